@@ -6,13 +6,14 @@ import simplejson
 
 from django.conf import settings
 from django.core.management import call_command
+from django.db import connection, reset_queries
 from django.utils.importlib import import_module
 
-from channelguide.channels.models import Item
+from channelguide.channels.models import AddedChannel, Channel, Item
 from channelguide.labels.models import Category, Language
 from channelguide.ratings.models import Rating
 from channelguide.search.models import ChannelSearchData
-from channelguide.subscriptions.models import Subscription
+from channelguide.subscriptions.models import GeneratedStats, Subscription
 from channelguide.testframework import TestCase, test_data_path
 from channelguide.api import utils
 
@@ -344,6 +345,44 @@ class ChannelApiViewTest(ChannelApiTestBase):
         self.assertEquals(len(data), 1)
         self.assertEquals(data[0]['id'], self.channels[1].id)
 
+    def test_suggest(self):
+        """
+        /api/suggest should return the channels and labels with a word
+        starting with the query, the most subscribed to first, and follow
+        changes to the channels.
+        """
+        GeneratedStats.objects.create(channel=self.channels[1],
+                                      subscription_count_month=5)
+        def suggest(query, **kwargs):
+            response = self.make_api_request('suggest', query=query,
+                                             **kwargs)
+            self.assertEquals(response.status_code, 200)
+            return [(data['type'], data['name'], data.get('id'))
+                    for data in eval(response.content)]
+        self.assertEquals(suggest('chan'), [
+                ('channel', 'My Channel 1', self.channels[1].id),
+                ('channel', 'My Channel 0', self.channels[0].id)])
+        self.assertEquals(suggest('chan', limit=-1), [
+                ('channel', 'My Channel 1', self.channels[1].id)])
+        self.assertEquals(len(suggest('chan', limit=1000)), 2)
+        self.assertEquals(suggest('my channel 0'), [
+                ('channel', 'My Channel 0', self.channels[0].id)])
+        self.assertEquals(suggest('TAG'), [('tag', 'tag0', None),
+                                           ('tag', 'tag1', None)])
+        self.assertEquals(suggest('testvision')[0],
+                          ('publisher', 'TestVision@TestVision.com', None))
+        self.channels[0].name = 'Rocketboom'
+        self.channels[0].save()
+        self.assertEquals(suggest('rocket'), [
+                ('channel', 'Rocketboom', self.channels[0].id)])
+        self.assertEquals(suggest('chan'), [
+                ('channel', 'My Channel 1', self.channels[1].id)])
+        self.channels[0].delete_tag(self.owner, 'tag0')
+        self.assertEquals(suggest('tag'), [('tag', 'tag1', None)])
+        self.channels[0].change_state(self.owner, Channel.REJECTED)
+        self.assertEquals(suggest('rocket'), [])
+        self.assertEquals(suggest('tag'), [])
+
     def test_get_session(self):
         response = self.make_api_request('get_session')
         self.assertEquals(response.status_code, 200)
@@ -986,6 +1025,38 @@ class ChannelApiFunctionTest(ChannelApiTestBase):
         self.assertEquals(channels[0].reasons[0].id, self.channels[0].id)
         self.assertTrue(channels[0].reasons[0].score > 0.5)
 
+    def count_queries(self, function, *args):
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        reset_queries()
+        try:
+            function(*args)
+        finally:
+            settings.DEBUG = old_debug
+        return len(connection.queries)
+
+    def test_get_recommendations_stored(self):
+        """
+        Once they're worked out, a user's recommendations should be counted
+        with one query and a page of them loaded with two, until the user
+        rates or adds a channel.
+        """
+        rating, created = Rating.objects.get_or_create(
+            channel=self.channels[0], user=self.owner)
+        rating.rating = 5
+        rating.save()
+        call_command('refresh_stats_table')
+        call_command('calculate_recommendations')
+        self.assertEquals(utils.get_recommendations(self.owner, None), 1)
+        self.assertEquals(self.count_queries(utils.get_recommendations,
+                                             self.owner, None, 10, 'feed'),
+                          1)
+        self.assertEquals(self.count_queries(utils.get_recommendations,
+                                             self.owner, 0, 10, 'feed'), 2)
+        AddedChannel.objects.create(channel=self.channels[1],
+                                    user=self.owner)
+        self.assertEquals(utils.get_recommendations(self.owner), [])
+
 
     def test_list_categories(self):
         categories = utils.list_labels('category')
@@ -10,6 +10,7 @@ urlpatterns = patterns('channelguide.api.views',
                        (r'^get_channels$', 'get_channels'),
                        (r'^get_feeds$', 'get_feeds'),
                        (r'^get_sites$', 'get_sites'),
+                       (r'^suggest$', 'suggest'),
                        (r'^get_session$', 'get_session'),
                        (r'^authenticate$', 'authenticate'),
                        (r'^rate$', 'rate'),
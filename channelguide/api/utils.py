@@ -5,14 +5,16 @@ from django.conf import settings
 from django.core import cache
 from django.contrib.auth.models import User
 from django.db.models import Q
+from channelguide.cache import utils as cache_utils
+from channelguide.search import suggest as suggest_mod
 from channelguide.search import utils as search_mod
-from channelguide.channels.models import Channel, AddedChannel, Item
+from channelguide.channels.models import Channel, Item
 from channelguide.labels.models import Category, Language
 from channelguide.ratings.models import Rating
-from channelguide.recommendations.models import Similarity
+from channelguide.recommendations import store as recommendation_store
 
+import copy
 import operator
-import time
 
 def login(id):
     try:
@@ -22,11 +24,7 @@ def login(id):
     return user
 
 def get_item(id):
-    itemKey = 'Item:%s' % id
-    timestamp = cache.cache.get(itemKey)
-    if timestamp is None:
-        timestamp = time.time()
-        cache.cache.set(itemKey, timestamp)
+    timestamp = cache_utils.get_stamps(['Item:%s' % id]).values()[0]
     apiKey = 'get_item:%s:%s' % (id, timestamp)
     item = cache.cache.get(apiKey)
     if item is None or not hasattr(item, '_state'):
@@ -44,11 +42,7 @@ def get_item_by_url(url):
         raise LookupError('item %s does not exist' % url)
 
 def get_channel(id):
-    channelKey = 'Channel:%s' % id
-    timestamp = cache.cache.get(channelKey)
-    if timestamp is None:
-        timestamp = time.time()
-        cache.cache.set(channelKey, timestamp)
+    timestamp = cache_utils.get_stamps(['Channel:%s' % id]).values()[0]
     apiKey = 'get_channel:%s:%s' % (id, timestamp)
     channel = cache.cache.get(apiKey)
     if channel is None or not hasattr(channel, '_state'):
@@ -73,6 +67,7 @@ def get_channels_query(request, filter_list, value_list, sort=None,
         value_list = [value_list]
     if request.user.has_perm('channels.change_channel'):
         query = Channel.objects.all()
+        states = Channel.name_for_state_code.keys()
     else:
         if 'audio' in filter_list:
             index = filter_list.index('audio')
@@ -81,10 +76,18 @@ def get_channels_query(request, filter_list, value_list, sort=None,
             value = value_list.pop(index)
             if value:
                 query = Channel.objects.filter(state=Channel.AUDIO)
+                states = [Channel.AUDIO]
             else:
                 query = Channel.objects.filter(state=Channel.APPROVED)
+                states = [Channel.APPROVED]
         else:
             query = Channel.objects.approved()
+            states = [Channel.APPROVED, Channel.AUDIO]
+    # the page showing these channels needs to be regenerated when a channel
+    # enters or leaves one of these states, or when the other data the query
+    # depends on changes
+    cache_utils.add_request_tags(request, *['State:%s' % state
+                                            for state in states])
     for filter, value in zip(filter_list, value_list):
         if filter == 'audio':
             if value:
@@ -93,8 +96,10 @@ def get_channels_query(request, filter_list, value_list, sort=None,
                 query = query.exclude(state=Channel.AUDIO)
         elif filter == 'category':
             query = query.filter(categories__name=value)
+            cache_utils.add_request_tags(request, u'Category:%s' % value)
         elif filter == 'tag':
             query = query.filter(tags__name=value)
+            cache_utils.add_request_tags(request, u'Tag:%s' % value)
         elif filter == 'language':
             query = query.filter(language__name=value)
         elif filter == 'featured':
@@ -109,7 +114,9 @@ def get_channels_query(request, filter_list, value_list, sort=None,
             if value is not None:
                 query = query.filter(name__istartswith=value)
         elif filter == 'search':
-            query = search_mod.search_channels(query, value.split())
+            query = search_mod.search_channels(query, value.split(),
+                                               states)
+            cache_utils.add_request_tags(request, 'search')
         else:
             raise ValueError('unknown filter: %r' % (filter,))
     if country_code:
@@ -129,7 +136,9 @@ def get_channels_query(request, filter_list, value_list, sort=None,
             sort = 'approved_at'
         elif sort == 'popular':
             sort = 'stats__subscription_count_today'
+            cache_utils.add_request_tags(request, 'Stats')
         elif sort == 'rating':
+            cache_utils.add_request_tags(request, 'Rating')
             query = query.filter(rating__count__gt=5).extra(
                 select={
                     'rating__bayes':
@@ -181,6 +190,22 @@ def _add_limit_and_offset(query, limit, offset, loads):
         query = query.select_related(*loads)
     return list(query[offset:offset+limit])
 
+def _add_limit_and_offset_and_tag(request, query, limit, offset, loads):
+    channels = _add_limit_and_offset(query, limit, offset, loads)
+    cache_utils.add_channel_tags(request, channels)
+    return channels
+
+def _add_matching_items(channels, filter, value):
+    """If the channels are search results, give them the items which matched
+    the search."""
+    if isinstance(filter, basestring):
+        filter = [filter]
+        value = [value]
+    if 'search' in filter:
+        search_mod.add_matching_items(
+            channels, value[list(filter).index('search')].split())
+    return channels
+
 def get_feeds(request, filter, value, sort=None, limit=None, offset=None,
               loads=None, country_code=None):
     use_sort = _use_sort(sort)
@@ -195,7 +220,9 @@ def get_feeds(request, filter, value, sort=None, limit=None, offset=None,
             return 0
     elif query is None:
         return []
-    return _add_limit_and_offset(query, limit, offset, loads)
+    channels = _add_limit_and_offset_and_tag(request, query, limit, offset,
+                                             loads)
+    return _add_matching_items(channels, filter, value)
 
 def get_sites(request, filter, value, sort=None, limit=None, offset=None,
               loads=None, country_code=None):
@@ -211,7 +238,9 @@ def get_sites(request, filter, value, sort=None, limit=None, offset=None,
             return 0
     elif query is None:
         return []
-    return _add_limit_and_offset(query, limit, offset, loads)
+    channels = _add_limit_and_offset_and_tag(request, query, limit, offset,
+                                             loads)
+    return _add_matching_items(channels, filter, value)
 
 def get_channels(request, filter, value, sort=None, limit=None, offset=None,
         loads=None, country_code=None):
@@ -232,10 +261,24 @@ def get_channels(request, filter, value, sort=None, limit=None, offset=None,
             return 0
     elif query is None:
         return []
-    return _add_limit_and_offset(query, limit, offset, loads)
+    return _add_limit_and_offset_and_tag(request, query, limit, offset,
+                                         loads)
+
+def suggest(prefix, limit=10):
+    """Return a list of dictionaries with the type ('channel', 'tag',
+    'category' or 'publisher') and name of the suggestions for prefix, and
+    the id of channels."""
+    suggestions = []
+    for kind, value, name in suggest_mod.suggest(prefix, limit):
+        data = {'type': kind, 'name': name}
+        if kind == 'channel':
+            data['id'] = value
+        suggestions.append(data)
+    return suggestions
 
 def search(terms):
-    return search_mod.search_channels(Channel.objects.approved(), terms)
+    return search_mod.search_channels(Channel.objects.approved(), terms,
+                                      [Channel.APPROVED, Channel.AUDIO])
 
 def rate(user, channel, score):
     rating, created = Rating.objects.get_or_create(user=user,
@@ -267,83 +310,57 @@ def get_ratings(user, rating=None):
                                                        rating=rating)]
 
 def get_recommendations(user, start=0, length=10, filter=None):
-    ratings = Rating.objects.filter(user=user).order_by('-timestamp')
-    added_channels = AddedChannel.objects.filter(user=user).order_by(
-        '-timestamp')
-    if len(ratings):
-        if added_channels.count():
-            key = str(
-                max(ratings[0].timestamp,
-                    added_channels[0].timestamp).isoformat())
-        else:
-            key = str(ratings[0].timestamp.isoformat())
-        cacheKey = ':'.join(('recommendations_for', str(user.id),
-                             key))
-        result = cache.cache.get(cacheKey)
-        if result is None:
-            (estimatedRatings,
-             reasons) = Similarity.objects.recommend_from_ratings(
-                ratings)
-            added_ids = [added.channel_id for added in added_channels]
-            toSort = estimatedRatings.items()
-            toSort.sort(key=operator.itemgetter(1), reverse=True)
-            ids = [cid for (cid, rating) in toSort if rating>=3.25 and
-                   cid not in added_ids]
-            ids = ids[:99]
-            for id in estimatedRatings.keys():
-                if id not in ids:
-                    del estimatedRatings[id]
-            for id in reasons.keys():
-                if id not in ids:
-                    del reasons[id]
-            result = estimatedRatings, reasons, ids
-            cache.cache.set(cacheKey, result)
-        else:
-            estimatedRatings, reasons, ids = result
-        if not ids:
-            if start is None:
-                return 0
-            else:
-                return []
-        query = Channel.objects.filter(id__in=ids).select_related('stats',
-                                                                  'rating')
-        if filter is not None:
-            if filter == 'feed':
-                query = query.filter(url__isnull=False)
-            elif filter == 'site':
-                query = query.filter(url__isnull=True)
-            else:
-                raise ValueError('unknown recommendations filter: %r' % filter)
-        if start is None:
-            if not ids:
-                return 0
-            else:
-                return query.count()
-        profile = user.get_profile()
-        if profile.filter_languages:
-            query = query.filter(
-                language__in=profile.shown_languages.all())
-        channels = list(query)
-        for channel in channels:
-            channel.guessed = estimatedRatings[channel.id]
-        channels.sort(key=operator.attrgetter('guessed'), reverse=True)
-        channels = channels[start:start+length]
-        for channel in channels:
-            if channel.id in reasons:
-                channelReasons = dict((cid, score) for (score, cid) in
-                                      reasons[channel.id][-3:])
-                channel.reasons = list(Channel.objects.filter(
-                        id__in=channelReasons.keys()))
-                for reason in channel.reasons:
-                    reason.score = channelReasons[reason.id]
-                channel.reasons.sort(key=operator.attrgetter('score'),
-                                     reverse=True)
-        return channels
-    else:
+    """
+    Return the user's recommended channels from start to start+length,
+    best first, each with the rating we guess they'd give it as .guessed
+    and the channels they rated which it's recommended because of as
+    .reasons; or the number of them if start is None.
+    """
+    recommendations = recommendation_store.get_recommendations(user.id)
+    if not recommendations.ids:
         if start is None:
             return 0
         else:
             return []
+    query = Channel.objects.filter(id__in=recommendations.ids)
+    if filter is not None:
+        if filter == 'feed':
+            query = query.filter(url__isnull=False)
+        elif filter == 'site':
+            query = query.filter(url__isnull=True)
+        else:
+            raise ValueError('unknown recommendations filter: %r' % filter)
+    if start is None:
+        return query.count()
+    profile = user.get_profile()
+    if profile.filter_languages:
+        query = query.filter(
+            language__in=profile.shown_languages.all())
+    shown = set(query.values_list('id', flat=True))
+    ids = [id for id in recommendations.ids if id in shown]
+    ids = ids[start:start+length]
+    reasons = dict((id, recommendations.reasons.get(id, [])) for id in ids)
+    # the channels and the channels they're recommended because of, together
+    reason_ids = set(cid for id in ids for (score, cid) in reasons[id])
+    loaded = Channel.objects.select_related('stats', 'rating').in_bulk(
+        list(reason_ids.union(ids)))
+    channels = []
+    for id in ids:
+        if id not in loaded:
+            continue
+        channel = loaded[id]
+        channel.guessed = recommendations.scores[id]
+        if reasons[id]:
+            channel.reasons = []
+            for score, cid in reasons[id]:
+                if cid in loaded:
+                    reason = copy.copy(loaded[cid])
+                    reason.score = score
+                    channel.reasons.append(reason)
+            channel.reasons.sort(key=operator.attrgetter('score'),
+                                 reverse=True)
+        channels.append(channel)
+    return channels
 
 def list_labels(type):
     if type == 'category':
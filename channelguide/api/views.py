@@ -14,8 +14,10 @@ from django.utils.importlib import import_module
 from django.utils.translation import ugettext as _
 
 from channelguide import util
-from channelguide.cache.decorators import api_cache
+from channelguide.cache import utils as cache_utils
+from channelguide.cache.decorators import api_cache, shared_api_cache
 from channelguide.api import utils as api_utils
+from channelguide.search import suggest as suggest_mod
 
 def requires_arguments(*arguments):
     def outer(func):
@@ -144,6 +146,8 @@ def get_item(request):
         except LookupError:
             return error_response(request, 'ITEM_NOT_FOUND',
                                   'Item %s not found' % value)
+    cache_utils.add_request_tags(request, *['Item:%i' % item.pk
+                                            for item in items])
     if request.user.is_authenticated():
         for item in items:
             item.score = api_utils.get_rating(request.user, item)
@@ -173,6 +177,7 @@ def get_channel(request):
         except LookupError:
             return error_response(request, 'CHANNEL_NOT_FOUND',
                                   'Channel %s not found' % value)
+    cache_utils.add_channel_tags(request, channels)
     if request.user.is_authenticated():
         for channel in channels:
             channel.score = api_utils.get_rating(
@@ -204,21 +209,34 @@ def _get_channels(request, api_method=api_utils.get_channels):
     data = map(data_for_channel, channels)
     return response_for_data(request, data)
 
-@api_cache
+@shared_api_cache
 @requires_arguments('filter', 'filter_value')
 def get_channels(request):
     return _get_channels (request)
 
-@api_cache
+@shared_api_cache
 @requires_arguments('filter', 'filter_value')
 def get_feeds(request):
     return _get_channels (request, api_utils.get_feeds)
 
-@api_cache
+@shared_api_cache
 @requires_arguments('filter', 'filter_value')
 def get_sites(request):
     return _get_channels (request, api_utils.get_sites)
 
+@requires_arguments('query')
+def suggest(request):
+    # not cached: the suggestions are in memory already
+    try:
+        limit = int(request.GET.get('limit', 10))
+    except ValueError:
+        raise Http404
+    # no more than the index keeps, and a negative one would slice from
+    # the end
+    limit = max(1, min(limit, suggest_mod.MAX_SUGGESTIONS))
+    return response_for_data(request, api_utils.suggest(
+            request.GET['query'], limit))
+
 def get_session(request):
     engine = import_module(settings.SESSION_ENGINE)
     key = engine.SessionStore(None).session_key
@@ -268,6 +286,7 @@ def rate(request):
                               'Channel %s not found' % request.GET.get('id'))
     if 'rating' in request.GET:
         api_utils.rate(request.user, channel, request.GET['rating'])
+    cache_utils.add_channel_tags(request, [channel])
     return response_for_data(request,
                              {'rating':
                                   api_utils.get_rating(
@@ -285,6 +304,7 @@ def get_recommendations(request):
 @api_cache
 @requires_login
 def get_ratings(request):
+    cache_utils.add_request_tags(request, 'Rating')
     rating = request.GET.get('rating')
     if rating is not None:
         ratings = api_utils.get_ratings(request.user,
@@ -299,9 +319,10 @@ def get_ratings(request):
             data[index]['rating'] = ratings[channels]
         return response_for_data(request, data)
 
-@api_cache
+@shared_api_cache
 def list_labels(request, type):
     labels = api_utils.list_labels(type)
+    cache_utils.add_request_tags(request, type.capitalize())
     data = [
         {'name': label.name,
          'url': label.get_absolute_url()}
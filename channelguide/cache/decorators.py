@@ -3,10 +3,24 @@
 
 from middleware import UserCacheMiddleware
 from middleware import SiteHidingCacheMiddleware, APICacheMiddleware
-from django.utils.decorators import (decorator_from_middleware,
-                                     decorator_from_middleware_with_args)
+from django.utils.decorators import decorator_from_middleware_with_args
 
-cache_with_sites = decorator_from_middleware_with_args(
-    SiteHidingCacheMiddleware)
-cache_for_user = decorator_from_middleware(UserCacheMiddleware)
-api_cache = decorator_from_middleware(APICacheMiddleware)
+def view_cache_decorator(middleware_class):
+    """
+    Like decorator_from_middleware_with_args(), but the middleware is told
+    the name of the view it caches, so that its counters are kept per view.
+    """
+    make_decorator = decorator_from_middleware_with_args(middleware_class)
+    def with_args(*args, **kwargs):
+        def decorator(view_func):
+            view_name = '%s.%s' % (view_func.__module__, view_func.__name__)
+            return make_decorator(*args, **dict(kwargs, view_name=view_name))(
+                view_func)
+        return decorator
+    return with_args
+
+cache_with_sites = view_cache_decorator(SiteHidingCacheMiddleware)
+cache_for_user = view_cache_decorator(UserCacheMiddleware)()
+api_cache = view_cache_decorator(APICacheMiddleware)()
+# for API calls whose results don't depend on who's asking
+shared_api_cache = view_cache_decorator(APICacheMiddleware)(per_user=False)
@@ -0,0 +1,177 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+"""Per-user fragments of cached pages.
+
+Pages cached in fragment mode are rendered once for everyone who sees the
+same page, with a placeholder where each per-user fragment goes (the account
+menu, the user's own rating, the edit bar).  The placeholders are filled in
+for each request after the page comes out of the cache, the way
+NotificationMiddleware fills in the notification bar.
+
+Use the {% fragment %} tag (in the 'fragments' library) to put a fragment in
+a template.  When the page isn't being cached in fragment mode, the fragment
+is rendered right away.
+"""
+
+import md5
+import re
+import urllib
+
+from django.conf import settings
+from django.template.context import RequestContext
+from django.template.loader import get_template, render_to_string
+
+# part of every placeholder, so that text which ends up in a page (a channel
+# description, say) can't pass itself off as one
+TOKEN = md5.new('fragments:' + settings.SECRET_KEY).hexdigest()[:12]
+FRAGMENT_RE = re.compile(r'<!-- FRAGMENT %s ([\w-]+)((?: [^ ]+)*) -->' %
+                         TOKEN)
+
+_fragments = {}
+
+def register(name, batch=False):
+    """
+    Register a function which renders a fragment.  It's called with the
+    request, a template context and the arguments given to the {% fragment
+    %} tag (as strings, if the fragment comes from a placeholder).
+
+    If batch is True, the function is instead called once with a list of the
+    argument tuples for every placeholder on the page, and returns a list of
+    the rendered fragments.
+    """
+    def decorator(func):
+        _fragments[name] = (func, batch)
+        return func
+    return decorator
+
+def is_deferred(request):
+    """Return True if fragments for this request should be left as
+    placeholders.
+    """
+    return getattr(request, 'cache_fragments', False)
+
+def _quote(arg):
+    if isinstance(arg, unicode):
+        arg = arg.encode('utf8')
+    return urllib.quote(str(arg), '')
+
+def placeholder(name, *args):
+    return '<!-- FRAGMENT %s %s -->' % (
+        TOKEN, ' '.join([name] + [_quote(arg) for arg in args]))
+
+def render(request, context, name, *args):
+    """Render a single fragment with the given template context."""
+    func, batch = _fragments[name]
+    if batch:
+        return func(request, context, [args])[0]
+    return func(request, context, *args)
+
+def fill(request, content):
+    """Replace the placeholders in content with the fragments for this
+    request.
+    """
+    matches = list(FRAGMENT_RE.finditer(content))
+    if not matches:
+        return content
+    wanted = {}
+    for match in matches:
+        args = tuple([urllib.unquote(arg).decode('utf8')
+                      for arg in match.group(2).split()])
+        arg_lists = wanted.setdefault(match.group(1), [])
+        if args not in arg_lists:
+            arg_lists.append(args)
+    context = RequestContext(request)
+    rendered = {}
+    for name, arg_lists in wanted.items():
+        if name not in _fragments:
+            continue
+        func, batch = _fragments[name]
+        if batch:
+            results = func(request, context, arg_lists)
+        else:
+            results = [func(request, context, *args) for args in arg_lists]
+        for args, result in zip(arg_lists, results):
+            if isinstance(result, unicode):
+                result = result.encode('utf8')
+            rendered[name, args] = result
+    def replace(match):
+        args = tuple([urllib.unquote(arg).decode('utf8')
+                      for arg in match.group(2).split()])
+        return rendered.get((match.group(1), args), '')
+    return FRAGMENT_RE.sub(replace, content)
+
+def render_template(template_name, context, dictionary=None):
+    """Render a template with the given context, like {% include %} does,
+    without leaving anything behind in the context.
+    """
+    context.update(dictionary or {})
+    try:
+        return get_template(template_name).render(context)
+    finally:
+        context.pop()
+
+def _get_user(request, context):
+    # templates get the user from the context, so fragments do as well
+    user = context.get('user')
+    if user is None:
+        user = request.user
+    return user
+
+@register('account-link')
+def account_link(request, context):
+    return render_template('guide/account-link.html', context)
+
+@register('topmenu')
+def topmenu(request, context):
+    return render_template('guide/topmenu_dropdowns.html', context)
+
+@register('rating', batch=True)
+def rating_stars(request, context, arg_lists):
+    from channelguide.ratings.models import Rating, GeneratedRatings
+    from channelguide.ratings.templatetags.ratings import display_rating
+    channel_ids = set([int(args[0]) for args in arg_lists])
+    user = _get_user(request, context)
+    user_ratings = {}
+    if user.is_authenticated():
+        for rating in Rating.objects.filter(user=user,
+                                            channel__in=channel_ids):
+            user_ratings[rating.channel_id] = rating
+    generated = GeneratedRatings.objects.in_bulk(
+        channel_ids - set(user_ratings))
+    results = []
+    for args in arg_lists:
+        channel_id = int(args[0])
+        if channel_id not in user_ratings and channel_id not in generated:
+            generated[channel_id], created = \
+                GeneratedRatings.objects.get_or_create(pk=channel_id)
+        rating = display_rating(user_ratings.get(channel_id), channel_id,
+                                generated.get(channel_id))
+        results.append(render_to_string('ratings/rating.html', {
+                    'rating': rating,
+                    'referer': request.path,
+                    'small': args[1:] and args[1] or ''}))
+    return results
+
+@register('channel-edit-bar')
+def channel_edit_bar(request, context, channel_id):
+    from channelguide.channels.models import Channel
+    from channelguide.featured.models import FeaturedQueue
+    try:
+        channel = Channel.objects.get(pk=channel_id)
+    except (Channel.DoesNotExist, ValueError):
+        return ''
+    user = _get_user(request, context)
+    if not channel.can_edit(user):
+        return ''
+    if user.has_perm('featured.change_featuredqueue'):
+        try:
+            featured_queue = channel.featured_queue
+        except FeaturedQueue.DoesNotExist:
+            pass
+        else:
+            if featured_queue.state in (
+                FeaturedQueue.IN_QUEUE, FeaturedQueue.CURRENT):
+                channel.featured = True
+    return render_template('channels/edit-bar.html', context,
+                           {'channel': channel})
@@ -0,0 +1,96 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core import cache
+from django.core.management.base import NoArgsCommand
+from django.http import HttpRequest, HttpResponse
+
+from channelguide.cache import utils
+from channelguide.cache.middleware import UserCacheMiddleware
+
+class CountingCache(object):
+    """
+    Wraps the cache backend and counts the calls made to it; each one is a
+    round trip with memcached.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return attr(*args, **kwargs)
+        return counted
+
+class LegacyKeyMiddleware(UserCacheMiddleware):
+    """Builds keys the way the middleware used to."""
+    def get_cache_key(self, request):
+        prefix = UserCacheMiddleware.__name__ + ":"
+        return prefix + hex(hash(self.get_cache_key_tuple(request)))
+
+class Command(NoArgsCommand):
+    """
+    Time cache hits in the page cache middleware with the old key scheme and
+    no per-process stamp cache against the digest keys and stamp cache.
+    """
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('-n', '--hits', type='int', default=10000,
+                    help='Number of cache hits to time'),
+        make_option('-t', '--tags', type='int', default=10,
+                    help='Number of tags each page depends on'),)
+
+    def make_request(self, path):
+        request = HttpRequest()
+        request.method = 'GET'
+        request.path = path
+        request.user = AnonymousUser()
+        request.session = {}
+        request.LANGUAGE_CODE = settings.LANGUAGE_CODE
+        request.META['QUERY_STRING'] = 'page=2&sort=-popular'
+        return request
+
+    def run(self, middleware, hits, tags):
+        path = '/benchmark/%s' % middleware.__class__.__name__
+        request = self.make_request(path)
+        utils.add_request_tags(request, *tags)
+        middleware.process_request(request)
+        middleware.process_response(request, HttpResponse('x' * 10000))
+        counting = cache.cache = CountingCache(cache.cache)
+        try:
+            start = time.time()
+            for i in xrange(hits):
+                response = middleware.process_request(
+                    self.make_request(path))
+                assert response is not None, 'benchmark page was not cached'
+            elapsed = time.time() - start
+        finally:
+            cache.cache = counting.backend
+        return elapsed, counting.calls
+
+    def handle_noargs(self, **options):
+        hits = options['hits']
+        tags = ['Channel:%i' % i for i in range(options['tags'])]
+        utils.local_stamps.clear()
+        timeout = utils.local_stamps.timeout
+        results = []
+        try:
+            utils.local_stamps.timeout = 0
+            results.append(('before', self.run(LegacyKeyMiddleware(), hits,
+                                               tags)))
+        finally:
+            utils.local_stamps.timeout = timeout
+        results.append(('after', self.run(UserCacheMiddleware(), hits,
+                                          tags)))
+        print '%i hits, %i tags per page, %s' % (
+            hits, len(tags), settings.CACHE_BACKEND)
+        print '%-8s %14s %18s' % ('', 'usec per hit', 'cache calls per hit')
+        for name, (elapsed, calls) in results:
+            print '%-8s %14.1f %18.2f' % (name, elapsed * 1000000 / hits,
+                                          float(calls) / hits)
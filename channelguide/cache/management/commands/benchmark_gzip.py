@@ -0,0 +1,95 @@
+import cPickle
+import sys
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.http import HttpRequest, HttpResponse
+from django.middleware.gzip import GZipMiddleware
+from django.test.client import Client
+
+from channelguide.cache.middleware import UserCacheMiddleware
+
+DEFAULT_PATHS = (
+    '/',
+    '/popular/',
+    '/api/get_channels?filter=name&filter_value=&sort=-popular&limit=20'
+    '&datatype=json')
+
+class Command(BaseCommand):
+    """
+    Compare the size of cache entries and the time a cache hit takes when
+    pages are stored uncompressed (and gzipped by GZipMiddleware on every
+    hit), stored gzipped, and stored both ways.
+    """
+    args = '[path ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--hits', type='int', default=1000,
+                    help='Number of cache hits to time'),)
+
+    modes = (
+        # name, gzip_min_length, store_identity
+        ('plain', sys.maxint, False),
+        ('gzip', UserCacheMiddleware.gzip_min_length, False),
+        ('both', UserCacheMiddleware.gzip_min_length, True),
+        )
+
+    def make_request(self, path, accept_gzip):
+        request = HttpRequest()
+        request.method = 'GET'
+        request.path = path
+        request.user = AnonymousUser()
+        request.session = {}
+        request.LANGUAGE_CODE = settings.LANGUAGE_CODE
+        if accept_gzip:
+            request.META['HTTP_ACCEPT_ENCODING'] = 'gzip, deflate'
+        return request
+
+    def get_page(self, path):
+        response = Client().get(path)
+        if response.status_code != 200:
+            raise CommandError('%s returned %i' % (path,
+                                                   response.status_code))
+        return response.content
+
+    def time_hits(self, middleware, path, hits, accept_gzip):
+        gzip_middleware = GZipMiddleware()
+        start = time.time()
+        for i in xrange(hits):
+            request = self.make_request(path, accept_gzip)
+            response = middleware.process_request(request)
+            assert response is not None, 'benchmark page was not cached'
+            # what the rest of the middleware stack does with the page
+            response = gzip_middleware.process_response(request, response)
+            len(response.content)
+        return (time.time() - start) * 1000000 / hits
+
+    def run(self, content, content_id, mode, hits):
+        name, gzip_min_length, store_identity = mode
+        middleware = UserCacheMiddleware(view_name='benchmark')
+        middleware.gzip_min_length = gzip_min_length
+        middleware.store_identity = store_identity
+        path = '/benchmark/gzip/%s/%s' % (name, content_id)
+        request = self.make_request(path, False)
+        middleware.process_request(request)
+        middleware.process_response(request, HttpResponse(content))
+        entry = cache.cache.get(middleware.get_cache_key(request))
+        size = len(cPickle.dumps(entry, cPickle.HIGHEST_PROTOCOL))
+        return (size, self.time_hits(middleware, path, hits, True),
+                self.time_hits(middleware, path, hits, False))
+
+    def handle(self, *paths, **options):
+        hits = options['hits']
+        print '%i hits per page, %s' % (hits, settings.CACHE_BACKEND)
+        print '%-40s %-6s %10s %14s %14s' % (
+            'page', 'stored', 'entry size', 'usec gzip hit',
+            'usec plain hit')
+        for i, path in enumerate(paths or DEFAULT_PATHS):
+            content = self.get_page(path)
+            for mode in self.modes:
+                size, gzip_hit, plain_hit = self.run(content, i, mode, hits)
+                print '%-40s %-6s %10i %14.1f %14.1f' % (
+                    path[:40], mode[0], size, gzip_hit, plain_hit)
@@ -0,0 +1,43 @@
+from django.core.management.base import NoArgsCommand
+
+from channelguide.cache import utils
+
+class Command(NoArgsCommand):
+    """
+    Print the cache hit rate for each kind of tag, along with how often tags
+    of that kind get bumped, and how often each cached view was served from
+    the cache, served stale, or regenerated.
+    """
+
+    args = ''
+
+    def handle_noargs(self, **options):
+        utils.counters.flush()
+        totals = utils.counters.get_totals()
+        kinds = sorted(set(kind for (event, kind) in totals))
+        print '%-12s %10s %10s %12s %10s %8s' % (
+            'tag', 'hits', 'misses', 'invalidated', 'bumps', 'hit %')
+        for kind in kinds:
+            hits = totals.get(('hit', kind), 0)
+            misses = totals.get(('miss', kind), 0)
+            invalidated = totals.get(('invalidated', kind), 0)
+            bumps = totals.get(('bump', kind), 0)
+            lookups = hits + misses + invalidated
+            if lookups:
+                rate = '%.1f' % (100.0 * hits / lookups)
+            else:
+                rate = '-'
+            print '%-12s %10i %10i %12i %10i %8s' % (
+                kind, hits, misses, invalidated, bumps, rate)
+
+        print
+        utils.view_counters.flush()
+        totals = utils.view_counters.get_totals()
+        views = sorted(set(view for (event, view) in totals))
+        print '%-50s %10s %10s %12s' % ('view', 'hits', 'stale',
+                                        'regenerated')
+        for view in views:
+            print '%-50s %10i %10i %12i' % (
+                view, totals.get(('hit', view), 0),
+                totals.get(('stale', view), 0),
+                totals.get(('regenerate', view), 0))
@@ -1,11 +1,21 @@
 
 # See LICENSE for details.
 
+import md5
+import re
 import time
+import urllib
+import urlparse
 from django.conf import settings
 from django.core import cache
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.http import parse_etags, quote_etag
+from django.utils.text import compress_string
 
 from channelguide import util
+from channelguide.cache import fragments, utils
 from channelguide.guide.country import country_code
 
 try:
@@ -19,31 +29,146 @@ else:
                 return True # our cache middleware
             return MongoStatsMiddleware.request_was_cached(self, request)
 
+re_accepts_gzip = re.compile(r'\bgzip\b')
+
+def make_etag(content):
+    return md5.new(content).hexdigest()
+
+class CacheEntry(object):
+    """
+    What actually gets stored in the cache: the cached object along with the
+    stamps of the tags it depends on and the time it should be regenerated.
+    The entry stays in the cache for a while after that so it can be served
+    while one request regenerates it.
+
+    The ETag and Last-Modified time of the cached page are stored with it,
+    so that conditional requests can be answered without looking at the
+    page.  Large pages are stored gzipped in gzipped_content, and the
+    cached response's own content is then left empty unless the middleware
+    keeps both.
+    """
+    def __init__(self, cached_object, stamps, expires, etag=None,
+                 last_modified=None):
+        self.cached_object = cached_object
+        self.stamps = stamps
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+        self.gzipped_content = None
+
+    def stale_tags(self):
+        """Return the tags which have been bumped since this entry was
+        cached.
+        """
+        current = utils.get_stamps(self.stamps.keys())
+        return [tag for tag, stamp in self.stamps.items()
+                if current[tag] != stamp]
+
 class CacheMiddlewareBase(object):
     cache_time = settings.CACHE_MIDDLEWARE_SECONDS # how many seconds to cache
                                                    # for
+    # how many seconds past its expiry (or the time its tags were bumped) a
+    # page can be served while another request regenerates it
+    stale_time = getattr(settings, 'CACHE_MIDDLEWARE_STALE_SECONDS', 60)
+    # how long one request gets to regenerate a page before another request
+    # takes over
+    lock_time = getattr(settings, 'CACHE_MIDDLEWARE_LOCK_SECONDS', 30)
     namespace = 'namespace'
+    # the GET arguments the view looks at; others don't get their own cache
+    # entry.  None means the view might use any of them.
+    query_params = None
+    # arguments which never change the page: cache busters and tracking
+    ignored_query_params = ('_',)
+    ignored_query_prefixes = ('utm_',)
+    # if False, users who see the same page (same permissions and language
+    # filter) share the cache entry
+    per_user = True
+    # if True, the page is cached with placeholders for the per-user parts,
+    # which are filled in for each request (see cache.fragments).  Pages
+    # cached this way are always shared.
+    fragment_mode = False
+    # pages at least this long are stored gzipped, and served that way to
+    # clients which accept it
+    gzip_min_length = 200
+    # if True, the uncompressed page is stored as well, so that clients
+    # which don't accept gzip don't cost a decompression.  Doubles the
+    # memory each page takes.
+    store_identity = getattr(settings, 'CACHE_MIDDLEWARE_STORE_IDENTITY',
+                             False)
 
-    def __init__(self, namespace=None):
+    def __init__(self, namespace=None, view_name=None, query_params=None,
+                 per_user=None, fragment_mode=None):
         if namespace is not None:
             # used to separately cache search pages
             self.namespace = namespace
+        if view_name is None:
+            view_name = self.__class__.__name__
+        self.view_name = view_name
+        if query_params is not None:
+            self.query_params = query_params
+        if per_user is not None:
+            self.per_user = per_user
+        if fragment_mode is not None:
+            self.fragment_mode = fragment_mode
+
+    def get_namespace_names(self):
+        if not isinstance(self.namespace, tuple):
+            return (self.namespace,)
+        else:
+            return self.namespace
+
+    def get_cache_tags(self, request):
+        """Return the tags that every page cached by this middleware depends
+        on.  Views add more specific ones with cache.utils.add_request_tags().
+        """
+        return self.get_namespace_names()
 
     def get_cache_key_tuple(self, request):
         """Return a tuple that will be used to create the cache key."""
-        if not isinstance(self.namespace, tuple):
-            namespace_names = (self.namespace,)
+        return self.get_namespace_names() + (request.LANGUAGE_CODE,)
+
+    def use_query_param(self, name):
+        if name in self.ignored_query_params:
+            return False
+        for prefix in self.ignored_query_prefixes:
+            if name.startswith(prefix):
+                return False
+        return self.query_params is None or name in self.query_params
+
+    def get_query_key(self, request):
+        """Return the query string in a canonical form, without the arguments
+        that don't change the page.
+        """
+        args = urlparse.parse_qsl(request.META.get('QUERY_STRING') or '',
+                                  keep_blank_values=True)
+        args = [(name, value) for (name, value) in args
+                if self.use_query_param(name)]
+        args.sort()
+        return urllib.urlencode(args)
+
+    def get_language_filter_key(self, request):
+        if request.user.is_authenticated():
+            profile = request.user.get_profile()
+            if profile.filter_languages:
+                return tuple(sorted([lang.name for lang in
+                                     profile.shown_languages.all()]))
+        elif request.session.get('filter_languages'):
+            return request.LANGUAGE_CODE
+        return ''
+
+    def get_user_key(self, request):
+        """Return a tuple which identifies what the user will see on the
+        page.
+        """
+        if not request.user.is_authenticated():
+            user = None
+        elif self.per_user and not self.fragment_mode:
+            user = request.user.username
         else:
-            namespace_names = self.namespace
-        namespace_values = cache.cache.get_many(namespace_names)
-        for name in namespace_names:
-            if type(namespace_values.get(name, None)) is not float:
-                namespace_values[name] = None
-            if namespace_values.get(name, None) is None:
-                namespace_values[name] = time.time()
-                cache.cache.set(name, namespace_values[name])
-        return tuple([namespace_values[k] for k in namespace_names]) + (
-            request.LANGUAGE_CODE,)
+            # users with the same permissions see the same page
+            user = (request.user.is_superuser,
+                    tuple(sorted(request.user.get_all_permissions())))
+        return (user, self.get_language_filter_key(request))
 
     def response_to_cache_object(self, request, response):
         return response
@@ -52,34 +177,228 @@ class CacheMiddlewareBase(object):
         return cached_object
 
     def get_cache_key(self, request):
-        prefix = self.__class__.__name__ + ":"
-        tuple = self.get_cache_key_tuple(request)
-        return prefix + hex(hash(tuple))
+        return utils.digest_key(self.__class__.__name__,
+                                self.get_cache_key_tuple(request))
 
     def can_cache_request(self, request):
         return (request.method == 'GET' and
                 'no-cache' not in request.META.get('HTTP_CACHE_CONTROL', ''))
 
+    def get_lock_key(self, key):
+        return 'lock:' + key
+
+    def acquire_regenerate_lock(self, request, key):
+        """
+        Try to become the request which regenerates the page.  Returns False
+        if another request is already doing it.
+        """
+        if not cache.cache.add(self.get_lock_key(key), True, self.lock_time):
+            return False
+        if not hasattr(request, '_cache_locks'):
+            request._cache_locks = set()
+        request._cache_locks.add(key)
+        return True
+
+    def release_regenerate_lock(self, request, key):
+        locks = getattr(request, '_cache_locks', ())
+        if key in locks:
+            locks.remove(key)
+            cache.cache.delete(self.get_lock_key(key))
+
+    def make_entry(self, request, response, stamps):
+        now = time.time()
+        cached_object = self.response_to_cache_object(request, response)
+        content = cached_object.content
+        entry = CacheEntry(cached_object, stamps, now + self.cache_time,
+                           make_etag(content), now)
+        if (len(content) >= self.gzip_min_length and
+                not cached_object.has_header('Content-Encoding')):
+            entry.gzipped_content = compress_string(content)
+        return entry
+
+    def is_rewritten_later(self, request):
+        """
+        Return True if middleware further out will still change the page.
+        NotificationMiddleware fills in the notification bar when there are
+        notifications to show, which it can't do to a gzipped page.
+        """
+        return bool(getattr(request, 'notifications', None))
+
+    def can_serve_gzipped(self, request):
+        """
+        Return True if the gzipped page can be sent as it is: the client
+        accepts it, and nothing needs to change in the page.
+        """
+        return (getattr(request, '_cache_outermost', None) is self and
+                not fragments.is_deferred(request) and
+                not self.is_rewritten_later(request) and
+                re_accepts_gzip.search(
+                    request.META.get('HTTP_ACCEPT_ENCODING', '')) is not None)
+
+    def response_from_entry(self, request, entry, content=None):
+        """
+        Return the response to send for a cache entry.  If the uncompressed
+        page is already known (because it was just rendered), it's passed as
+        content.
+        """
+        response = entry.cached_object
+        gzipped_content = getattr(entry, 'gzipped_content', None)
+        if gzipped_content is None:
+            return self.response_from_cache_object(request, response)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if self.can_serve_gzipped(request):
+            response.content = gzipped_content
+            response['Content-Encoding'] = 'gzip'
+            response['Content-Length'] = str(len(gzipped_content))
+            response._cache_gzipped = True
+            return response
+        if content is None:
+            content = response.content or utils.decompress_string(
+                gzipped_content)
+        response.content = content
+        return self.response_from_cache_object(request, response)
+
+    def serve_cached(self, request, entry):
+        response = self.response_from_entry(request, entry)
+        request._cache_hit = response._cache_hit = True
+        return self.add_validators(request,
+                                   self.fill_fragments(request, response),
+                                   entry)
+
+    def start_fragments(self, request):
+        """
+        Have the page rendered with placeholders for the per-user fragments.
+        If cached pages are nested, the outermost one fills them in.
+        """
+        if not hasattr(request, '_cache_fragment_owner'):
+            request._cache_fragment_owner = self
+            request.cache_fragments = True
+
+    def fill_fragments(self, request, response):
+        if getattr(request, '_cache_fragment_owner', None) is self:
+            response.content = fragments.fill(request, response.content)
+        return response
+
+    def get_etag(self, request, entry):
+        """Return the ETag for a response served from the given entry."""
+        return entry.etag
+
+    def client_has_response(self, request, etag, last_modified):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            etags = parse_etags(if_none_match)
+            return etag in etags or '*' in etags
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE'))
+        return (if_modified_since is not None and last_modified is not None
+                and int(last_modified) <= if_modified_since)
+
+    def add_validators(self, request, response, entry=None):
+        """
+        Give the response ETag and Last-Modified headers, and if the client
+        already has this version of the page send a 304 instead.  Only the
+        outermost cache middleware does this, once the fragments have been
+        filled in.
+        """
+        if (getattr(request, '_cache_outermost', None) is not self or
+                response.status_code != 200):
+            return response
+        if self.is_rewritten_later(request):
+            # the client can't have this page, and we don't know what it
+            # will be
+            return response
+        if (fragments.is_deferred(request) or entry is None or
+                getattr(entry, 'etag', None) is None):
+            # the page isn't exactly what's in the entry; the fragments
+            # can change without the entry changing, so there's no
+            # Last-Modified time either
+            etag = make_etag(response.content)
+            last_modified = None
+        else:
+            etag = self.get_etag(request, entry)
+            if getattr(response, '_cache_gzipped', False):
+                etag += '-gzip'
+            last_modified = entry.last_modified
+        response['ETag'] = quote_etag(etag)
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        if not self.client_has_response(request, etag, last_modified):
+            return response
+        not_modified = HttpResponseNotModified()
+        for header in ('ETag', 'Last-Modified', 'Cache-Control', 'Expires',
+                       'Vary'):
+            if response.has_header(header):
+                not_modified[header] = response[header]
+        return not_modified
+
     def process_request(self, request):
+        if not hasattr(request, '_cache_outermost'):
+            request._cache_outermost = self
+        if self.fragment_mode:
+            self.start_fragments(request)
         if not self.can_cache_request(request):
             return None
         key = self.get_cache_key(request)
-        cached_object = cache.cache.get(key)
-        if cached_object is None:
-            return None
+        entry = cache.cache.get(key)
+        if not isinstance(entry, CacheEntry):
+            utils.counters.incr('miss', self.get_cache_tags(request))
         else:
-            response = self.response_from_cache_object(request, cached_object)
-            request._cache_hit = response._cache_hit = True
-            return response
+            now = time.time()
+            stale_tags = entry.stale_tags()
+            if stale_tags:
+                utils.counters.incr('invalidated', stale_tags)
+            elif now < entry.expires:
+                utils.counters.incr('hit', entry.stamps.keys())
+                utils.view_counters.incr('hit', [self.view_name])
+                return self.serve_cached(request, entry)
+            # the entry is stale; unless it's too old, only one request
+            # regenerates it and everyone else gets the stale copy
+            if (not self.acquire_regenerate_lock(request, key) and
+                    now < entry.expires + self.stale_time):
+                utils.view_counters.incr('stale', [self.view_name])
+                return self.serve_cached(request, entry)
+        utils.view_counters.incr('regenerate', [self.view_name])
+        # read the stamps before the page is rendered, so that a change made
+        # while we render means the entry we store is already stale.  They're
+        # stored by key because the caches for some pages are nested.
+        if not hasattr(request, '_cache_stamps'):
+            request._cache_stamps = {}
+        request._cache_stamps[key] = utils.get_stamps(
+            self.get_cache_tags(request))
+        return None
+
+    def get_stamps_for_response(self, request, key):
+        stamps = getattr(request, '_cache_stamps', {}).get(key)
+        if stamps is None:
+            stamps = utils.get_stamps(self.get_cache_tags(request))
+        new_tags = [tag for tag in getattr(request, 'cache_tags', ())
+                    if tag not in stamps]
+        stamps.update(utils.get_stamps(new_tags))
+        return stamps
 
     def process_response(self, request, response):
+        entry = None
         if (request.method == 'GET' and response.status_code == 200 and
                 not hasattr(request, '_cache_hit')):
             key = self.get_cache_key(request)
-            cache.cache.set(key,
-                    self.response_to_cache_object(request, response),
-                    self.cache_time)
-        return response
+            stamps = self.get_stamps_for_response(request, key)
+            entry = self.make_entry(request, response, stamps)
+            content = entry.cached_object.content
+            if entry.gzipped_content is not None and not self.store_identity:
+                entry.cached_object.content = ''
+            cache.cache.set(key, entry, self.cache_time + self.stale_time)
+            self.release_regenerate_lock(request, key)
+            response = self.response_from_entry(request, entry, content)
+        elif hasattr(request, '_cache_locks'):
+            self.release_regenerate_lock(request, self.get_cache_key(request))
+        return self.add_validators(request,
+                                   self.fill_fragments(request, response),
+                                   entry)
+
+    def process_exception(self, request, exception):
+        if hasattr(request, '_cache_locks'):
+            self.release_regenerate_lock(request, self.get_cache_key(request))
+        return None
 
 class UserCacheMiddleware(CacheMiddlewareBase):
     """
@@ -87,19 +406,9 @@ class UserCacheMiddleware(CacheMiddlewareBase):
     that have ratings.
     """
     def get_cache_key_tuple(self, request):
-        filter_languages = ''
-        if request.user.is_authenticated():
-            user = request.user.username
-            profile = request.user.get_profile()
-            if profile.filter_languages:
-                filter_languages = ''.join(
-                    [lang.name for lang in profile.shown_languages.all()])
-        else:
-            user = None
-            if request.session.get('filter_languages'):
-                filter_languages = request.LANGUAGE_CODE
         return CacheMiddlewareBase.get_cache_key_tuple(self, request) + (
-            request.path, request.META['QUERY_STRING'], user, filter_languages)
+            request.path, self.get_query_key(request)) + \
+            self.get_user_key(request)
 
 class SiteHidingCacheMiddleware(UserCacheMiddleware):
     """
@@ -130,37 +439,42 @@ class SiteHidingCacheMiddleware(UserCacheMiddleware):
 
 class APICacheMiddleware(CacheMiddlewareBase):
 
+    # the JSONP callback is stripped from the cached response
+    ignored_query_params = ('_', 'jsoncallback')
+
     def get_cache_key_tuple(self, request):
-        if request.user.is_authenticated():
-            user = request.user.id
-        else:
-            user = None
         # since we're not doing any translating in the API, we can ignore the
         # LANGUAGE_CODE
-        GET_args = dict(request.GET)
-        if 'jsoncallback' in GET_args:
-            del GET_args['jsoncallback']
-        if '_' in GET_args:
-            del GET_args['_']
         return CacheMiddlewareBase.get_cache_key_tuple(self, request)[:-1] + \
-            (request.path, str(GET_args), user)
+            (request.path, self.get_query_key(request)) + \
+            self.get_user_key(request)
+
+    def is_jsonp(self, request):
+        return request.GET.get('datatype') == 'json' and \
+            'jsoncallback' in request.GET
 
     def response_to_cache_object(self, request, response):
-        if request.GET.get('datatype') == 'json' and \
-                'jsoncallback' in request.GET:
+        if self.is_jsonp(request):
             response.content = response.content[
                 len(request.GET['jsoncallback'])+1:-2]
         return response
 
     def response_from_cache_object(self, request, response):
-        if request.GET.get('datatype') == 'json' and \
-                'jsoncallback' in request.GET:
+        if self.is_jsonp(request):
             response.content = '%s(%s);' % (
                 request.GET['jsoncallback'],
                 response.content)
         return response
 
-    def process_response(self, request, response):
-        response = CacheMiddlewareBase.process_response(self, request,
-                                                        response)
-        return self.response_from_cache_object(request, response)
+    def can_serve_gzipped(self, request):
+        # JSONP responses have the callback added
+        return (not self.is_jsonp(request) and
+                CacheMiddlewareBase.can_serve_gzipped(self, request))
+
+    def get_etag(self, request, entry):
+        # the entry is shared by every callback, but the responses aren't
+        etag = CacheMiddlewareBase.get_etag(self, request, entry)
+        if self.is_jsonp(request):
+            etag = make_etag('%s:%s' % (
+                    etag, request.GET['jsoncallback'].encode('utf8')))
+        return etag
@@ -1,28 +1,129 @@
 # No actual models; this just replaces the cache-resetting functionality of
-# thet old dbwatcher module
-
-import time
-
-from django.db.models.signals import post_save
-from django.core import cache
-
-def handle_save(sender=None, instance=None, **kwargs):
-    # reset the table key, so cached pages will not find the old caches
-    now = time.time()
-    if sender.__name__ not in (
-        'User',
-        'Permission',
-        'Group',
-        'ContentType',
-        'Session',
-        'Site',
-        'Subscription',
-        'UserProfile',
-        ):
-        cache.cache.set('namespace', now)
-    if sender.__name__ == 'Channel':
-        cache.cache.set('Channel:%i' % instance.pk, now)
-    elif sender.__name__ == 'Item':
-        cache.cache.set('Channel:%i' % instance.pk, now)
+# thet old dbwatcher module.  Saves bump the tags for the object which was
+# saved (see channelguide.cache.utils), so that only the cached pages which
+# depend on it are regenerated.
 
+from django.db.models.signals import post_init, post_save, post_delete
+from django.db.models.signals import m2m_changed
+
+from channelguide.cache import utils
+from channelguide.channels.models import Channel, items_changed
+from channelguide.labels.models import Category
+
+IGNORED_MODELS = (
+    'User',
+    'Permission',
+    'Group',
+    'ContentType',
+    'Session',
+    'Site',
+    'Subscription',
+    'SubscriptionDay',
+    'SubscriptionHour',
+    'UserProfile',
+    'Similarity',
+    'SimilarityStatistics',
+    'SearchChange',
+    'WatchedVideos',
+    'FeedSchedule',
+    )
+
+# Channel fields which change what shows up in listings (or the order it shows
+# up in).  Saving a channel without changing them only bumps its own tag.
+LISTING_FIELDS = (
+    'name', 'state', 'archived', 'featured', 'hi_def', 'language_id',
+    'owner_id', 'url', 'approved_at', 'geoip', 'adult')
+
+def listing_values(instance):
+    return tuple([getattr(instance, name, None) for name in LISTING_FIELDS])
+
+def handle_channel_init(sender=None, instance=None, **kwargs):
+    # remember what the channel looked like when it was loaded, so that a
+    # save can tell whether the listings need to change
+    instance._cache_listing_values = listing_values(instance)
+
+def tags_for_channel(instance, created_or_deleted):
+    tags = ['Channel:%i' % instance.pk]
+    old = getattr(instance, '_cache_listing_values', None)
+    new = listing_values(instance)
+    if created_or_deleted or old != new:
+        tags.append('State:%s' % instance.state)
+        if old is not None:
+            tags.append('State:%s' % old[LISTING_FIELDS.index('state')])
+    instance._cache_listing_values = new
+    return tags
+
+def tags_for_instance(sender, instance, created_or_deleted=False):
+    name = sender.__name__
+    if name in IGNORED_MODELS:
+        return ()
+    if name == 'Channel':
+        return tags_for_channel(instance, created_or_deleted)
+    tags = []
+    channel_id = getattr(instance, 'channel_id', None)
+    if channel_id is not None:
+        tags.append('Channel:%i' % channel_id)
+    if name == 'Item':
+        tags.append('Item:%i' % instance.pk)
+    elif name in ('Rating', 'GeneratedRatings'):
+        tags.append('Rating')
+    elif name == 'GeneratedStats':
+        tags.append('Stats')
+    elif name == 'FeaturedQueue':
+        tags.append('Featured')
+    elif name == 'TagMap':
+        tags.append(u'Tag:%s' % instance.tag.name)
+    elif name == 'Tag':
+        tags.append(u'Tag:%s' % instance.name)
+    elif name in ('Category', 'Language'):
+        tags.extend([name, u'%s:%s' % (name, instance.name)])
+    elif name in ('ChannelSearchData', 'ItemSearchData'):
+        tags.append('search')
+    elif not tags:
+        # we don't know what this affects, so reset everything
+        tags.append(utils.GLOBAL_TAG)
+    return tags
+
+def handle_save(sender=None, instance=None, created=False, **kwargs):
+    # reset the tags for the instance, so cached pages which depend on it
+    # will not use their old caches
+    utils.bump(*tags_for_instance(sender, instance, created))
+
+def handle_delete(sender=None, instance=None, **kwargs):
+    utils.bump(*tags_for_instance(sender, instance, True))
+
+def handle_items_changed(sender=None, instance=None, updated=(), deleted=(),
+                         search_changed=False, **kwargs):
+    tags = ['Channel:%i' % instance.pk]
+    tags.extend(['Item:%i' % pk for pk in updated])
+    tags.extend(['Item:%i' % pk for pk in deleted])
+    if search_changed:
+        tags.append('search')
+    utils.bump(*tags)
+
+def handle_categories_changed(sender=None, instance=None, action=None,
+                              reverse=False, pk_set=None, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse: # category.channels changed
+        tags = [u'Category:%s' % instance.name]
+        if pk_set:
+            tags.extend('Channel:%i' % pk for pk in pk_set)
+        else:
+            tags.append(utils.GLOBAL_TAG)
+    else:
+        tags = ['Channel:%i' % instance.pk]
+        if pk_set:
+            categories = Category.objects.filter(pk__in=pk_set)
+        else: # cleared
+            categories = Category.objects.all()
+        tags.extend(u'Category:%s' % category.name
+                    for category in categories)
+    utils.bump(*tags)
+
+post_init.connect(handle_channel_init, sender=Channel)
 post_save.connect(handle_save)
+post_delete.connect(handle_delete)
+items_changed.connect(handle_items_changed)
+m2m_changed.connect(handle_categories_changed,
+                    sender=Channel.categories.through)
@@ -0,0 +1,34 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+from django import template
+
+from channelguide.cache import fragments
+
+register = template.Library()
+
+@register.tag('fragment')
+def do_fragment(parser, token):
+    tokens = token.split_contents()
+    if len(tokens) < 2:
+        raise template.TemplateSyntaxError(
+            'syntax is {% fragment "<name>" [arg ...] %}')
+    return FragmentNode(parser.compile_filter(tokens[1]),
+                        [parser.compile_filter(arg) for arg in tokens[2:]])
+
+class FragmentNode(template.Node):
+    """
+    Renders a per-user fragment of the page, or a placeholder for it if the
+    page is being cached in fragment mode.
+    """
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def render(self, context):
+        name = self.name.resolve(context)
+        args = [arg.resolve(context) for arg in self.args]
+        request = context['request']
+        if fragments.is_deferred(request):
+            return fragments.placeholder(name, *args)
+        return fragments.render(request, context, name, *args)
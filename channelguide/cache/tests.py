@@ -1,17 +1,21 @@
 from channelguide.testframework import TestCase, clear_cache
 from datetime import datetime
+import time
 
 from django.conf import settings
-from django.http import HttpRequest, HttpResponse
+from django.core import cache
+from django.http import HttpRequest, HttpResponse, HttpResponseRedirect
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.sessions.models import Session
 
 from channelguide import util
-from channelguide.cache import middleware
+from channelguide.cache import fragments, middleware, utils
+from channelguide.notifications.middleware import NotificationMiddleware
+from channelguide.ratings.models import Rating
 
 class CacheTestBase(TestCase):
 
-    def make_request(self, path, query=None):
+    def make_request(self, path, query=None, tags=()):
         request = HttpRequest()
         request.method = "GET"
         request.path = path
@@ -19,6 +23,8 @@ class CacheTestBase(TestCase):
         request.session = {}
         request.LANGUAGE_CODE = settings.LANGUAGE_CODE
         request.META['QUERY_STRING'] = query
+        if tags:
+            utils.add_request_tags(request, *tags)
         return request
 
     def make_response(self):
@@ -29,16 +35,16 @@ class CacheTestBase(TestCase):
     def rand_path(self):
         return '/' + util.random_string(20)
 
-    def is_request_cached(self, path, query=None):
-        request = self.make_request(path, query)
+    def is_request_cached(self, path, query=None, tags=()):
+        request = self.make_request(path, query, tags)
         if self.middleware.process_request(request) is None:
             self.middleware.process_response(request, self.make_response())
             return False
         else:
             return True
 
-    def make_request_cached(self, path, query=None):
-        request = self.make_request(path, query)
+    def make_request_cached(self, path, query=None, tags=()):
+        request = self.make_request(path, query, tags)
         request.LANGUAGE_CODE = settings.LANGUAGE_CODE
         if self.middleware.process_request(request) is None:
             self.middleware.process_response(request, self.make_response())
@@ -67,11 +73,90 @@ class UserCacheMiddlewareTest(CacheTestBase):
         channel = self.make_channel(user)
         path = '/channels/popular'
         channel.save()
-        self.make_request_cached(path)
+        self.make_request_cached(path, tags=['Channel:%i' % channel.pk])
         channel.name = "NEW ONE"
         channel.save()
         self.assert_(not self.is_request_cached(path))
 
+    def test_unrelated_change_doesnt_expire_cache(self):
+        user = self.make_user("kelly")
+        channel = self.make_channel(user)
+        channel2 = self.make_channel(user)
+        path = self.rand_path()
+        self.make_request_cached(path, tags=['Channel:%i' % channel.pk])
+        channel2.name = "NEW ONE"
+        channel2.save()
+        self.assert_(self.is_request_cached(path))
+        Rating.objects.create(user=user, channel=channel2, rating=5)
+        self.assert_(self.is_request_cached(path))
+
+    def test_listing_change_expires_state_tag(self):
+        """
+        Changing a channel in a way that changes the listings should expire
+        pages which depend on its state.  Other changes should not.
+        """
+        user = self.make_user("kelly")
+        channel = self.make_channel(user, state='A')
+        path = self.rand_path()
+        self.make_request_cached(path, tags=['State:A'])
+        channel.description = 'Hello World!'
+        channel.save()
+        self.assert_(self.is_request_cached(path))
+        channel.state = 'R'
+        channel.save()
+        self.assert_(not self.is_request_cached(path))
+
+    def test_global_tag_expires_everything(self):
+        path = self.rand_path()
+        self.make_request_cached(path, tags=['Channel:1234'])
+        utils.bump(utils.GLOBAL_TAG)
+        self.assert_(not self.is_request_cached(path))
+
+    def test_query_normalized(self):
+        path = self.rand_path()
+        self.make_request_cached(path, 'page=2&sort=name')
+        self.assert_(self.is_request_cached(path, 'sort=name&page=2'))
+        self.assert_(self.is_request_cached(path,
+                                            'sort=name&page=2&_=1234'))
+        self.assert_(self.is_request_cached(path,
+                                            'utm_source=x&sort=name&page=2'))
+        self.assert_(not self.is_request_cached(path, 'sort=-name&page=2'))
+
+    def test_unused_query_params_ignored(self):
+        self.middleware = middleware.UserCacheMiddleware(
+            query_params=('page',))
+        path = self.rand_path()
+        self.make_request_cached(path, 'page=2')
+        self.assert_(self.is_request_cached(path, 'page=2&foo=bar'))
+        self.assert_(not self.is_request_cached(path, 'page=3'))
+
+    def test_shared_variants(self):
+        """
+        If the middleware isn't caching per-user, users with the same
+        permissions and language filter share a cache entry.
+        """
+        self.middleware = middleware.UserCacheMiddleware(per_user=False)
+        path = self.rand_path()
+        kelly = self.make_user('kelly')
+        bobby = self.make_user('bobby')
+        mod = self.make_user('mod', group='cg_moderator')
+        request = self.make_request(path)
+        request.user = kelly
+        self.assertEquals(self.middleware.process_request(request), None)
+        self.middleware.process_response(request, self.make_response())
+        request = self.make_request(path)
+        request.user = bobby
+        self.assertNotEquals(self.middleware.process_request(request), None)
+        request = self.make_request(path)
+        request.user = mod
+        self.assertEquals(self.middleware.process_request(request), None)
+        profile = bobby.get_profile()
+        profile.filter_languages = True
+        profile.save()
+        request = self.make_request(path)
+        request.user = bobby
+        self.assertEquals(self.middleware.process_request(request), None)
+
     def test_session_change_doesnt_expire_cache(self):
         path = self.rand_path()
         self.make_request_cached(path)
@@ -101,6 +186,392 @@ class UserCacheMiddlewareTest(CacheTestBase):
         self.assert_('userkelly' not in anon_page.content)
 
 
+class CacheCountersTest(CacheTestBase):
+    def setUp(self):
+        CacheTestBase.setUp(self)
+        self.middleware = middleware.UserCacheMiddleware()
+        utils.counters.flush()
+        self.initial = utils.counters.get_totals()
+
+    def get_count(self, event, kind):
+        utils.counters.flush()
+        return (utils.counters.get_totals().get((event, kind), 0) -
+                self.initial.get((event, kind), 0))
+
+    def test_counts(self):
+        path = self.rand_path()
+        self.make_request_cached(path, tags=['Channel:1234'])
+        self.assertEquals(self.get_count('miss', 'namespace'), 1)
+        self.assertEquals(self.get_count('hit', 'Channel'), 1)
+        self.assertEquals(self.get_count('hit', 'namespace'), 1)
+        utils.bump('Channel:1234')
+        self.assertEquals(self.get_count('bump', 'Channel'), 1)
+        self.assert_(not self.is_request_cached(path))
+        self.assertEquals(self.get_count('invalidated', 'Channel'), 1)
+        self.assertEquals(self.get_count('invalidated', 'namespace'), 0)
+
+class CacheKeyTest(CacheTestBase):
+    def test_digest_key(self):
+        key = utils.digest_key('Prefix', ('namespace', u'/path', None, 1))
+        self.assertEquals(key,
+                          utils.digest_key('Prefix',
+                                           ('namespace', '/path', None, 1)))
+        self.assertNotEquals(key,
+                             utils.digest_key('Prefix',
+                                              ('namespace', '/path', 'None',
+                                               1)))
+        self.assert_(key.startswith('Prefix:'))
+
+    def test_stamps_cached_in_process(self):
+        """
+        Stamps are read from the shared cache once per STAMP_CACHE_SECONDS;
+        bumps from other processes are seen once that's passed.
+        """
+        stamp = utils.get_stamps(['Channel:1234'])['Channel:1234']
+        # another process bumps the tag
+        cache.cache.set(utils.stamp_key('Channel:1234'), stamp + 1)
+        self.assertEquals(utils.get_stamps(['Channel:1234']),
+                          {'Channel:1234': stamp})
+        utils.local_stamps.clear()
+        self.assertEquals(utils.get_stamps(['Channel:1234']),
+                          {'Channel:1234': stamp + 1})
+
+    def test_stamp_cache_pruned(self):
+        """
+        The process's stamps should drop the expired ones, instead of
+        keeping every tag it has ever seen.
+        """
+        stamps = utils.StampCache(5)
+        for i in range(100):
+            stamps.set('Channel:%i' % i, 1, 100)
+        stamps.set('Channel:100', 1, 103)
+        self.assertEquals(len(stamps.stamps), 101)
+        stamps.set('Channel:101', 1, 106)
+        self.assertEquals(sorted(stamps.stamps),
+                          ['Channel:100', 'Channel:101'])
+        self.assertEquals(stamps.get('Channel:100', 106), 1)
+
+class StaleWhileRevalidateTest(CacheTestBase):
+    def setUp(self):
+        CacheTestBase.setUp(self)
+        self.middleware = middleware.UserCacheMiddleware(view_name='test')
+        self.path = self.rand_path()
+        self.make_request_cached(self.path, tags=['Channel:1234'])
+
+    def expire_entry(self, seconds_ago=1):
+        key = self.middleware.get_cache_key(self.make_request(self.path))
+        entry = cache.cache.get(key)
+        entry.expires = time.time() - seconds_ago
+        cache.cache.set(key, entry)
+
+    def get_count(self, event):
+        utils.view_counters.flush()
+        return utils.view_counters.get_totals().get((event, 'test'), 0)
+
+    def test_single_regeneration(self):
+        """
+        Once a page expires, one request regenerates it and the others are
+        served the stale copy until it's done.
+        """
+        stale = self.get_count('stale')
+        regenerated = self.get_count('regenerate')
+        self.expire_entry()
+        regenerating = self.make_request(self.path)
+        self.assertEquals(self.middleware.process_request(regenerating),
+                          None)
+        for i in range(3):
+            response = self.middleware.process_request(
+                self.make_request(self.path))
+            self.assertNotEquals(response, None)
+        self.middleware.process_response(regenerating, self.make_response())
+        self.assert_(self.is_request_cached(self.path))
+        self.assertEquals(self.get_count('stale') - stale, 3)
+        self.assertEquals(self.get_count('regenerate') - regenerated, 1)
+
+    def test_bumped_tags_serve_stale(self):
+        utils.bump('Channel:1234')
+        regenerating = self.make_request(self.path)
+        self.assertEquals(self.middleware.process_request(regenerating),
+                          None)
+        self.assert_(self.is_request_cached(self.path))
+        self.middleware.process_response(regenerating, self.make_response())
+        self.assert_(self.is_request_cached(self.path))
+
+    def test_too_stale(self):
+        """
+        Pages which expired longer than stale_time ago are not served, even
+        if another request is regenerating them.
+        """
+        self.expire_entry(self.middleware.stale_time + 1)
+        regenerating = self.make_request(self.path)
+        self.assertEquals(self.middleware.process_request(regenerating),
+                          None)
+        self.assert_(not self.is_request_cached(self.path))
+
+    def test_exception_releases_lock(self):
+        self.expire_entry()
+        regenerating = self.make_request(self.path)
+        self.assertEquals(self.middleware.process_request(regenerating),
+                          None)
+        self.middleware.process_exception(regenerating, ValueError())
+        self.assertEquals(self.middleware.process_request(
+                self.make_request(self.path)), None)
+
+class FragmentCacheTest(CacheTestBase):
+    def setUp(self):
+        CacheTestBase.setUp(self)
+        self.middleware = middleware.UserCacheMiddleware(fragment_mode=True)
+
+    def test_placeholders_filled(self):
+        """
+        The cached page keeps the placeholders; each response gets them
+        filled in.
+        """
+        path = self.rand_path()
+        request = self.make_request(path)
+        self.assertEquals(self.middleware.process_request(request), None)
+        self.assert_(fragments.is_deferred(request))
+        response = HttpResponse('<p>%s</p>' %
+                                fragments.placeholder('account-link'))
+        response = self.middleware.process_response(request, response)
+        self.assert_('FRAGMENT' not in response.content)
+        self.assert_('Account' in response.content)
+        key = self.middleware.get_cache_key(self.make_request(path))
+        entry = cache.cache.get(key)
+        self.assert_('FRAGMENT' in entry.cached_object.content)
+        response = self.middleware.process_request(self.make_request(path))
+        self.assert_('FRAGMENT' not in response.content)
+        self.assert_('Account' in response.content)
+
+    def test_page_shared_between_users(self):
+        kelly = self.make_user('userkelly')
+        bobby = self.make_user('userbobby')
+        self.get_page('/') # sets up LastApproved, which resets the cache
+        kelly_page = self.get_page('/', login_as=kelly)
+        self.assertFalse(hasattr(kelly_page, '_cache_hit'))
+        bobby_page = self.get_page('/', login_as=bobby)
+        self.assertTrue(getattr(bobby_page, '_cache_hit', False))
+        self.assert_('userkelly' in kelly_page.content)
+        self.assert_('userbobby' in bobby_page.content)
+        self.assert_('userkelly' not in bobby_page.content)
+
+class ConditionalGetTest(CacheTestBase):
+    def setUp(self):
+        CacheTestBase.setUp(self)
+        self.middleware = middleware.UserCacheMiddleware()
+        self.path = self.rand_path()
+
+    def get_response(self, path=None, content='Hello World', **headers):
+        request = self.make_request(path or self.path)
+        request.META.update(headers)
+        response = self.middleware.process_request(request)
+        if response is None:
+            response = self.middleware.process_response(
+                request, HttpResponse(content))
+        return response
+
+    def test_validators(self):
+        response = self.get_response()
+        self.assertEquals(response.status_code, 200)
+        self.assert_(response.has_header('ETag'))
+        self.assert_(response.has_header('Last-Modified'))
+        cached = self.get_response()
+        self.assert_(cached._cache_hit)
+        self.assertEquals(cached['ETag'], response['ETag'])
+        self.assertEquals(cached['Last-Modified'], response['Last-Modified'])
+
+    def test_if_none_match(self):
+        etag = self.get_response()['ETag']
+        response = self.get_response(HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response.content, '')
+        self.assertEquals(response['ETag'], etag)
+        response = self.get_response(HTTP_IF_NONE_MATCH='"other"')
+        self.assertEquals(response.status_code, 200)
+
+    def test_if_modified_since(self):
+        last_modified = self.get_response()['Last-Modified']
+        response = self.get_response(HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEquals(response.status_code, 304)
+        response = self.get_response(
+            HTTP_IF_MODIFIED_SINCE='Sat, 01 Jan 2000 00:00:00 GMT')
+        self.assertEquals(response.status_code, 200)
+
+    def test_regenerated_page_unchanged(self):
+        """
+        If a page is regenerated but comes out the same, clients which have
+        it still get a 304.
+        """
+        etag = self.get_response()['ETag']
+        utils.bump(utils.GLOBAL_TAG)
+        response = self.get_response(HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+        utils.bump(utils.GLOBAL_TAG)
+        response = self.get_response(content='Goodbye',
+                                     HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response['ETag'], etag)
+
+    def test_fragments(self):
+        """
+        Pages with fragments get an ETag for the filled-in page, and no
+        Last-Modified time.
+        """
+        self.middleware = middleware.UserCacheMiddleware(fragment_mode=True)
+        content = '<p>%s</p>' % fragments.placeholder('account-link')
+        response = self.get_response(content=content)
+        self.assertEquals(response['ETag'],
+                          '"%s"' % middleware.make_etag(response.content))
+        self.assert_(not response.has_header('Last-Modified'))
+        response = self.get_response(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(response.status_code, 304)
+
+    def test_jsonp(self):
+        """
+        JSONP responses get a different ETag for each callback, though
+        they share a cache entry.
+        """
+        self.middleware = middleware.APICacheMiddleware()
+        def get_response(callback, **headers):
+            request = self.make_request(self.path,
+                                        'datatype=json&jsoncallback=' +
+                                        callback)
+            request.GET = {'datatype': 'json', 'jsoncallback': callback}
+            request.META.update(headers)
+            response = self.middleware.process_request(request)
+            if response is None:
+                response = self.middleware.process_response(
+                    request, HttpResponse('%s({});' % callback))
+            return response
+        first = get_response('first')
+        self.assertEquals(first.content, 'first({});')
+        second = get_response('second')
+        self.assert_(second._cache_hit)
+        self.assertEquals(second.content, 'second({});')
+        self.assertNotEquals(first['ETag'], second['ETag'])
+        response = get_response('second', HTTP_IF_NONE_MATCH=second['ETag'])
+        self.assertEquals(response.status_code, 304)
+        response = get_response('first', HTTP_IF_NONE_MATCH=second['ETag'])
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.content, 'first({});')
+
+class GzipCacheTest(CacheTestBase):
+    content = '<p>Hello World</p>' * 100
+
+    def setUp(self):
+        CacheTestBase.setUp(self)
+        self.middleware = middleware.UserCacheMiddleware()
+        self.path = self.rand_path()
+
+    def get_response(self, content=None, query=None, **headers):
+        request = self.make_request(self.path, query)
+        request.META.update(headers)
+        response = self.middleware.process_request(request)
+        if response is None:
+            response = self.middleware.process_response(
+                request, HttpResponse(content or self.content))
+        return response
+
+    def get_entry(self):
+        return cache.cache.get(self.middleware.get_cache_key(
+                self.make_request(self.path)))
+
+    def test_stored_gzipped(self):
+        self.get_response()
+        entry = self.get_entry()
+        self.assertEquals(entry.cached_object.content, '')
+        self.assertEquals(utils.decompress_string(entry.gzipped_content),
+                          self.content)
+
+    def test_small_pages_not_gzipped(self):
+        self.get_response('Hello World')
+        entry = self.get_entry()
+        self.assertEquals(entry.gzipped_content, None)
+        self.assertEquals(entry.cached_object.content, 'Hello World')
+
+    def test_served_gzipped(self):
+        for i in range(2): # the miss, then the hit
+            response = self.get_response(HTTP_ACCEPT_ENCODING='gzip, deflate')
+            self.assertEquals(response['Content-Encoding'], 'gzip')
+            self.assertEquals(response['Content-Length'],
+                              str(len(response.content)))
+            self.assert_('Accept-Encoding' in response['Vary'])
+            self.assertEquals(utils.decompress_string(response.content),
+                              self.content)
+        self.assert_(response._cache_hit)
+        gzip_etag = response['ETag']
+        response = self.get_response()
+        self.assert_(response._cache_hit)
+        self.assertEquals(response.content, self.content)
+        self.assert_(not response.has_header('Content-Encoding'))
+        self.assert_('Accept-Encoding' in response['Vary'])
+        self.assertNotEquals(response['ETag'], gzip_etag)
+        response = self.get_response(HTTP_ACCEPT_ENCODING='gzip',
+                                     HTTP_IF_NONE_MATCH=gzip_etag)
+        self.assertEquals(response.status_code, 304)
+
+    def test_store_identity(self):
+        self.middleware.store_identity = True
+        self.get_response()
+        entry = self.get_entry()
+        self.assertEquals(entry.cached_object.content, self.content)
+        self.assertNotEquals(entry.gzipped_content, None)
+        self.assertEquals(self.get_response().content, self.content)
+
+    def test_notifications_filled_in(self):
+        """
+        A cached page isn't sent gzipped while there are notifications to
+        show, so that NotificationMiddleware can fill in the bar.
+        """
+        content = '<!-- NOTIFICATION BAR -->' + self.content
+        self.get_response(content)
+        notifications = NotificationMiddleware()
+        # the request that added the notification redirected, so it's kept
+        # in the session for the next page
+        session = {}
+        request = self.make_request('/flag')
+        request.session = session
+        notifications.process_request(request)
+        request.add_notification('Thanks!', 'Your flag has been recorded.')
+        notifications.process_response(request, HttpResponseRedirect('/'))
+        def get_response():
+            request = self.make_request(self.path)
+            request.session = session
+            request.META['HTTP_ACCEPT_ENCODING'] = 'gzip'
+            notifications.process_request(request)
+            response = self.middleware.process_request(request)
+            self.assert_(response._cache_hit)
+            return notifications.process_response(request, response)
+        response = get_response()
+        self.assert_(not response.has_header('Content-Encoding'))
+        self.assert_('Your flag has been recorded.' in response.content)
+        self.assert_(response.content.endswith(self.content))
+        response = get_response()
+        self.assertEquals(response['Content-Encoding'], 'gzip')
+        self.assert_('Your flag has been recorded.' not in
+                     utils.decompress_string(response.content))
+
+    def test_jsonp_not_served_gzipped(self):
+        self.middleware = middleware.APICacheMiddleware()
+        def get_response(callback):
+            request = self.make_request(self.path,
+                                        'datatype=json&jsoncallback=' +
+                                        callback)
+            request.GET = {'datatype': 'json', 'jsoncallback': callback}
+            request.META['HTTP_ACCEPT_ENCODING'] = 'gzip'
+            response = self.middleware.process_request(request)
+            if response is None:
+                response = self.middleware.process_response(
+                    request, HttpResponse('%s(%s);' % (callback,
+                                                       self.content)))
+            return response
+        for callback in ('first', 'second'):
+            response = get_response(callback)
+            self.assert_(not response.has_header('Content-Encoding'))
+            self.assertEquals(response.content,
+                              '%s(%s);' % (callback, self.content))
+        self.assert_(response._cache_hit)
+
 class SiteHidingCacheMiddlewareTest(CacheTestBase):
     def setUp(self):
         CacheTestBase.setUp(self)
@@ -0,0 +1,224 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+"""Tag-based cache invalidation.
+
+Cached pages record the tags they depend on ('Channel:12', 'State:A',
+'Category:Comedy', ...) along with the stamp each tag had when the page was
+rendered.  Saving a model bumps the stamps of the tags it affects (see
+channelguide.cache.models), so only the pages which depend on that object
+have to be regenerated.  The 'namespace' tag is still bumped for models which
+don't have more specific tags, and every page cached by the middleware
+depends on it by default.
+"""
+
+import gzip
+import md5
+import threading
+import time
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.core import cache
+
+GLOBAL_TAG = 'namespace'
+
+# how many seconds a process trusts the stamps it has read before checking
+# the shared cache again.  Bumps made by this process are seen immediately,
+# bumps made by other processes within this many seconds.
+STAMP_CACHE_SECONDS = getattr(settings, 'CACHE_STAMP_SECONDS', 5)
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    elif isinstance(value, (tuple, list)):
+        return tuple([_encode(part) for part in value])
+    return value
+
+def digest_key(prefix, parts):
+    """Return a cache key for the given tuple which is the same in every
+    process on every host (unlike hash(), which can also collide).
+    """
+    return '%s:%s' % (prefix, md5.new(repr(_encode(parts))).hexdigest())
+
+def decompress_string(s):
+    """The reverse of django.utils.text.compress_string()."""
+    return gzip.GzipFile(fileobj=StringIO(s)).read()
+
+def stamp_key(tag):
+    """Return the cache key which holds the stamp for the given tag."""
+    return 'tag:%s' % md5.new(_encode(tag)).hexdigest()
+
+def tag_kind(tag):
+    """Return the kind of a tag: 'Channel:12' -> 'Channel'."""
+    return tag.split(':', 1)[0]
+
+class StampCache(object):
+    """
+    Per-process copy of the tag stamps, so that checking whether a cached
+    page is still valid doesn't need another round trip to the cache.
+    Expired stamps are dropped once every timeout seconds, so it only holds
+    the tags used recently.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.stamps = {} # tag -> (stamp, time read)
+        self.pruned = 0
+
+    def get(self, tag, now):
+        value = self.stamps.get(tag)
+        if value is not None and now - value[1] < self.timeout:
+            return value[0]
+
+    def set(self, tag, stamp, now):
+        if now - self.pruned >= self.timeout:
+            self.pruned = now
+            # a new dictionary, so other threads never see it half-pruned
+            self.stamps = dict((key, value)
+                               for key, value in self.stamps.items()
+                               if now - value[1] < self.timeout)
+        self.stamps[tag] = (stamp, now)
+
+    def clear(self):
+        self.stamps = {}
+        self.pruned = 0
+
+local_stamps = StampCache(STAMP_CACHE_SECONDS)
+
+def get_stamps(tags):
+    """Return a dictionary mapping each of the given tags to its current
+    stamp.  Tags which don't have a stamp yet get one.
+    """
+    now = time.time()
+    stamps = {}
+    keys = {}
+    for tag in tags:
+        stamp = local_stamps.get(tag, now)
+        if stamp is None:
+            keys[stamp_key(tag)] = tag
+        else:
+            stamps[tag] = stamp
+    if not keys:
+        return stamps
+    values = cache.cache.get_many(keys.keys())
+    missing = [key for key in keys if type(values.get(key)) is not float]
+    if missing:
+        # add() so that processes racing to create a stamp agree on it
+        for key in missing:
+            cache.cache.add(key, now)
+        values.update(cache.cache.get_many(missing))
+    for key, tag in keys.items():
+        value = values.get(key)
+        if type(value) is not float: # the cache isn't storing anything
+            value = now
+        stamps[tag] = value
+        local_stamps.set(tag, value, now)
+    return stamps
+
+def bump(*tags):
+    """Invalidate every cached page which depends on one of the given
+    tags.
+    """
+    if not tags:
+        return
+    now = time.time()
+    cache.cache.set_many(dict((stamp_key(tag), now) for tag in tags))
+    for tag in tags:
+        local_stamps.set(tag, now, now)
+    counters.incr('bump', tags)
+
+def add_request_tags(request, *tags):
+    """Record that the page being rendered for this request depends on the
+    given tags.  The cache middleware stores them with the response.
+    """
+    if not hasattr(request, 'cache_tags'):
+        request.cache_tags = set()
+    request.cache_tags.update(tags)
+
+def add_channel_tags(request, channels):
+    add_request_tags(request, *['Channel:%i' % channel.pk
+                                for channel in channels])
+
+class CacheCounters(object):
+    """
+    Counts cache events ('hit', 'miss', 'stale', ...) per name.  Counts are
+    kept in-process and added to the shared cache every flush_every events so
+    that the numbers from every process end up in one place; get_totals()
+    reads them back.
+    """
+    flush_every = 100
+    timeout = 3600 * 24 * 30 # memcached has a 30 day limit
+
+    def __init__(self, key_prefix):
+        self.key_prefix = key_prefix
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.pending_events = 0
+
+    def incr(self, event, names):
+        self.lock.acquire()
+        try:
+            for name in set(names):
+                counter = '%s:%s' % (event, name)
+                self.pending[counter] = self.pending.get(counter, 0) + 1
+            self.pending_events += 1
+            if self.pending_events < self.flush_every:
+                return
+            pending = self._take_pending()
+        finally:
+            self.lock.release()
+        self._flush(pending)
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            pending = self._take_pending()
+        finally:
+            self.lock.release()
+        self._flush(pending)
+
+    def _take_pending(self):
+        pending = self.pending
+        self.pending = {}
+        self.pending_events = 0
+        return pending
+
+    def _key(self, name):
+        return '%s:%s' % (self.key_prefix, name)
+
+    def _flush(self, pending):
+        if not pending:
+            return
+        names = cache.cache.get(self.key_prefix) or set()
+        if not names.issuperset(pending):
+            cache.cache.set(self.key_prefix, names | set(pending),
+                            self.timeout)
+        for name, count in pending.items():
+            key = self._key(name)
+            cache.cache.add(key, 0, self.timeout)
+            try:
+                cache.cache.incr(key, count)
+            except ValueError: # evicted between the add and the incr
+                cache.cache.set(key, count, self.timeout)
+
+    def get_totals(self):
+        """Return a dictionary mapping (event, name) to the total count."""
+        names = cache.cache.get(self.key_prefix) or set()
+        values = cache.cache.get_many([self._key(name) for name in names])
+        totals = {}
+        for name in names:
+            event, counted = name.split(':', 1)
+            totals[event, counted] = values.get(self._key(name), 0)
+        return totals
+
+class TagCounters(CacheCounters):
+    """
+    Counts cache events per kind of tag; 'Channel:12' and 'Channel:13' are
+    both counted as 'Channel'.
+    """
+    def incr(self, event, tags):
+        CacheCounters.incr(self, event, [tag_kind(tag) for tag in tags])
+
+counters = TagCounters('cache-counters')
+# hits, stale serves and regenerations for each cached view
+view_counters = CacheCounters('cache-view-counters')
@@ -0,0 +1,394 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+"""Concurrent feed crawler, used by the update_items command.
+
+Crawling happens in two stages.  A pool of fetcher threads downloads the
+feeds, making at most a few requests to each host at once and backing off
+from hosts which fail.  The downloaded feeds are handed to the parser
+stage, which runs feedparser and updates the items in the database, so
+slow hosts never hold up parsing and parsing never holds up downloads.
+"""
+
+import calendar
+from datetime import datetime
+import heapq
+import httplib
+import logging
+import socket
+import threading
+import time
+import traceback
+import urllib2
+import urlparse
+import Queue
+from StringIO import StringIO
+
+import feedparser
+from django.db import connection
+from django.utils.http import http_date
+
+from channelguide import util
+from channelguide.channels.models import Channel, FeedSchedule
+
+DEFAULT_FETCHERS = 20
+DEFAULT_PARSERS = 2
+DEFAULT_PER_HOST = 2
+DEFAULT_ATTEMPTS = 3
+# seconds to wait after the first failure from a host; doubles with each
+# failure after that
+DEFAULT_BACKOFF = 5.0
+MAX_BACKOFF = 300.0
+# updates which take longer than this many seconds get logged
+SLOW_UPDATE = 6
+
+def due_channels(now):
+    """
+    Return the channels whose feeds are due to be checked (see
+    FeedSchedule).
+    """
+    FeedSchedule.objects.schedule_new_channels(now)
+    return Channel.objects.filter(
+        state__in=FeedSchedule.CHECKED_STATES, url__isnull=False,
+        feed_schedule__next_check__lte=now).select_related('feed_schedule')
+
+class FetchedFeed(StringIO):
+    """
+    A downloaded feed.  feedparser reads it like the HTTP response it came
+    from, so it gets the status, headers and URL as well as the body.
+    """
+    def __init__(self, url, status, headers, body):
+        StringIO.__init__(self, body)
+        self.url = url
+        self.status = status
+        self.headers = headers
+
+class TransientError(Exception):
+    """A fetch failed in a way that might not happen next time."""
+
+class CrawlJob(object):
+    def __init__(self, channel):
+        self.channel = channel
+        self.url = channel.url
+        self.host = urlparse.urlsplit(channel.url)[1].lower()
+        self.attempts = 0
+
+class HostScheduler(object):
+    """
+    Hands out jobs to the fetchers.  No more than per_host jobs for the same
+    host run at once, and after a host fails its jobs wait (backoff seconds,
+    doubling with each failure in a row) before they're tried again.
+    """
+    def __init__(self, jobs, per_host=DEFAULT_PER_HOST,
+                 backoff=DEFAULT_BACKOFF, max_backoff=MAX_BACKOFF):
+        self.per_host = per_host
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.condition = threading.Condition()
+        self.ready = [] # heap of (time, sequence, job)
+        self.sequence = 0
+        self.blocked = {} # host -> jobs waiting for a free slot
+        self.active = {} # host -> running jobs
+        self.failures = {} # host -> failures in a row
+        self.host_ready_at = {}
+        self.outstanding = 0
+        for job in jobs:
+            self._push(job, 0)
+            self.outstanding += 1
+
+    def _push(self, job, when):
+        self.sequence += 1
+        heapq.heappush(self.ready, (when, self.sequence, job))
+
+    def get_job(self):
+        """Wait for a job which can run now.  Returns None once every job
+        is finished.
+        """
+        self.condition.acquire()
+        try:
+            while self.outstanding:
+                if not self.ready:
+                    self.condition.wait()
+                    continue
+                when, sequence, job = self.ready[0]
+                now = time.time()
+                if when > now:
+                    self.condition.wait(when - now)
+                    continue
+                heapq.heappop(self.ready)
+                host_ready_at = self.host_ready_at.get(job.host, 0)
+                if host_ready_at > now:
+                    self._push(job, host_ready_at)
+                elif self.active.get(job.host, 0) >= self.per_host:
+                    self.blocked.setdefault(job.host, []).append(job)
+                else:
+                    self.active[job.host] = self.active.get(job.host, 0) + 1
+                    return job
+            return None
+        finally:
+            self.condition.release()
+
+    def job_done(self, job, failed=False, retry=False):
+        """Record that a job has run.  If retry is True it's run again once
+        the host's backoff has passed.
+        """
+        self.condition.acquire()
+        try:
+            now = time.time()
+            self.active[job.host] -= 1
+            blocked = self.blocked.get(job.host)
+            if blocked:
+                self._push(blocked.pop(0), now)
+            if failed:
+                failures = self.failures.get(job.host, 0) + 1
+                self.failures[job.host] = failures
+                self.host_ready_at[job.host] = now + min(
+                    self.backoff * 2 ** (failures - 1), self.max_backoff)
+            else:
+                self.failures.pop(job.host, None)
+            if retry:
+                self._push(job, now)
+            else:
+                self.outstanding -= 1
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+class CrawlStats(object):
+    """Progress and latency numbers for a crawl."""
+    def __init__(self, total, progress=False):
+        self.lock = threading.Lock()
+        self.total = total
+        self.counts = {}
+        self.bytes = 0
+        self.fetch_times = []
+        self.parse_times = []
+        self.start = time.time()
+        self.end = None
+        if progress:
+            self.pprinter = util.ProgressPrinter('updating items', total)
+            self.pprinter.print_status()
+        else:
+            self.pprinter = None
+
+    def incr(self, name, count=1):
+        self.lock.acquire()
+        try:
+            self.counts[name] = self.counts.get(name, 0) + count
+        finally:
+            self.lock.release()
+
+    def fetched(self, feed, seconds):
+        self.lock.acquire()
+        try:
+            if feed.status == 304:
+                name = 'not modified'
+            else:
+                name = 'fetched'
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.bytes += len(feed.getvalue())
+            self.fetch_times.append(seconds)
+        finally:
+            self.lock.release()
+
+    def parsed(self, seconds):
+        self.lock.acquire()
+        try:
+            self.parse_times.append(seconds)
+        finally:
+            self.lock.release()
+
+    def channel_done(self):
+        self.lock.acquire()
+        try:
+            self.counts['done'] = self.counts.get('done', 0) + 1
+            if self.pprinter is not None:
+                self.pprinter.iteration_done()
+        finally:
+            self.lock.release()
+
+    def finish(self):
+        self.end = time.time()
+        if self.pprinter is not None:
+            self.pprinter.loop_done()
+
+    def summary(self):
+        """Return a list of lines describing the crawl."""
+        elapsed = (self.end or time.time()) - self.start
+        lines = ['%i feeds in %.1fs (%.1f feeds/s, %.1f KB)' % (
+                self.counts.get('done', 0), elapsed,
+                self.counts.get('done', 0) / max(elapsed, 0.001),
+                self.bytes / 1024.0)]
+        lines.append(', '.join(['%s: %i' % item
+                                for item in sorted(self.counts.items())]))
+        for name, times in (('fetch', self.fetch_times),
+                            ('parse', self.parse_times)):
+            lines.append('%s latency: median %.3fs, 95%% %.3fs, max %.3fs'
+                         % (name, _percentile(times, 50),
+                            _percentile(times, 95), max(times or [0])))
+        return lines
+
+class Crawler(object):
+    """
+    Fetches and parses the feeds for a list of channels.  With parsers=0 the
+    feeds are parsed in the thread which calls crawl().  With stream=True
+    the feeds are read one entry at a time (see Channel.update_items).
+    """
+    def __init__(self, fetchers=DEFAULT_FETCHERS, parsers=DEFAULT_PARSERS,
+                 per_host=DEFAULT_PER_HOST, attempts=DEFAULT_ATTEMPTS,
+                 backoff=DEFAULT_BACKOFF, max_backoff=MAX_BACKOFF,
+                 progress=False, stream=False):
+        self.fetchers = fetchers
+        self.parsers = parsers
+        self.per_host = per_host
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.progress = progress
+        self.stream = stream
+
+    def crawl(self, channels):
+        """Update the items for the given channels.  Returns the
+        CrawlStats.
+        """
+        jobs = [CrawlJob(channel) for channel in channels]
+        self.stats = CrawlStats(len(jobs), self.progress)
+        self.scheduler = HostScheduler(jobs, self.per_host, self.backoff,
+                                       self.max_backoff)
+        # bounded, so that fetching doesn't get too far ahead of parsing
+        self.parse_queue = Queue.Queue(max(self.fetchers, 1) * 2)
+        fetchers = [threading.Thread(target=self.run_fetcher)
+                    for i in range(self.fetchers)]
+        parsers = [threading.Thread(target=self.run_parser)
+                   for i in range(self.parsers)]
+        for thread in fetchers + parsers:
+            thread.setDaemon(True)
+            thread.start()
+        if parsers:
+            for thread in fetchers:
+                thread.join()
+            for thread in parsers:
+                self.parse_queue.put(None)
+            for thread in parsers:
+                thread.join()
+        else:
+            def stop_parsing():
+                for thread in fetchers:
+                    thread.join()
+                self.parse_queue.put(None)
+            threading.Thread(target=stop_parsing).start()
+            self.parse_feeds()
+        self.stats.finish()
+        return self.stats
+
+    def make_request(self, job):
+        channel = job.channel
+        request = urllib2.Request(job.url)
+        request.add_header('User-Agent', feedparser.USER_AGENT)
+        request.add_header('Accept-Encoding', 'gzip, deflate')
+        if channel.feed_etag:
+            request.add_header('If-None-Match', channel.feed_etag)
+        if channel.feed_modified:
+            request.add_header('If-Modified-Since', http_date(
+                    calendar.timegm(channel.feed_modified.timetuple())))
+        return request
+
+    def fetch(self, job):
+        """Download the feed for a job.  Returns a FetchedFeed, or raises
+        TransientError if it's worth trying again.
+        """
+        try:
+            response = urllib2.urlopen(self.make_request(job))
+            try:
+                return FetchedFeed(response.geturl(), 200, response.info(),
+                                   response.read())
+            finally:
+                response.close()
+        except urllib2.HTTPError, e:
+            if e.code >= 500 or e.code == 429:
+                raise TransientError('HTTP %i' % e.code)
+            # 304s and error pages go to feedparser, the way they did when
+            # feedparser did the downloading
+            return FetchedFeed(e.geturl() or job.url, e.code, e.info(),
+                               e.read() or '')
+        except (urllib2.URLError, socket.error, httplib.HTTPException,
+                ValueError), e:
+            raise TransientError(str(e) or e.__class__.__name__)
+
+    def run_fetcher(self):
+        while True:
+            job = self.scheduler.get_job()
+            if job is None:
+                return
+            job.attempts += 1
+            start = time.time()
+            try:
+                feed = self.fetch(job)
+            except TransientError, e:
+                retry = job.attempts < self.attempts
+                self.scheduler.job_done(job, failed=True, retry=retry)
+                if retry:
+                    self.stats.incr('retries')
+                    continue
+                logging.info('giving up on %s: %s' % (job.url, e))
+                self.stats.incr('errors')
+                feed = None
+            except:
+                self.scheduler.job_done(job, failed=True)
+                logging.warn('\nError fetching %s\n\n%s\n' % (
+                        job.url, traceback.format_exc()))
+                self.stats.incr('errors')
+                feed = None
+            else:
+                self.scheduler.job_done(job)
+                self.stats.fetched(feed, time.time() - start)
+            # failures go to the parsers as well, so they're recorded
+            self.parse_queue.put((job, feed))
+
+    def run_parser(self):
+        try:
+            self.parse_feeds()
+        finally:
+            # each thread has its own database connection
+            connection.close()
+
+    def parse_feeds(self):
+        while True:
+            next = self.parse_queue.get()
+            if next is None:
+                return
+            job, feed = next
+            start = time.time()
+            try:
+                self.handle_feed(job, feed)
+            except:
+                logging.warn("\nError updating items for %s\n\n%s\n" %
+                             (job.channel, traceback.format_exc()))
+                self.stats.incr('parse errors')
+            length = time.time() - start
+            if feed is not None:
+                self.stats.parsed(length)
+            if length > SLOW_UPDATE:
+                logging.warn("Update too slow for %s: %f" % (job.url,
+                                                             length))
+            self.stats.channel_done()
+
+    def handle_feed(self, job, feed):
+        """Update the channel from its feed, which is None if it couldn't be
+        downloaded, and schedule the next check.
+        """
+        channel = job.channel
+        schedule = FeedSchedule.objects.for_channel(channel)
+        now = datetime.now()
+        if feed is None:
+            # like feedparser's URLErrors, these leave the channel alone
+            schedule.failed(now)
+        else:
+            channel.update_items(feedparser_input=feed, stream=self.stream)
+            schedule.checked(now, not_modified=feed.status == 304)
@@ -0,0 +1,154 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+"""A local HTTP server which stands in for the hosts feeds come from, so
+that the crawler can be tested and benchmarked without the network.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+
+from django.utils.http import http_date
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class FeedRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        feed_server = self.server.feed_server
+        port = self.server.server_address[1]
+        # counted as finished before anything is sent, since the client can
+        # move on as soon as it has the response
+        feed_server.request_started(port)
+        try:
+            status, headers, body = feed_server.respond(
+                self.path, self.headers.get('If-None-Match'))
+        finally:
+            feed_server.request_finished(port)
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FeedServer(object):
+    """
+    Serves generated feeds at http://127.0.0.1:<port>/feed/<n>.  Each of
+    the hosts listens on its own port, which the crawler counts as a
+    separate host.  Every response takes latency seconds, and the first
+    fail_first requests for each feed get a 503.
+    """
+    def __init__(self, hosts=1, items=10, latency=0, fail_first=0):
+        self.items = items
+        self.latency = latency
+        self.fail_first = fail_first
+        self.lock = threading.Lock()
+        self.requests = {} # feed number -> requests
+        self.active = {} # port -> requests being answered
+        self.max_active = {} # port -> most requests answered at once
+        self.started = time.time()
+        self.servers = []
+        for i in range(hosts):
+            server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                         FeedRequestHandler)
+            server.feed_server = self
+            self.servers.append(server)
+
+    def start(self):
+        for server in self.servers:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.setDaemon(True)
+            thread.start()
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def feed_urls(self, count):
+        """Return the URLs of count feeds, spread over the hosts."""
+        urls = []
+        for number in range(count):
+            port = self.servers[number % len(self.servers)].server_address[1]
+            urls.append('http://127.0.0.1:%i/feed/%i' % (port, number))
+        return urls
+
+    def reset_counts(self):
+        self.lock.acquire()
+        try:
+            self.requests = {}
+            self.max_active = {}
+        finally:
+            self.lock.release()
+
+    def request_started(self, port):
+        self.lock.acquire()
+        try:
+            active = self.active[port] = self.active.get(port, 0) + 1
+            self.max_active[port] = max(self.max_active.get(port, 0), active)
+        finally:
+            self.lock.release()
+
+    def request_finished(self, port):
+        self.lock.acquire()
+        try:
+            self.active[port] -= 1
+        finally:
+            self.lock.release()
+
+    def should_fail(self, number):
+        self.lock.acquire()
+        try:
+            requests = self.requests[number] = self.requests.get(number,
+                                                                  0) + 1
+        finally:
+            self.lock.release()
+        return requests <= self.fail_first
+
+    def respond(self, path, if_none_match):
+        """Return the status, headers and body of the response for path."""
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            number = int(path.strip('/').split('/')[-1])
+        except ValueError:
+            return 404, [], ''
+        if self.should_fail(number):
+            return 503, [], ''
+        etag = '"feed-%i"' % number
+        headers = [('ETag', etag)]
+        if if_none_match == etag:
+            return 304, headers, ''
+        headers.extend([('Content-Type', 'application/rss+xml'),
+                        ('Last-Modified', http_date(self.started))])
+        return 200, headers, self.make_feed(number)
+
+    def make_feed(self, number):
+        items = []
+        for i in range(self.items):
+            items.append("""<item>
+<title>Feed %(number)i episode %(i)i</title>
+<link>http://example.com/%(number)i/%(i)i.html</link>
+<guid>http://example.com/%(number)i/%(i)i</guid>
+<description>Episode %(i)i of feed %(number)i.</description>
+<pubDate>%(date)s</pubDate>
+<enclosure url="http://example.com/%(number)i/%(i)i.mp4" length="1000"
+    type="video/mp4"/>
+</item>""" % {'number': number, 'i': i,
+              'date': http_date(self.started - i * 86400)})
+        return """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel>
+<title>Feed %i</title>
+<link>http://example.com/%i/</link>
+<description>A generated feed.</description>
+%s
+</channel></rss>""" % (number, number, '\n'.join(items))
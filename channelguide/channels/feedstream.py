@@ -0,0 +1,94 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+"""Read the entries of a feed one at a time.
+
+feedparser builds the whole feed in memory before anything can be done with
+it, which is a lot of memory and time for feeds with thousands of entries
+when only the newest few have changed.  iter_entries() reads the document
+with iterparse instead, and hands each item to feedparser on its own as it
+comes to it, so the entries are exactly what feedparser.parse() would have
+returned but only one of them is in memory at a time, and the caller can
+stop reading whenever it likes.
+"""
+
+import gzip
+import zlib
+from cStringIO import StringIO
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+import feedparser
+
+ENTRY_TAGS = frozenset([
+        'item', # RSS 0.9x and 2.0
+        '{http://purl.org/rss/1.0/}item',
+        '{http://my.netscape.com/rdf/simple/0.9/}item',
+        '{http://www.w3.org/2005/Atom}entry',
+        '{http://purl.org/atom/ns#}entry', # Atom 0.3
+        ])
+
+class FeedStreamError(Exception):
+    """The feed couldn't be read as a stream (usually because it isn't
+    well-formed XML, which feedparser can still cope with)."""
+
+def decode_content(feed_file):
+    """Undo any Content-Encoding the feed was sent with."""
+    headers = getattr(feed_file, 'headers', None)
+    if headers is None:
+        return feed_file
+    encoding = (headers.get('content-encoding') or '').lower()
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=feed_file)
+    elif encoding == 'deflate':
+        data = feed_file.read()
+        try:
+            return StringIO(zlib.decompress(data))
+        except zlib.error:
+            # some servers send raw deflate data without the zlib header
+            return StringIO(zlib.decompress(data, -zlib.MAX_WBITS))
+    return feed_file
+
+def wrap_entry(ancestors, element):
+    """Return a document with just the one entry in it, inside empty copies
+    of the elements it was inside in the feed."""
+    root = parent = None
+    for ancestor in ancestors:
+        copy = ElementTree.Element(ancestor.tag, dict(ancestor.attrib))
+        if parent is None:
+            root = copy
+        else:
+            parent.append(copy)
+        parent = copy
+    if parent is None:
+        return ElementTree.tostring(element, 'utf-8')
+    parent.append(element)
+    return ElementTree.tostring(root, 'utf-8')
+
+def iter_entries(feed_file):
+    """Yield the feedparser entries in a feed file, in the order they're in
+    the feed.  Raises FeedStreamError if the feed can't be read this way.
+    """
+    ancestors = []
+    try:
+        for event, element in ElementTree.iterparse(
+            decode_content(feed_file), events=('start', 'end')):
+            if event == 'start':
+                ancestors.append(element)
+                continue
+            ancestors.pop()
+            if element.tag not in ENTRY_TAGS:
+                continue
+            parsed = feedparser.parse(StringIO(wrap_entry(ancestors,
+                                                          element)))
+            # the entry is done with, so let it go
+            element.clear()
+            if ancestors:
+                ancestors[-1].remove(element)
+            for entry in parsed.entries:
+                yield entry
+    except (SyntaxError, IOError, zlib.error), e:
+        raise FeedStreamError(str(e))
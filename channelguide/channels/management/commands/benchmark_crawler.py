@@ -0,0 +1,89 @@
+import threading
+import time
+import Queue
+from optparse import make_option
+
+import feedparser
+from django.core.management.base import NoArgsCommand
+
+from channelguide.channels import crawler
+from channelguide.channels.feedserver import FeedServer
+
+class FakeChannel(object):
+    feed_etag = ''
+    feed_modified = None
+
+    def __init__(self, url):
+        self.url = url
+
+class ParseOnlyCrawler(crawler.Crawler):
+    """Parses the feeds without touching the database."""
+    def handle_feed(self, job, feed):
+        if feed is not None:
+            feedparser.parse(feed)
+
+class Command(NoArgsCommand):
+    """
+    Crawl feeds from a local stand-in server, the way update_items used to
+    (4 threads, each downloading and parsing with feedparser) and with the
+    crawler.  The database isn't updated in either case.
+    """
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('-f', '--feeds', type='int', default=200,
+                    help='Number of feeds to crawl'),
+        make_option('--hosts', type='int', default=10,
+                    help='Number of hosts the feeds are spread over'),
+        make_option('--latency', type='float', default=0.1,
+                    help='Seconds the server takes to answer'),
+        make_option('--items', type='int', default=20,
+                    help='Items in each feed'),
+        make_option('--fetchers', type='int',
+                    default=crawler.DEFAULT_FETCHERS),
+        make_option('--per-host', type='int', dest='per_host',
+                    default=crawler.DEFAULT_PER_HOST),)
+
+    def crawl_before(self, urls):
+        queue = Queue.Queue()
+        for url in urls:
+            queue.put(url)
+        def worker():
+            while True:
+                try:
+                    url = queue.get(block=False)
+                except Queue.Empty:
+                    return
+                feedparser.parse(url)
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+    def handle_noargs(self, **options):
+        server = FeedServer(hosts=options['hosts'], items=options['items'],
+                            latency=options['latency'])
+        server.start()
+        try:
+            urls = server.feed_urls(options['feeds'])
+            before = self.crawl_before(urls)
+            server.reset_counts()
+            feed_crawler = ParseOnlyCrawler(
+                fetchers=options['fetchers'],
+                parsers=crawler.DEFAULT_PARSERS,
+                per_host=options['per_host'])
+            stats = feed_crawler.crawl([FakeChannel(url) for url in urls])
+        finally:
+            server.stop()
+        after = stats.end - stats.start
+        print '%i feeds on %i hosts, %.2fs latency, %i items each' % (
+            len(urls), options['hosts'], options['latency'],
+            options['items'])
+        print 'before: %.1fs (%.1f feeds/s)' % (before, len(urls) / before)
+        print 'after:  %.1fs (%.1f feeds/s), at most %i requests at once ' \
+            'to one host' % (after, len(urls) / after,
+                             max(server.max_active.values()))
+        for line in stats.summary():
+            print '  ' + line
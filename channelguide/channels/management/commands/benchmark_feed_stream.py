@@ -0,0 +1,92 @@
+import os
+import resource
+import time
+from StringIO import StringIO
+from optparse import make_option
+
+import feedparser
+from django.core.management.base import NoArgsCommand
+
+from channelguide.channels import feedstream
+from channelguide.channels.feedserver import FeedServer
+from channelguide.channels.models import Channel, Item
+
+def parse_whole_feed(feed, existing):
+    parsed = feedparser.parse(StringIO(feed))
+    return [Item.from_feedparser_entry(entry) for entry in parsed.entries]
+
+def stream_feed(feed, existing):
+    return Channel()._stream_items(StringIO(feed), existing)[0]
+
+class Command(NoArgsCommand):
+    """
+    Compare the time and memory it takes to turn a large generated feed
+    into Items by parsing it all with feedparser, and by reading it one
+    entry at a time, for a channel which doesn't have any items yet and for
+    one which has all but the newest few.  Each run happens in its own
+    process, and memory is the growth in peak RSS while it runs.
+    """
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--items', type='int', default=5000,
+                    help='Entries in the feed'),
+        make_option('--new', type='int', default=5,
+                    help='Entries the refreshed channel doesn\'t have yet'),)
+
+    def existing_items(self, feed, skip):
+        existing = {}
+        for i, entry in enumerate(feedstream.iter_entries(StringIO(feed))):
+            if i < skip:
+                continue
+            item = Item.from_feedparser_entry(entry)
+            values = dict([(name, getattr(item, name))
+                           for name in Item.CONTENT_FIELDS])
+            values.update(id=i, guid=item.guid)
+            existing[i] = values
+        return existing
+
+    def run(self, function, count, skip):
+        """Run function in a child process.  Returns the seconds it took,
+        the growth in peak RSS in KB and the number of items it returned.
+        """
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                feed = FeedServer(hosts=0, items=count).make_feed(0)
+                if skip is None:
+                    existing = {}
+                else:
+                    existing = self.existing_items(feed, skip)
+                before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                start = time.time()
+                items = function(feed, existing)
+                seconds = time.time() - start
+                after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                os.write(write_fd, '%f %i %i' % (seconds, after - before,
+                                                 len(items)))
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        result = os.read(read_fd, 1024)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        seconds, memory, items = result.split()
+        return float(seconds), int(memory), int(items)
+
+    def handle_noargs(self, **options):
+        count = options['items']
+        runs = (
+            ('feedparser', parse_whole_feed, None),
+            ('stream, new channel', stream_feed, None),
+            ('stream, %i new items' % options['new'], stream_feed,
+             options['new']),
+            )
+        print '%i entry feed (%.1f KB)' % (count, len(
+                FeedServer(hosts=0, items=count).make_feed(0)) / 1024.0)
+        print '%-25s %10s %12s %8s' % ('', 'seconds', 'peak RSS KB',
+                                       'items')
+        for name, function, skip in runs:
+            seconds, memory, items = self.run(function, count, skip)
+            print '%-25s %10.2f %12i %8i' % (name, seconds, memory, items)
@@ -0,0 +1,125 @@
+import time
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import NoArgsCommand
+from django.db import connection, reset_queries
+
+from channelguide import util
+from channelguide.channels.models import Channel, Item
+from channelguide.labels.models import Language
+
+def replace_items_one_by_one(channel, new_items):
+    """Channel._replace_items the way it used to work, saving and deleting
+    each item separately."""
+    to_delete = set(channel.items.all())
+    to_add = set(new_items)
+
+    items_by_url = {}
+    items_by_guid = {}
+    for i in channel.items.all():
+        if i.url is not None:
+            items_by_url[i.url] = i
+        if i.get_guid() is not None:
+            items_by_guid[i.get_guid()] = i
+    for i in new_items:
+        if i.get_guid() in items_by_guid:
+            to_delete.discard(items_by_guid[i.get_guid()])
+            to_add.discard(i)
+            items_by_guid[i.get_guid()].update_from_item(i)
+        elif i.url in items_by_url:
+            to_delete.discard(items_by_url[i.url])
+            to_add.discard(i)
+            items_by_url[i.url].update_from_item(i)
+    for i in to_delete:
+        i.delete()
+    for i in new_items:
+        if i in to_add:
+            channel.items.add(i)
+
+def replace_items_in_bulk(channel, new_items):
+    channel._replace_items(new_items)
+
+class Command(NoArgsCommand):
+    """
+    Count the queries and time it takes to replace a channel's items when
+    its feed is refreshed, saving each item separately (the old way) and
+    with the batched writes.  A throwaway channel is created for the
+    benchmark and deleted afterwards.
+    """
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--items', type='int', default=50,
+                    help='Items in the feed'),
+        make_option('-n', '--runs', type='int', default=20,
+                    help='Number of refreshes to time'),)
+
+    implementations = (
+        ('before', replace_items_one_by_one),
+        ('after', replace_items_in_bulk),
+        )
+
+    def make_items(self, first, count, description='Description'):
+        now = datetime.now().replace(microsecond=0)
+        items = []
+        for i in range(first, first + count):
+            items.append(Item(
+                    name='Episode %i' % i,
+                    url='http://example.com/benchmark/%i.mp4' % i,
+                    guid='http://example.com/benchmark/%i' % i,
+                    description='%s of episode %i.' % (description, i),
+                    mime_type='video/mp4', size=1000,
+                    date=now - timedelta(days=i)))
+        return items
+
+    def scenarios(self, count):
+        return (
+            ('unchanged', lambda: self.make_items(0, count)),
+            ('2 new, 2 gone', lambda: self.make_items(2, count)),
+            ('all edited', lambda: self.make_items(0, count, 'Edited')),
+            )
+
+    def run(self, channel, function, make_new_items, runs):
+        queries = 0
+        seconds = 0.0
+        for i in range(runs):
+            channel._replace_items(self.make_items(0, self.count))
+            new_items = make_new_items()
+            settings.DEBUG = True
+            reset_queries()
+            start = time.time()
+            function(channel, new_items)
+            seconds += time.time() - start
+            queries += len(connection.queries)
+            settings.DEBUG = False
+        return queries / float(runs), seconds * 1000 / runs
+
+    def handle_noargs(self, **options):
+        self.count = options['items']
+        channel = Channel(owner=User.objects.all()[0],
+                          language=Language.objects.all()[0],
+                          name='Benchmark %s' % util.random_string(10),
+                          url='http://example.com/benchmark/%s' % (
+                util.random_string(20),),
+                          website_url='http://example.com/',
+                          publisher='benchmark@example.com',
+                          description='Benchmark channel')
+        channel.download_feed = lambda: None
+        channel.save()
+        old_debug = settings.DEBUG
+        try:
+            print '%i items per feed, %i refreshes each' % (
+                self.count, options['runs'])
+            print '%-15s %-7s %8s %10s' % ('refresh', '', 'queries',
+                                           'ms')
+            for name, make_new_items in self.scenarios(self.count):
+                for label, function in self.implementations:
+                    queries, ms = self.run(channel, function,
+                                           make_new_items, options['runs'])
+                    print '%-15s %-7s %8.1f %10.2f' % (name, label, queries,
+                                                      ms)
+        finally:
+            settings.DEBUG = old_debug
+            channel.delete()
@@ -0,0 +1,116 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from channelguide import util
+from channelguide.channels.models import Channel
+from channelguide.thumbnailable import images
+
+class Command(NoArgsCommand):
+    """
+    Make a channel's thumbnails of made-up JPEGs in a temporary directory
+    and report images per second: with ImageMagick, one convert for each
+    size (the old way, if convert is installed), decoding the image again
+    for each size with PIL, with one decode and the shrinking chain, and
+    with that in a pool of processes.
+    """
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--images', type='int', default=50,
+                    help='Images to make thumbnails of'),
+        make_option('--width', type='int', default=1024),
+        make_option('--height', type='int', default=768),
+        make_option('-p', '--processes', type='int', default=None,
+                    help='Processes in the pool (default: one for each '
+                    'core)'),
+        make_option('--seed', type='int', default=0),)
+
+    def make_image(self, generator, path, width, height):
+        try:
+            from PIL import ImageDraw
+        except ImportError:
+            import ImageDraw
+        image = images.Image.new('RGB', (width, height), (0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        for i in range(200):
+            x, y = generator.randint(0, width), generator.randint(0, height)
+            size = generator.randint(10, width / 4)
+            draw.ellipse((x, y, x + size, y + size),
+                         fill=tuple([generator.randint(0, 255)
+                                     for j in range(3)]))
+        image.save(path, 'JPEG', quality=90)
+
+    def jobs(self, sources, directory, label):
+        jobs = []
+        for i, source in enumerate(sources):
+            sizes = []
+            for width, height in Channel.THUMBNAIL_SIZES:
+                size_dir = os.path.join(directory, label,
+                                        '%ix%i' % (width, height))
+                if not os.path.exists(size_dir):
+                    os.makedirs(size_dir)
+                sizes.append((os.path.join(size_dir, '%i.jpeg' % i),
+                              width, height))
+            jobs.append((source, sizes))
+        return jobs
+
+    def convert(self, jobs):
+        for source, sizes in jobs:
+            for path, width, height in sizes:
+                util.call_command(
+                    "convert",  source, "-strip", '-flatten',
+                    "-resize", "%dx%d>" % (width, height),
+                    "-gravity", "center", "-bordercolor", "black",
+                    "-border", "%s" % (max(width, height) / 2),
+                    "-crop", "%dx%d+0+0" % (width, height),
+                    "+repage", path)
+
+    def per_size(self, jobs):
+        for source, sizes in jobs:
+            for size in sizes:
+                images.make_thumbnails(source, [size])
+
+    def chained(self, jobs):
+        for job in jobs:
+            images.make_thumbnails(*job)
+
+    def handle_noargs(self, **options):
+        generator = random.Random(options['seed'])
+        directory = tempfile.mkdtemp()
+        pool = images.make_pool(options['processes'])
+        try:
+            sources = []
+            for i in range(options['images']):
+                path = os.path.join(directory, '%i.jpeg' % i)
+                self.make_image(generator, path, options['width'],
+                                options['height'])
+                sources.append(path)
+            ways = [('per size', self.per_size),
+                    ('chained', self.chained),
+                    ('pool', lambda jobs: images.make_many(jobs, pool))]
+            try:
+                util.call_command('convert', '-version')
+            except EnvironmentError:
+                print 'convert is not installed; skipping it'
+            else:
+                ways.insert(0, ('convert', self.convert))
+            print '%i %ix%i images, %i sizes each' % (
+                len(sources), options['width'], options['height'],
+                len(Channel.THUMBNAIL_SIZES))
+            print '%-12s %10s %10s' % ('way', 'seconds', 'images/s')
+            for label, function in ways:
+                jobs = self.jobs(sources, directory, label.replace(' ', '-'))
+                start = time.time()
+                function(jobs)
+                seconds = time.time() - start
+                print '%-12s %10.2f %10.1f' % (label, seconds,
+                                               len(sources) / seconds)
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(directory)
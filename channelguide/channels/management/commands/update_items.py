@@ -1,37 +1,36 @@
 from datetime import datetime
-import logging
-import time
-import traceback
+from optparse import make_option
 
 from django.core.management.base import BaseCommand
-from channelguide.channels.models import Channel
+from channelguide.channels import crawler
 from channelguide.channels.management import utils
 
 class Command(BaseCommand):
 
-    def handle(self, **kwargs):
+    option_list = BaseCommand.option_list + (
+        make_option('--fetchers', type='int',
+                    default=crawler.DEFAULT_FETCHERS,
+                    help='Number of feeds to download at once'),
+        make_option('--parsers', type='int',
+                    default=crawler.DEFAULT_PARSERS,
+                    help='Number of threads parsing feeds'),
+        make_option('--per-host', type='int', dest='per_host',
+                    default=crawler.DEFAULT_PER_HOST,
+                    help='Number of feeds to download at once from one '
+                    'host'),
+        make_option('--stream', action='store_true', default=False,
+                    help='Read feeds one entry at a time, stopping at the '
+                    'entries which are already in the database'),)
+
+    def handle(self, **options):
         """Update the items for each channel."""
         utils.set_short_socket_timeout()
-        now = datetime.now()
-        def callback(channel):
-            if channel.state == Channel.SUSPENDED and now.weekday() != 6:
-                # only check suspended feeds on Sunday
-                return
-            if not channel.is_approved() and \
-                    channel.state != Channel.SUSPENDED:
-                # only check approved/suspended feeds
-                return
-            if channel.id % 24 != now.hour:
-                # check channels throughout the day, some each hour
-                return
-            try:
-                start = time.time()
-                channel.update_items()
-                length = time.time() - start
-                if length > 6:
-                    logging.warn("Update too slow for %s: %f" % (channel.url,
-                                                                 length))
-            except:
-                logging.warn("\nError updating items for %s\n\n%s\n" %
-                        (channel, traceback.format_exc()))
-        utils.spawn_threads_for_channels('updating items', callback, 4)
+        feed_crawler = crawler.Crawler(fetchers=options['fetchers'],
+                                       parsers=options['parsers'],
+                                       per_host=options['per_host'],
+                                       progress=utils.print_stuff,
+                                       stream=options['stream'])
+        stats = feed_crawler.crawl(crawler.due_channels(datetime.now()))
+        if utils.print_stuff:
+            for line in stats.summary():
+                print line
@@ -3,21 +3,30 @@ from optparse import make_option
 import traceback
 from django.core.management.base import BaseCommand
 from channelguide.channels.management import utils
+from channelguide.thumbnailable import images
 
 class Command(BaseCommand):
 
     option_list = BaseCommand.option_list + (
         make_option('-o', '--overwrite', action='store_true',
-                    help='Overwrite existing thumbnails'),)
+                    help='Overwrite existing thumbnails'),
+        make_option('-p', '--processes', type='int', default=None,
+                    help='Processes making the thumbnails (default: one '
+                    'for each core)'),)
 
     def handle(self, *sizes, **kwargs):
         overwrite = kwargs.pop('overwrite', False)
         if len(sizes) == 0:
             sizes = None
-        for channel in utils.all_channel_iterator('update thumbnails'):
-            try:
-                channel.update_thumbnails(overwrite, None)
-            except:
-                logging.warn('error updating thumbnails for %i:\n%s' % (
-                        channel.id,
-                        traceback.format_exc()))
+        pool = images.make_pool(kwargs.get('processes'))
+        try:
+            for channel in utils.all_channel_iterator('update thumbnails'):
+                try:
+                    channel.update_thumbnails(overwrite, sizes, pool)
+                except:
+                    logging.warn('error updating thumbnails for %i:\n%s' % (
+                            channel.id,
+                            traceback.format_exc()))
+        finally:
+            pool.close()
+            pool.join()
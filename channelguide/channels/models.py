@@ -2,7 +2,7 @@
 # Copyright (c) 2008-2009 Participatory Culture Foundation
 # See LICENSE for details.
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import urllib2
 from glob import glob
 import cgi
@@ -19,19 +19,30 @@ except ImportError:
     import StringIO
 
 from django.conf import settings
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Max
+from django.dispatch import Signal
 from django.utils.translation import ngettext
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 
 from channelguide import util
+from channelguide.channels import feedstream
 from channelguide.guide import feedutil, exceptions, emailmessages
 from channelguide.guide import filetypes
 
-from channelguide.thumbnailable.models import Thumbnailable
+from channelguide.thumbnailable.models import Thumbnailable, refresh_many
 from channelguide.moderate.models import ModeratorAction
 from channelguide.labels.models import Tag, TagMap
 
+# Sent when Channel._replace_items changes a channel's items.  The changes
+# are written without saving each Item, so there are no post_save or
+# post_delete signals for them.  added is a list of the new Items, updated
+# and deleted are lists of Item ids; items maps the ids of the added and
+# updated items to Items with their new content; search_changed is True if
+# item search data was deleted along with the items.
+items_changed = Signal(providing_args=['instance', 'added', 'updated',
+                                       'deleted', 'items', 'search_changed'])
 
 def try_to_download_thumb(url):
     try:
@@ -141,6 +152,10 @@ class Channel(Thumbnailable):
             (245, 164),
     ]
 
+    # when reading a feed one entry at a time, stop after this many entries
+    # in a row which we already have, if the feed is newest first
+    STREAM_STOP_AFTER = 3
+
     def __str__(self):
         return "%s (%s)" % (self.name, self.url)
 
@@ -247,8 +262,9 @@ class Channel(Thumbnailable):
                 'count': count
         }
 
-    def update_thumbnails(self, overwrite=False, sizes=None):
-        """Recreate the thumbnails using the original data."""
+    def update_thumbnails(self, overwrite=False, sizes=None, pool=None):
+        """Recreate the thumbnails using the original data, and the items'
+        thumbnails in the pool's processes if there is one."""
 
         if self.thumbnail_extension is None:
             pattern = self.thumb_path('original')
@@ -260,10 +276,7 @@ class Channel(Thumbnailable):
                 self.save()
 
         Thumbnailable.refresh_thumbnails(self, overwrite, sizes)
-        for item in self.items.order_by('-id'):
-            try:
-                item.refresh_thumbnails(overwrite, sizes)
-            except: pass
+        refresh_many(self.items.order_by('-id'), overwrite, sizes, pool)
 
     def download_item_thumbnails(self, redownload=False):
         """Download item thumbnails."""
@@ -286,32 +299,123 @@ class Channel(Thumbnailable):
             modified = self.feed_modified.timetuple()
         else:
             modified = None
-        parsed = feedparser.parse(self.url, modified=modified,
-                etag=self.feed_etag)
-        if hasattr(parsed, 'status') and parsed.status == 304:
+        return self.parse_feed(self.url, modified=modified,
+                               etag=self.feed_etag)
+
+    def parse_feed(self, feedparser_input, **kwargs):
+        """Parse the feed with feedparser.  Returns None if the feed hasn't
+        changed since the last time it was parsed.
+        """
+        parsed = feedparser.parse(feedparser_input, **kwargs)
+        # newer versions of feedparser keep the parsed time separately
+        modified = getattr(parsed, 'modified_parsed',
+                           getattr(parsed, 'modified', None))
+        if not self._feed_changed(getattr(parsed, 'status', None),
+                                  getattr(parsed, 'etag', None), modified):
             return None
-        if hasattr(parsed, 'modified'):
-            new_modified = feedutil.struct_time_to_datetime(parsed.modified)
+        return parsed
+
+    def _feed_changed(self, status, etag, modified):
+        """Remember the ETag and modified time (a struct_time) the feed was
+        sent with.  Returns False if the feed hasn't changed since the last
+        time it was parsed.
+        """
+        if status == 304:
+            return False
+        if modified is not None:
+            new_modified = feedutil.struct_time_to_datetime(modified)
             if (self.feed_modified is not None and
                     new_modified <= self.feed_modified):
-                return None
+                return False
             self.feed_modified = new_modified
-        if hasattr(parsed, 'etag'):
-            self.feed_etag = parsed.etag
-        return parsed
+        if etag is not None:
+            self.feed_etag = etag
+        return True
+
+    def _stream_items(self, feed_file, existing):
+        """Read the items from a feed file one entry at a time (see
+        channels.feedstream), stopping once STREAM_STOP_AFTER entries in a
+        row are items we already have with the same content.  That's only
+        done while every item so far has a date no newer than the one
+        before it; feeds which list their oldest items first have the new
+        ones at the end, so they're read to the end.  existing is what
+        _load_items() returned.  Returns the items and whether the whole
+        feed was read.
+        """
+        items_by_url, items_by_guid = self._index_items(existing)
+        items = []
+        known = 0
+        newest_first = True
+        for entry in feedstream.iter_entries(feed_file):
+            try:
+                item = Item.from_feedparser_entry(entry)
+            except exceptions.EntryMissingDataError:
+                continue
+            except exceptions.FeedparserEntryError, e:
+                logging.warn("Error converting feedparser entry: %s (%s)"
+                        % (e, self))
+                continue
+            if item.date is None or (items and items[-1].date is not None
+                                     and item.date > items[-1].date):
+                newest_first = False
+            items.append(item)
+            old = self._match_item(item, items_by_url, items_by_guid)
+            if (old is not None and
+                    item.content_hash() == Item.content_hash_of(old)):
+                known += 1
+                if newest_first and known >= self.STREAM_STOP_AFTER:
+                    return items, False
+            else:
+                known = 0
+        return items, True
 
-    def update_items(self, feedparser_input=None):
+    def _update_items_streaming(self, feed_file):
+        """update_items() for stream=True.  Returns False if the feed has
+        to be parsed the usual way instead.
+        """
+        headers = getattr(feed_file, 'headers', None) or {}
+        modified = headers.get('last-modified')
+        if modified is not None:
+            modified = feedparser._parse_date(modified)
+        # put back if feedparser has to read it, so that it doesn't think
+        # it's already seen this version
+        validators = self.feed_modified, self.feed_etag
+        if not self._feed_changed(getattr(feed_file, 'status', None),
+                                  headers.get('etag'), modified):
+            if self.items or self.state != Channel.SUSPENDED:
+                self._check_archived()
+            return True
+        existing = self._load_items()
+        try:
+            items, complete = self._stream_items(feed_file, existing)
+        except feedstream.FeedStreamError:
+            self.feed_modified, self.feed_etag = validators
+            feed_file.seek(0)
+            return False
+        self._replace_items(items, existing, complete)
+        self._check_items()
+        return True
+
+    def update_items(self, feedparser_input=None, stream=False):
+        """Update the items from the channel's feed.  feedparser_input is
+        anything feedparser can parse; if it isn't given, the feed is
+        downloaded.  With stream=True, a feedparser_input which is a file is
+        read one entry at a time, and only up to the items we already have.
+        """
         if self.url is None:
             return # sites don't have items
+        if (stream and hasattr(feedparser_input, 'read') and
+                self._update_items_streaming(feedparser_input)):
+            return
         try:
             if feedparser_input is None:
                 parsed = self.download_feed()
-                if parsed is None:
-                    if self.items or self.state != Channel.SUSPENDED:
-                        self._check_archived()
-                    return
             else:
-                parsed = feedparser.parse(feedparser_input)
+                parsed = self.parse_feed(feedparser_input)
+            if parsed is None:
+                if self.items or self.state != Channel.SUSPENDED:
+                    self._check_archived()
+                return
         except:
             logging.exception("ERROR parsing %s" % self.url)
         else:
@@ -330,6 +434,9 @@ class Channel(Thumbnailable):
                     logging.warn("Error converting feedparser entry: %s (%s)"
                             % (e, self))
             self._replace_items(items)
+        self._check_items()
+
+    def _check_items(self):
         if self.items.count():
             self._check_archived()
         else:
@@ -366,45 +473,92 @@ class Channel(Thumbnailable):
                     self.state = Channel.NEW
                     self.last_moderated_by_id = None
             self.save()
-        items = [item for item in self.items.all() if item.date is not None]
-        if not items:
+        latest = self.items.aggregate(latest=Max('date'))['latest']
+        if latest is None:
             return
-        items.sort(key=lambda x: x.date)
-        latest = items[-1].date
         if (datetime.now() - latest).days > 90:
             self.archived = True
         else:
             self.archived = False
         self.save()
 
-    def _replace_items(self, new_items):
-        """Replace the items currently in the channel with a new list of
-        items."""
-
-        to_delete = set(self.items.all())
-        to_add = set(new_items)
+    def _load_items(self):
+        """Return the channel's items as dictionaries of the fields
+        _replace_items needs, keyed by id."""
+        columns = ['id', 'guid'] + list(Item.CONTENT_FIELDS)
+        return dict([(row[0], dict(zip(columns, row)))
+                     for row in self.items.values_list(*columns)])
 
+    @staticmethod
+    def _index_items(existing):
         items_by_url = {}
         items_by_guid = {}
-        for i in self.items.all():
-            if i.url is not None:
-                items_by_url[i.url] = i
-            if i.get_guid() is not None:
-                items_by_guid[i.get_guid()] = i
-        for i in new_items:
-            if i.get_guid() in items_by_guid:
-                to_delete.discard(items_by_guid[i.get_guid()])
-                to_add.discard(i)
-                items_by_guid[i.get_guid()].update_from_item(i)
-            elif i.url in items_by_url:
-                to_delete.discard(items_by_url[i.url])
-                to_add.discard(i)
-                items_by_url[i.url].update_from_item(i)
-        for i in to_delete:
-            i.delete()
+        # in the channel's item order, so that the oldest duplicate wins
+        for values in sorted(existing.values(),
+                             key=lambda values: (values['date'],
+                                                 values['id']),
+                             reverse=True):
+            if values['url'] is not None:
+                items_by_url[values['url']] = values
+            if values['guid'] is not None:
+                items_by_guid[values['guid']] = values
+        return items_by_url, items_by_guid
+
+    @staticmethod
+    def _match_item(item, items_by_url, items_by_guid):
+        """Return the existing item a new item replaces, or None."""
+        if item.get_guid() in items_by_guid:
+            return items_by_guid[item.get_guid()]
+        return items_by_url.get(item.url)
+
+    def _replace_items(self, new_items, existing=None, complete=True):
+        """Replace the items currently in the channel with a new list of
+        items.
+
+        The existing items are loaded once (unless they're passed in, from
+        _load_items) and matched against the new ones by GUID, then by URL.
+        Matched items whose content hasn't changed aren't touched; the
+        updates and deletes which are needed go to the database as a few
+        batched statements, along with an INSERT for each new item, in one
+        transaction.  If complete is False,
+        new_items is only the start of the feed, so the items which aren't
+        in it are kept.
+        """
+        if existing is None:
+            existing = self._load_items()
+        existing = existing.copy()
+        items_by_url, items_by_guid = self._index_items(existing)
+
+        updates = {}
+        to_add = []
         for i in new_items:
-            if i in to_add:
-                self.items.add(i)
+            old = self._match_item(i, items_by_url, items_by_guid)
+            if old is None:
+                to_add.append(i)
+                continue
+            existing.pop(old['id'], None)
+            # if more than one new item matches, the last one wins
+            updates.pop(old['id'], None)
+            if i.content_hash() != Item.content_hash_of(old):
+                updates[old['id']] = (
+                    i, i.thumbnail_url != old['thumbnail_url'])
+        if complete:
+            to_delete = existing.keys()
+        else:
+            to_delete = []
+        if not (to_add or updates or to_delete):
+            return
+        search_changed = Item.objects.write_changes(self, to_add, updates,
+                                                    to_delete)
+        items = dict([(item.id, item) for item in to_add])
+        for id, (item, thumbnail_changed) in updates.items():
+            # the Items parsed from the feed, which haven't got these yet
+            item.id = id
+            item.channel_id = self.id
+            items[id] = item
+        items_changed.send(sender=Channel, instance=self, added=to_add,
+                           updated=updates.keys(), deleted=to_delete,
+                           items=items, search_changed=search_changed)
 
     def _thumb_html(self, width, height):
         thumb_url = self.thumb_url(width, height)
@@ -480,6 +634,78 @@ class AddedChannel(models.Model): # TODO move
         db_table = 'cg_channel_added'
         unique_together = [('channel', 'user')]
 
+class ItemManager(models.Manager):
+
+    # most ids in one DELETE statement
+    DELETE_BATCH_SIZE = 100
+
+    @transaction.commit_on_success
+    def write_changes(self, channel, added, updated, deleted):
+        """Write the changes Channel._replace_items found in one
+        transaction.  added is a list of new Items for the channel, updated
+        maps item ids to (Item, thumbnail_changed) and deleted is a list of
+        item ids.  Returns True if search data for the deleted items was
+        deleted as well.
+        """
+        cursor = connection.cursor()
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table = qn(opts.db_table)
+        search_changed = False
+        for start in range(0, len(deleted), self.DELETE_BATCH_SIZE):
+            ids = deleted[start:start + self.DELETE_BATCH_SIZE]
+            placeholders = ', '.join(['%s'] * len(ids))
+            # what Item.delete() would have deleted along with the items
+            for related in opts.get_all_related_objects():
+                cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                        qn(related.model._meta.db_table),
+                        qn(related.field.column), placeholders), ids)
+                if cursor.rowcount > 0:
+                    search_changed = True
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                    table, qn(opts.pk.column), placeholders), ids)
+
+        fields = [opts.get_field(name) for name in Item.CONTENT_FIELDS]
+        assignments = ', '.join(['%s = %%s' % qn(field.column)
+                                 for field in fields])
+        for thumbnail_changed in (False, True):
+            rows = []
+            for item_id, (item, changed) in updated.items():
+                if changed == thumbnail_changed:
+                    rows.append([field.get_db_prep_save(
+                                getattr(item, field.attname),
+                                connection=connection)
+                                 for field in fields] + [item_id])
+            if not rows:
+                continue
+            if thumbnail_changed:
+                # the old thumbnail is for the wrong image
+                extra = ', %s = NULL' % qn(
+                    opts.get_field('thumbnail_extension').column)
+            else:
+                extra = ''
+            cursor.executemany('UPDATE %s SET %s%s WHERE %s = %%s' % (
+                    table, assignments, extra, qn(opts.pk.column)), rows)
+
+        if added:
+            fields = [field for field in opts.local_fields
+                      if not isinstance(field, models.AutoField)]
+            sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                table, ', '.join([qn(field.column) for field in fields]),
+                ', '.join(['%s'] * len(fields)))
+            # one at a time, since only the last id inserted can be asked
+            # for; working the others out from the channel's newest ids
+            # goes wrong if something else adds items at the same time
+            for item in added:
+                item.channel_id = channel.id
+                cursor.execute(sql, [field.get_db_prep_save(
+                            getattr(item, field.attname),
+                            connection=connection) for field in fields])
+                item.id = connection.ops.last_insert_id(
+                    cursor, opts.db_table, opts.pk.column)
+        transaction.set_dirty()
+        return search_changed
+
 class Item(Thumbnailable):
     channel = models.ForeignKey(Channel, related_name='items')
     url = models.URLField(max_length=255)
@@ -491,10 +717,16 @@ class Item(Thumbnailable):
     guid = models.CharField(max_length=255)
     date = models.DateTimeField()
 
+    objects = ItemManager()
+
     class Meta:
         db_table = 'cg_channel_item'
         ordering = ['-date', '-id']
 
+    # the fields which come from the feed, other than the GUID
+    CONTENT_FIELDS = ('name', 'url', 'description', 'mime_type',
+                      'thumbnail_url', 'size', 'date')
+
     THUMBNAIL_DIR = 'item-thumbnails'
     THUMBNAIL_SIZES = [
             (97, 65),
@@ -537,13 +769,8 @@ class Item(Thumbnailable):
         return '<a href="%s">%s</a>' % (self.download_url(), self.name)
 
     def update_search_data(self):
-        raise NotImplementedError # not doing this right now
-        if self.search_data is None:
-            #self.search_data = search.ItemSearchData()
-            self.search_data.item_id = self.id
-        self.search_data.text = ' '.join([self.description, self.url])
-        self.search_data.important_text = self.name
-        self.search_data.save()
+        from channelguide.search.models import SearchChange
+        SearchChange.objects.log(SearchChange.ITEM, [self.id])
 
     def download_thumbnail(self, redownload=False):
         if self.thumbnail_url is None:
@@ -629,6 +856,22 @@ class Item(Thumbnailable):
         rv.thumbnail_url = feedutil.get_thumbnail_url(entry)
         return rv
 
+    @classmethod
+    def content_hash_of(cls, values):
+        """Return a hash of the CONTENT_FIELDS in the values dictionary."""
+        content = []
+        for name in cls.CONTENT_FIELDS:
+            value = values[name]
+            if isinstance(value, unicode):
+                value = value.encode('utf8')
+            elif isinstance(value, long):
+                value = int(value)
+            content.append(value)
+        return util.hash_string(repr(tuple(content)))
+
+    def content_hash(self):
+        return self.content_hash_of(self.__dict__)
+
     def update_from_item(self, other):
         """
         Update our information from another item, presumed to be the same as
@@ -668,6 +911,112 @@ class LastApproved(models.Model):
     class Meta:
         db_table = 'cg_channel_last_approved'
 
+class FeedScheduleManager(models.Manager):
+
+    def schedule_new_channels(self, now):
+        """Give the channels whose feeds get checked a schedule if they don't
+        have one.  The first checks are spread out over the next day.
+        """
+        channels = Channel.objects.filter(
+            state__in=FeedSchedule.CHECKED_STATES, url__isnull=False,
+            feed_schedule__isnull=True)
+        for channel_id in channels.values_list('id', flat=True):
+            self.create(channel_id=channel_id,
+                        next_check=now + timedelta(hours=channel_id % 24))
+
+    def for_channel(self, channel):
+        try:
+            schedule = channel.feed_schedule
+        except FeedSchedule.DoesNotExist:
+            schedule = FeedSchedule()
+        schedule.channel = channel
+        return schedule
+
+class FeedSchedule(models.Model):
+    """
+    When a channel's feed should next be checked, along with what's been
+    seen of the feed so far: how often it publishes, how often it hasn't
+    changed when it's checked, and how many checks in a row have failed.
+    """
+    channel = models.OneToOneField(Channel, primary_key=True,
+                                   related_name='feed_schedule')
+    next_check = models.DateTimeField(db_index=True)
+    last_check = models.DateTimeField(null=True)
+    # the date of the newest item in the feed
+    newest_item = models.DateTimeField(null=True)
+    # seconds between items, from the dates of the newest items
+    publish_interval = models.IntegerField(null=True)
+    # decaying average of how many checks got a 304
+    not_modified_rate = models.FloatField(default=0)
+    failures = models.IntegerField(default=0)
+
+    objects = FeedScheduleManager()
+
+    class Meta:
+        db_table = 'cg_channel_feed_schedule'
+
+    CHECKED_STATES = (Channel.APPROVED, Channel.AUDIO, Channel.SUSPENDED)
+    # seconds between checks
+    MIN_INTERVAL = 3600
+    DEFAULT_INTERVAL = 86400
+    MAX_INTERVAL = 86400 * 7
+    # feeds which haven't had a new item in this long are checked weekly
+    DORMANT = timedelta(days=30)
+    # how many times to check a feed between new items
+    CHECKS_PER_ITEM = 4
+    # how many item dates to look at
+    ITEM_HISTORY = 10
+    # how much each check counts towards not_modified_rate
+    RATE_WEIGHT = 0.2
+
+    def get_item_history(self):
+        """Return the seconds between items and the date of the newest
+        item.
+        """
+        dates = list(self.channel.items.filter(date__isnull=False).order_by(
+                '-date').values_list('date', flat=True)[:self.ITEM_HISTORY])
+        gaps = [newer - older for (newer, older) in zip(dates, dates[1:])]
+        if not gaps:
+            return None, (dates or [None])[0]
+        gaps.sort()
+        median = gaps[len(gaps) / 2]
+        return median.days * 86400 + median.seconds, dates[0]
+
+    def get_interval(self, now):
+        """Return how many seconds to wait before the next check."""
+        if (self.channel.state == Channel.SUSPENDED or self.channel.archived or
+                (self.newest_item is not None and
+                 now - self.newest_item > self.DORMANT)):
+            interval = self.MAX_INTERVAL
+        elif self.publish_interval is None:
+            interval = self.DEFAULT_INTERVAL
+        else:
+            # feeds which usually haven't changed get checked less often
+            interval = (self.publish_interval / self.CHECKS_PER_ITEM *
+                        (1 + self.not_modified_rate))
+        interval *= 2 ** min(self.failures, 8)
+        return int(max(self.MIN_INTERVAL, min(interval, self.MAX_INTERVAL)))
+
+    def checked(self, now, not_modified=False):
+        """Record a check of the feed and schedule the next one."""
+        self.not_modified_rate += self.RATE_WEIGHT * (
+            int(not_modified) - self.not_modified_rate)
+        if not not_modified:
+            self.publish_interval, self.newest_item = \
+                self.get_item_history()
+        self.failures = 0
+        self._reschedule(now)
+
+    def failed(self, now):
+        """Record a check which couldn't download the feed."""
+        self.failures += 1
+        self._reschedule(now)
+
+    def _reschedule(self, now):
+        self.last_check = now
+        self.next_check = now + timedelta(seconds=self.get_interval(now))
+        self.save()
+
 
 for width, height in Channel.THUMBNAIL_SIZES:
     def channel_thumb(self, width=width, height=height):
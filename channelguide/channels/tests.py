@@ -3,23 +3,30 @@
 
 from datetime import datetime, timedelta
 import os
+import re
 import time
+from StringIO import StringIO
 from urllib2 import URLError
 
+import feedparser
 from django.core import mail, management
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connection, reset_queries
 from django.template import loader
 
 from channelguide import util
-from channelguide.channels import views
-from channelguide.channels.models import Channel, Item, AddedChannel
+from channelguide.channels import crawler, views
+from channelguide.channels.feedserver import FeedServer
+from channelguide.channels.models import (Channel, Item, AddedChannel,
+                                          FeedSchedule)
 from channelguide.featured.models import FeaturedQueue, FeaturedEmail
 from channelguide.labels.models import Category, Language, TagMap
 from channelguide.moderate.models import ModeratorAction
 from channelguide.ratings.models import GeneratedRatings
 from channelguide.subscriptions.models import Subscription
+from channelguide.thumbnailable import images
 from channelguide.testframework import TestCase, test_data_path, test_data_url
 
 class ChannelTestBase(TestCase):
@@ -52,6 +59,38 @@ class ChannelModelTest(ChannelTestBase):
                 file(self.get_thumb_path('original')).read(),
                           'thumbnails are not equal')
 
+    def test_update_thumbnails(self):
+        """
+        Every thumbnail should be exactly its size, padded out if the image
+        is a different shape, and update_thumbnails() should remake the
+        missing ones, and the items' in a pool of processes.
+        """
+        self.channel.save_thumbnail(file(test_data_path(
+                    'thumbnail_square.png')))
+        item = Item(channel=self.channel, name='Item', url='http://a.b/c.flv',
+                    description='', size=0, date=datetime.now())
+        item.save()
+        item.save_thumbnail(file(test_data_path('thumbnail.jpg')))
+        for width, height in Channel.THUMBNAIL_SIZES:
+            image = images.Image.open(self.get_thumb_path(
+                    '%ix%i' % (width, height)))
+            self.assertEquals(image.size, (width, height))
+            # the square image is padded with black at the sides
+            self.assertEquals(image.convert('RGB').getpixel((0, 0)),
+                              (0, 0, 0))
+        paths = [self.get_thumb_path('97x65'),
+                 item.thumb_path('97x65')]
+        for path in paths:
+            os.remove(path)
+        pool = images.make_pool(2)
+        try:
+            self.channel.update_thumbnails(pool=pool)
+        finally:
+            pool.close()
+            pool.join()
+        for path in paths:
+            self.assertEquals(images.Image.open(path).size, (97, 65))
+
     def test_approved_at(self):
         self.assertEquals(self.channel.approved_at, None)
         self.channel.change_state(self.ralph, Channel.APPROVED)
@@ -284,6 +323,142 @@ class ChannelItemTest(ChannelTestBase):
         self.assertEquals(items[1].thumb_url(width, height),
                 self.channel.thumb_url(width, height))
 
+    def parse_items(self, filename):
+        parsed = feedparser.parse(open(test_data_path(filename)))
+        return [Item.from_feedparser_entry(entry)
+                for entry in parsed.entries]
+
+    def count_queries(self, function, *args):
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        reset_queries()
+        try:
+            function(*args)
+        finally:
+            settings.DEBUG = old_debug
+        return len(connection.queries)
+
+    def test_replace_items_batches_writes(self):
+        """
+        Replacing the items should take one query to load the existing items
+        and a few batched statements to write the changes, however many
+        items there are.
+        """
+        self.channel._replace_items(self.parse_items('feed.xml'))
+        old_ids = list(self.channel.items.values_list('id', flat=True))
+        # nothing changed, so nothing is written
+        self.assertEquals(self.count_queries(self.channel._replace_items,
+                                             self.parse_items('feed.xml')),
+                          1)
+        self.assertEquals(
+            list(self.channel.items.values_list('id', flat=True)), old_ids)
+        # load, delete search data, delete items, an INSERT for each of
+        # the two new items, and one logging the changes for the search
+        # indexes; the items which are still there haven't changed
+        new_items = self.parse_items('feed-future.xml')
+        self.assertEquals(self.count_queries(self.channel._replace_items,
+                                             new_items), 6)
+        self.assertEquals(self.channel.items.count(), 5)
+        for item in new_items[:2]:
+            self.assertEquals(Item.objects.get(pk=item.id).name, item.name)
+
+    def test_replace_items_keeps_thumbnails(self):
+        """
+        Items whose thumbnail URL hasn't changed keep their thumbnails.
+        """
+        def make_items():
+            items = self.parse_items('feed.xml')
+            for item in items:
+                item.thumbnail_url = 'http://www.getmiro.com/old.jpg'
+            return items
+        self.channel._replace_items(make_items())
+        item = self.channel.items.all()[0]
+        Item.objects.filter(pk=item.pk).update(thumbnail_extension='jpeg')
+        new_items = make_items()
+        for new_item in new_items:
+            new_item.description = 'changed'
+        self.channel._replace_items(new_items)
+        item = Item.objects.get(pk=item.pk)
+        self.assertEquals(item.description, 'changed')
+        self.assertEquals(item.thumbnail_extension, 'jpeg')
+        for new_item in new_items:
+            new_item.thumbnail_url = 'http://www.getmiro.com/new.jpg'
+        self.channel._replace_items(new_items)
+        item = Item.objects.get(pk=item.pk)
+        self.assertEquals(item.thumbnail_extension, None)
+
+    def test_stream(self):
+        """
+        Reading the feed one entry at a time gives the same items as parsing
+        it all at once.
+        """
+        self.channel.update_items(
+            feedparser_input=open(test_data_path('feed.xml')), stream=True)
+        self.check_item_titles('rb_06_dec_13', 'rb_06_dec_12', 'rb_06_dec_11',
+                'rb_06_dec_08', 'rb_06_dec_07')
+
+    def test_stream_stops_at_known_items(self):
+        """
+        Streaming stops once it gets to items we already have, and keeps the
+        items it didn't get to.
+        """
+        feed = FeedServer(hosts=0, items=20).make_feed(1)
+        self.channel.update_items(feedparser_input=StringIO(feed),
+                                  stream=True)
+        self.assertEquals(self.channel.items.count(), 20)
+        feed = feed.replace('Feed 1 episode 0<', 'New title<')
+        items, complete = self.channel._stream_items(
+            StringIO(feed), self.channel._load_items())
+        self.assertEquals(len(items), 1 + Channel.STREAM_STOP_AFTER)
+        self.assert_(not complete)
+        self.channel.update_items(feedparser_input=StringIO(feed),
+                                  stream=True)
+        self.assertEquals(self.channel.items.count(), 20)
+        self.assertEquals(self.channel.items.all()[0].name, 'New title')
+
+    def test_stream_reads_oldest_first_feeds(self):
+        """
+        Feeds which list their oldest items first are read to the end,
+        where the new items are.
+        """
+        feed = FeedServer(hosts=0, items=21).make_feed(1)
+        start = feed.index('<item>')
+        end = feed.rindex('</item>') + len('</item>')
+        entries = re.findall(r'<item>.*?</item>', feed, re.S)
+        entries.reverse() # episode 0, the newest, is last
+        def make_feed(entries):
+            return feed[:start] + '\n'.join(entries) + feed[end:]
+        self.channel.update_items(
+            feedparser_input=StringIO(make_feed(entries[:-1])), stream=True)
+        self.assertEquals(self.channel.items.count(), 20)
+        items, complete = self.channel._stream_items(
+            StringIO(make_feed(entries)), self.channel._load_items())
+        self.assertEquals(len(items), 21)
+        self.assert_(complete)
+        self.channel.update_items(
+            feedparser_input=StringIO(make_feed(entries)), stream=True)
+        self.assertEquals(self.channel.items.count(), 21)
+        self.assertEquals(
+            self.channel.items.filter(name='Feed 1 episode 0').count(), 1)
+
+    def test_stream_falls_back_to_feedparser(self):
+        """
+        Feeds which aren't well-formed XML are parsed by feedparser, which
+        shouldn't think it's already seen them because of the headers.
+        """
+        feed = open(test_data_path('feed.xml')).read().replace(
+            '<title>rb_06_dec_13</title>', '<title>rb_06_dec_13 &</title>')
+        headers = {'last-modified': 'Wed, 22 Jul 2009 17:29:27 GMT',
+                   'etag': '"v1"'}
+        self.channel.update_items(
+            feedparser_input=crawler.FetchedFeed(self.channel.url, 200,
+                                                 headers, feed),
+            stream=True)
+        self.assertEquals(self.channel.items.count(), 5)
+        self.assertEquals(self.channel.feed_modified,
+                          datetime(2009, 7, 22, 17, 29, 27))
+        self.assertEquals(self.channel.feed_etag, '"v1"')
+
     def test_item_info(self):
         def check_count(correct):
             channel = Channel.objects.get(pk=self.channel.id)
@@ -504,6 +679,186 @@ class ChannelSuspensionTest(ChannelTestBase):
                               'did not suspend %r by mistake' % name)
 
 
+class CrawlerTest(ChannelTestBase):
+    def setUp(self):
+        ChannelTestBase.setUp(self)
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        ChannelTestBase.tearDown(self)
+
+    def start_server(self, **kwargs):
+        self.server = FeedServer(**kwargs)
+        self.server.start()
+
+    def make_feed_channels(self, count):
+        channels = []
+        for url in self.server.feed_urls(count):
+            channel = self.make_channel(state=Channel.APPROVED)
+            channel.url = url
+            channel.save()
+            channels.append(channel)
+        return channels
+
+    def crawl(self, channels, **kwargs):
+        # parse in this thread, so that the updates go to the test database
+        kwargs.setdefault('parsers', 0)
+        return crawler.Crawler(**kwargs).crawl(channels)
+
+    def test_due_channels(self):
+        channels = {}
+        for state in (Channel.APPROVED, Channel.AUDIO, Channel.SUSPENDED,
+                      Channel.NEW):
+            channels[state] = self.make_channel(state=state)
+        site = self.make_channel(state=Channel.APPROVED)
+        site.url = None
+        site.save()
+        now = datetime(2009, 6, 1, 12)
+        crawler.due_channels(now)
+        self.assertEquals(set(FeedSchedule.objects.values_list('channel',
+                                                               flat=True)),
+                          set([channels[state].pk for state in (
+                        Channel.APPROVED, Channel.AUDIO, Channel.SUSPENDED)]))
+        FeedSchedule.objects.update(next_check=now)
+        FeedSchedule.objects.filter(channel=channels[Channel.AUDIO]).update(
+            next_check=now + timedelta(minutes=1))
+        self.assertEquals(set(crawler.due_channels(now)),
+                          set([channels[Channel.APPROVED],
+                               channels[Channel.SUSPENDED]]))
+
+    def test_crawl(self):
+        self.start_server(hosts=2, items=3, latency=0.05)
+        channels = self.make_feed_channels(6)
+        stats = self.crawl(channels, fetchers=6, per_host=2)
+        self.assertEquals(stats.counts['fetched'], 6)
+        self.assertEquals(stats.counts['done'], 6)
+        self.assertEquals(len(stats.fetch_times), 6)
+        self.assertEquals(len(stats.parse_times), 6)
+        for channel in channels:
+            self.assertEquals(channel.items.count(), 3)
+        self.assertEquals(max(self.server.max_active.values()), 2)
+
+    def test_not_modified(self):
+        self.start_server(items=3)
+        channels = self.make_feed_channels(2)
+        self.crawl(channels)
+        channels = [Channel.objects.get(pk=channel.pk) for channel in channels]
+        self.assertEquals(channels[0].feed_etag, '"feed-0"')
+        item_ids = [list(channel.items.values_list('id', flat=True))
+                    for channel in channels]
+        stats = self.crawl(channels)
+        self.assertEquals(stats.counts['not modified'], 2)
+        self.assertEquals(item_ids, [
+                list(channel.items.values_list('id', flat=True))
+                for channel in channels])
+
+    def test_backoff(self):
+        """
+        Failed downloads are retried after backing off from the host.  If
+        they keep failing, the channel is left alone.
+        """
+        self.start_server(items=3, fail_first=1)
+        channels = self.make_feed_channels(2)
+        stats = self.crawl(channels, backoff=0.01, attempts=2)
+        self.assertEquals(stats.counts['retries'], 2)
+        self.assertEquals(stats.counts['fetched'], 2)
+        for channel in channels:
+            self.assertEquals(channel.items.count(), 3)
+        self.server.fail_first = 2
+        self.server.reset_counts()
+        stats = self.crawl(channels, backoff=0.01, attempts=1)
+        self.assertEquals(stats.counts['errors'], 2)
+        for channel in channels:
+            channel = Channel.objects.get(pk=channel.pk)
+            self.assertEquals(channel.items.count(), 3)
+            self.assertEquals(channel.state, Channel.APPROVED)
+
+class FeedScheduleTest(ChannelTestBase):
+    def setUp(self):
+        ChannelTestBase.setUp(self)
+        self.channel.state = Channel.APPROVED
+        self.channel.save()
+        self.now = datetime(2009, 6, 1, 12)
+        self.schedule = FeedSchedule.objects.for_channel(self.channel)
+
+    def add_items(self, count, every):
+        for i in range(count):
+            self.channel.items.create(
+                url='http://example.com/%i.mp4' % i, name='item %i' % i,
+                description='', mime_type='video/mp4', size=0,
+                guid='item-%i' % i, date=self.now - every * i)
+
+    def check(self, not_modified=False):
+        self.schedule.checked(self.now, not_modified=not_modified)
+        return self.schedule.next_check - self.now
+
+    def test_new_feed(self):
+        self.assertEquals(self.check(), timedelta(days=1))
+
+    def test_busy_feed(self):
+        self.add_items(10, timedelta(minutes=20))
+        self.assertEquals(self.check(), timedelta(hours=1))
+
+    def test_publish_interval(self):
+        self.add_items(10, timedelta(days=2))
+        self.assertEquals(self.schedule.publish_interval, None)
+        self.assertEquals(self.check(), timedelta(hours=12))
+        self.assertEquals(self.schedule.publish_interval, 2 * 86400)
+        self.assertEquals(self.schedule.newest_item, self.now)
+
+    def test_dormant_feed(self):
+        self.add_items(5, timedelta(days=1))
+        self.now += timedelta(days=31)
+        self.assertEquals(self.check(), timedelta(days=7))
+
+    def test_suspended_feed(self):
+        self.add_items(5, timedelta(hours=1))
+        self.channel.state = Channel.SUSPENDED
+        self.assertEquals(self.check(), timedelta(days=7))
+
+    def test_not_modified(self):
+        """
+        Feeds which haven't changed when they're checked get checked less
+        often.
+        """
+        self.add_items(10, timedelta(days=2))
+        first = self.check()
+        for i in range(5):
+            interval = self.check(not_modified=True)
+        self.assert_(interval > first)
+        self.assert_(interval < first * 2)
+        self.assertEquals(self.schedule.publish_interval, 2 * 86400)
+
+    def test_failures(self):
+        self.add_items(10, timedelta(days=2))
+        self.check()
+        self.schedule.failed(self.now)
+        self.assertEquals(self.schedule.next_check - self.now,
+                          timedelta(days=1))
+        self.schedule.failed(self.now)
+        self.assertEquals(self.schedule.next_check - self.now,
+                          timedelta(days=2))
+        self.assertEquals(self.check(), timedelta(hours=12))
+
+    def test_crawl_records_checks(self):
+        server = FeedServer(items=3)
+        server.start()
+        try:
+            self.channel.url = server.feed_urls(1)[0]
+            self.channel.save()
+            crawler.Crawler(parsers=0).crawl([self.channel])
+            schedule = FeedSchedule.objects.get(channel=self.channel)
+            self.assertEquals(schedule.publish_interval, 86400)
+            self.assertEquals(schedule.failures, 0)
+            server.fail_first = 10
+            crawler.Crawler(parsers=0, attempts=1).crawl([self.channel])
+            schedule = FeedSchedule.objects.get(channel=self.channel)
+            self.assertEquals(schedule.failures, 1)
+        finally:
+            server.stop()
+
 class EditChannelTest(ChannelTestBase):
     def setUp(self):
         ChannelTestBase.setUp(self)
@@ -4,7 +4,6 @@
 import urlparse
 
 from django.conf import settings
-from django.utils.decorators import decorator_from_middleware
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth.views import redirect_to_login
@@ -18,7 +17,8 @@ from django.core.paginator import Paginator, InvalidPage
 from django.shortcuts import render_to_response, get_object_or_404
 
 from channelguide import util
-from channelguide.cache.decorators import cache_with_sites
+from channelguide.cache.decorators import (cache_with_sites,
+                                           view_cache_decorator)
 from channelguide.cache.middleware import UserCacheMiddleware
 from channelguide.guide.auth import admin_required
 from channelguide.guide.country import country_code
@@ -80,10 +80,17 @@ class SiteObjectList(ApiObjectList):
         return api_utils.get_sites(*args, **kw)
 
 class ChannelCacheMiddleware(UserCacheMiddleware):
-    def get_cache_key_tuple(self, request):
+    namespace = 'channel'
+    query_params = ('page', 'share')
+    fragment_mode = True
+
+    def get_cache_tags(self, request):
+        # the channel page only depends on the channel itself (saving an
+        # item, rating, etc. bumps the channel's tag as well)
         channelId = request.path.split('/')[-1].encode('utf8')
-        self.namespace = ('channel', 'Channel:%s' % channelId)
-        return UserCacheMiddleware.get_cache_key_tuple(self, request)
+        return ('Channel:%s' % channelId,)
+
+cache_channel_page = view_cache_decorator(ChannelCacheMiddleware)()
 
 
 def channel(request, id):
@@ -230,7 +237,7 @@ def channel(request, id):
     return util.redirect_to_referrer(request)
 
 
-@decorator_from_middleware(ChannelCacheMiddleware)
+@cache_channel_page
 def show(request, id, featured_form=None):
     c = get_object_or_404(Channel, pk=id)
     try:
@@ -263,7 +270,6 @@ def show(request, id, featured_form=None):
         'channel': c,
         'item_page': item_page,
         'is_miro': is_miro,
-        'show_edit_button': c.can_edit(request.user),
         'show_extra_info': c.can_edit(request.user),
         'link_to_channel': True,
         'BASE_URL': settings.BASE_URL,
@@ -344,7 +350,12 @@ def user_add(request, id):
                                            user=request.user)
     return HttpResponse("Added!")
 
-@cache_with_sites('namespace')
+# the arguments filtered_listing() reads; 'query' is the search the
+# listing shows, for /search
+LISTING_QUERY_PARAMS = ('page', 'sort', 'geoip', 'query')
+
+@cache_with_sites('namespace', query_params=LISTING_QUERY_PARAMS,
+                  fragment_mode=True)
 def filtered_listing(request, value=None, filter=None, limit=10,
                      title='Filtered Listing', default_sort=None):
     if not filter:
@@ -428,7 +439,11 @@ def filtered_listing(request, value=None, filter=None, limit=10,
         if (feed_object_list.count_all() != feed_paginator.count
             or (site_object_list is not None
                 and site_object_list.count_all() != site_paginator.count)):
-            args = request.GET.copy()
+            # only the arguments the page is cached by, so that nothing
+            # else in the URL ends up in the cached page
+            args = dict((name, request.GET[name])
+                        for name in LISTING_QUERY_PARAMS
+                        if name in request.GET)
             args['geoip'] = 'off'
             geoip_filtered = util.make_absolute_url(request.path, args)
 
@@ -9,10 +9,12 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.models import User
 from django.contrib.syndication import feeds, views
 from django.utils import feedgenerator
-from django.views.decorators.cache import cache_page
+from django.utils.cache import patch_response_headers
 from django.http import Http404
 
 from channelguide.api import utils as api_utils
+from channelguide.cache.decorators import view_cache_decorator
+from channelguide.cache.middleware import CacheMiddlewareBase
 from channelguide import util
 
 def https_add_domain(domain, url):
@@ -258,4 +260,22 @@ class RecommendationsFeed(ChannelsFeed):
         return api_utils.get_recommendations(user)
 
 
-cached_feed =  cache_page(views.feed, 3600)
+class FeedCacheMiddleware(CacheMiddlewareBase):
+    """
+    Caches feeds for an hour.  Feeds are the same for everyone, so the cache
+    key is only the URL.
+    """
+    cache_time = 3600
+
+    def get_cache_key_tuple(self, request):
+        return self.get_namespace_names() + (request.path,
+                                             self.get_query_key(request))
+
+    def process_response(self, request, response):
+        if response.status_code == 200 and \
+                not hasattr(request, '_cache_hit'):
+            # let feed readers cache it as well
+            patch_response_headers(response, self.cache_time)
+        return CacheMiddlewareBase.process_response(self, request, response)
+
+cached_feed = view_cache_decorator(FeedCacheMiddleware)()(views.feed)
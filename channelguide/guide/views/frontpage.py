@@ -8,7 +8,9 @@ from django.contrib import comments
 
 from channelguide import util
 from channelguide.guide.auth import admin_required
-from channelguide.cache.decorators import cache_for_user
+from channelguide.cache import utils as cache_utils
+from channelguide.cache.decorators import view_cache_decorator
+from channelguide.cache.middleware import UserCacheMiddleware
 from channelguide.channels.models import Channel
 from channelguide.labels.models import Category, Language
 
@@ -100,6 +102,8 @@ class FrontpageView:
 
     @classmethod
     def __call__(klass, request, show_welcome):
+        cache_utils.add_request_tags(request, 'State:%s' % klass.show_state,
+                                     'Featured', 'Category', 'Stats')
         featured_channels = list(klass.get_featured_channels(request))
         categories = Category.objects.filter(
             on_frontpage=True).order_by('name')
@@ -136,11 +140,15 @@ class AudioFrontpage(FrontpageView):
 video_frontpage = VideoFrontpage()
 audio_frontpage = AudioFrontpage()
 
-@cache_for_user
+# the frontpage doesn't look at any GET arguments
+cache_frontpage = view_cache_decorator(UserCacheMiddleware)(
+    query_params=(), fragment_mode=True)
+
+@cache_frontpage
 def index(request, show_welcome=False):
     return video_frontpage(request, show_welcome)
 
-@cache_for_user
+@cache_frontpage
 def audio_index(request, show_welcome=False):
     return audio_frontpage(request, show_welcome)
 
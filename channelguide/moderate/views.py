@@ -2,10 +2,9 @@
 # See LICENSE for details.
 
 from django.http import HttpResponseRedirect
-from django.core import cache
 from django.core.paginator import Paginator, InvalidPage
 from django.contrib.auth.decorators import permission_required
-from django.db.models import Count
+from django.db.models import Count, Sum
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
 from django.utils.translation import gettext as _
@@ -17,6 +16,7 @@ from channelguide.channels.models import Channel
 from channelguide.flags.models import Flag
 from channelguide.notes.models import ModeratorPost
 from channelguide.featured.models import FeaturedQueue
+from channelguide.subscriptions.models import GeneratedStats, SubscriptionDay
 
 from datetime import date, timedelta
 
@@ -133,32 +133,37 @@ def how_to_moderate(request):
 
 @permission_required('subscriptions.create_generatedstats')
 def stats(request):
-    todays = [int(request.connection.execute('SELECT SUM(subscription_count_today) FROM cg_channel_generated_stats')[0][0])]
+    totals = GeneratedStats.objects.aggregate(
+        Sum('subscription_count_today'), Sum('subscription_count_month'))
+    todays = [int(totals['subscription_count_today__sum'] or 0)]
     today_keys = [('last_24 hours', todays[0])]
-    months = [int(request.connection.execute('SELECT SUM(subscription_count_month) FROM cg_channel_generated_stats')[0][0])]
+    months = [int(totals['subscription_count_month__sum'] or 0)]
     month_keys = [('last_31_days', months[0])]
 
+    # the days' totals, all from one grouped query of the daily counts
+    today = date.today()
+    first_month = (today - timedelta(days=30*11)).replace(day=1)
+    days = SubscriptionDay.objects.totals_by_day(first_month,
+                                                 today - timedelta(days=1))
     for i in range(1, 100):
-        tt = (date.today() - timedelta(days=i)).timetuple()[:3]
-        key = 'stats:day:%i:%i:%i' % tt
-        val = cache.cache.get(key)
-        if val is None:
-            val = request.connection.execute('SELECT COUNT(*) FROM cg_channel_subscription WHERE YEAR(timestamp) = %s AND MONTH(timestamp) = %s AND DAY(timestamp) = %s', tt)[0][0]
-            cache.cache.set(key, val)
+        day = today - timedelta(days=i)
+        key = 'stats:day:%i:%i:%i' % day.timetuple()[:3]
+        val = int(days.get(day, 0))
         today_keys.append((key, val))
         todays.append(val)
 
+    month_totals = {}
+    for day, val in days.items():
+        month_totals[day.year, day.month] = month_totals.get(
+            (day.year, day.month), 0) + int(val)
     for i in range(1, 12):
-        tt = (date.today() - timedelta(days=30*i)).timetuple()[:2]
+        tt = (today - timedelta(days=30*i)).timetuple()[:2]
         key = 'stats:month:%i:%i' % tt
-        val = cache.cache.get(key)
-        if val is None:
-            val = request.connection.execute('SELECT COUNT(*) FROM cg_channel_subscription WHERE YEAR(timestamp) = %s AND MONTH(timestamp) = %s', tt)[0][0]
-            cache.cache.set(key, val)
+        val = month_totals.get(tt, 0)
         month_keys.append((key, val))
         months.append(val)
 
-    return render_to_response('moderate/stats.html', {
+    return render_to_response('guide/stats.html', {
             'today_keys': today_keys,
             'todays': reversed(todays),
             'min_today': min(todays),
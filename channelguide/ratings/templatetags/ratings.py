@@ -2,46 +2,79 @@
 # See LICENSE for details.
 
 from django import template
+from django.template.loader import render_to_string
+from channelguide.cache import fragments
 from channelguide.ratings.models import Rating, GeneratedRatings
 
 register = template.Library()
 
+def display_rating(user_rating, channel_id, generated_rating):
+    """
+    Return the Rating to show for a channel: the user's own rating if they
+    have one, otherwise one with the channel's average.
+    """
+    if user_rating is not None:
+        user_rating.has_user_rating = True
+        if user_rating.rating is None:
+            user_rating.rating = 0
+        return user_rating
+    rating = Rating(channel_id=channel_id)
+    rating.has_user_rating = False
+    rating.average_rating = generated_rating.average
+    return rating
+
 def _get_rating_context(context, channel):
     user = context['user']
-    rating = None
+    user_rating = None
     if user.is_authenticated():
         try:
-            rating = Rating.objects.filter(user=context['user'],
-                                           channel=channel).get()
+            user_rating = Rating.objects.filter(user=context['user'],
+                                                channel=channel).get()
         except Rating.DoesNotExist:
             pass
-        else:
-            rating.has_user_rating = True
-            if rating.rating is None:
-                rating.rating = 0
-
-    if rating is None:
-        rating = Rating(channel=channel)
-        rating.has_user_rating = False
+
+    generated_rating = None
+    if user_rating is None:
         try:
             if channel.rating is None:
                 raise GeneratedRatings.DoesNotExist
         except GeneratedRatings.DoesNotExist:
             channel.rating, created = GeneratedRatings.objects.get_or_create(
                 channel=channel)
-        rating.average_rating = channel.rating.average
+        generated_rating = channel.rating
 
     return {
-        'rating': rating,
+        'rating': display_rating(user_rating, channel.pk, generated_rating),
         'referer': context['request'].path,
         }
 
-@register.inclusion_tag('ratings/rating.html', takes_context=True)
-def show_rating_stars(context, channel):
-    return _get_rating_context(context, channel)
+class RatingStarsNode(template.Node):
+    def __init__(self, channel, small):
+        self.channel = channel
+        self.small = small
+
+    def render(self, context):
+        channel = self.channel.resolve(context)
+        if context['user'].is_authenticated() and \
+                fragments.is_deferred(context['request']):
+            # the user's own rating is filled in after the page comes out of
+            # the cache
+            args = [channel.pk]
+            if self.small:
+                args.append(self.small)
+            return fragments.placeholder('rating', *args)
+        rating_context = _get_rating_context(context, channel)
+        rating_context['small'] = self.small
+        return render_to_string('ratings/rating.html', rating_context)
+
+def _make_rating_stars_tag(small):
+    def do_rating_stars(parser, token):
+        tokens = token.split_contents()
+        if len(tokens) != 2:
+            raise template.TemplateSyntaxError(
+                'syntax is {%% %s <channel> %%}' % tokens[0])
+        return RatingStarsNode(parser.compile_filter(tokens[1]), small)
+    return do_rating_stars
 
-@register.inclusion_tag('ratings/rating.html', takes_context=True)
-def show_small_rating_stars(context, channel):
-    context = _get_rating_context(context, channel)
-    context['small'] = 'small'
-    return context
+register.tag('show_rating_stars', _make_rating_stars_tag(''))
+register.tag('show_small_rating_stars', _make_rating_stars_tag('small'))
@@ -0,0 +1,288 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+"""Offline evaluation of the recommendations.
+
+A Dataset is the ratings and the channel data the similarities are built
+from, taken from the database, generated, or kept in a SQLite file of its
+own so the same numbers can be run again later.  split() holds back half of
+the ratings of some of the users, the way rmse.py used to, and evaluate()
+builds the similarities from the rest and sees how well each engine
+predicts the ratings that were held back, timing each phase as it goes.
+
+An engine is anything which takes the (channel1 id, channel2 id,
+similarity) list and returns an object with a score(ratings) method giving
+the scores utils.calculate_scores() would; ENGINES has the ones the site
+has used.
+"""
+
+import math
+import random
+import resource
+import sqlite3
+import time
+
+from channelguide.recommendations import neighbors, utils
+
+MIN_TEST_RATINGS = 7 # users with fewer ratings are only used for training
+
+class Dataset(object):
+    """
+    Ratings (a list of (user id, channel id, rating)) along with the set of
+    approved channel ids, a dictionary of channel ids to language ids and
+    one of channel ids to sets of category ids.
+    """
+    def __init__(self, ratings, approved, languages, categories):
+        self.ratings = ratings
+        self.approved = approved
+        self.languages = languages
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.ratings)
+
+    def channel_data(self):
+        return self.approved, self.languages, self.categories
+
+    @classmethod
+    def from_database(cls):
+        from channelguide.ratings.models import Rating
+        ratings = list(Rating.objects.order_by('user', 'timestamp', 'id')
+                       .values_list('user', 'channel', 'rating'))
+        return cls(ratings, *utils.load_channel_data())
+
+    @classmethod
+    def generate(cls, users=500, channels=200, ratings_per_user=15,
+                 seed=0, tastes=3):
+        """
+        Make up ratings with some structure to them: users and channels
+        each get a random point in a space of tastes, and a user's rating of
+        a channel is higher the closer together they are, plus some noise.
+        Languages and categories are random, with channels near each other
+        more likely to share them.
+        """
+        generator = random.Random(seed)
+        def point():
+            return [generator.uniform(-1, 1) for i in range(tastes)]
+        channel_tastes = dict((id, point()) for id in range(1, channels + 1))
+        approved = set()
+        languages = {}
+        categories = {}
+        for id, taste in sorted(channel_tastes.items()):
+            if generator.random() < 0.9:
+                approved.add(id)
+            languages[id] = 1 + (taste[0] > 0.5) + (taste[0] < -0.5)
+            categories[id] = set([1 + int((taste[1] + 1) * 4) % 8])
+            if generator.random() < 0.3:
+                categories[id].add(generator.randint(1, 8))
+        ratings = []
+        for user_id in range(1, users + 1):
+            user_taste = point()
+            count = min(channels, generator.randint(1, ratings_per_user * 2))
+            for channel_id in generator.sample(sorted(channel_tastes),
+                                               count):
+                closeness = sum(a * b for a, b in zip(
+                        user_taste, channel_tastes[channel_id])) / tastes
+                rating = int(round(3 + closeness * 6 +
+                                   generator.gauss(0, 0.75)))
+                ratings.append((user_id, channel_id,
+                                max(1, min(5, rating))))
+        return cls(ratings, approved, languages, categories)
+
+    @classmethod
+    def load(cls, path):
+        """Read a dataset written by save()."""
+        db = sqlite3.connect(path)
+        try:
+            ratings = db.execute('SELECT user_id, channel_id, rating '
+                                 'FROM rating ORDER BY id').fetchall()
+            approved = set()
+            languages = {}
+            for id, language_id, is_approved in db.execute(
+                'SELECT id, language_id, approved FROM channel'):
+                languages[id] = language_id
+                if is_approved:
+                    approved.add(id)
+            categories = {}
+            for channel_id, category_id in db.execute(
+                'SELECT channel_id, category_id FROM channel_category'):
+                categories.setdefault(channel_id, set()).add(category_id)
+        finally:
+            db.close()
+        return cls(ratings, approved, languages, categories)
+
+    def save(self, path):
+        """Write the dataset to a SQLite file, replacing what was there."""
+        db = sqlite3.connect(path)
+        try:
+            for table, columns in (
+                ('rating', 'id INTEGER PRIMARY KEY, user_id INTEGER, '
+                 'channel_id INTEGER, rating INTEGER'),
+                ('channel', 'id INTEGER PRIMARY KEY, language_id INTEGER, '
+                 'approved INTEGER'),
+                ('channel_category', 'channel_id INTEGER, '
+                 'category_id INTEGER')):
+                db.execute('DROP TABLE IF EXISTS %s' % table)
+                db.execute('CREATE TABLE %s (%s)' % (table, columns))
+            db.executemany('INSERT INTO rating (user_id, channel_id, rating) '
+                           'VALUES (?, ?, ?)', self.ratings)
+            db.executemany('INSERT INTO channel VALUES (?, ?, ?)',
+                           [(id, language_id, id in self.approved)
+                            for id, language_id in self.languages.items()])
+            db.executemany('INSERT INTO channel_category VALUES (?, ?)',
+                           [(channel_id, category_id)
+                            for channel_id, ids in self.categories.items()
+                            for category_id in ids])
+            db.commit()
+        finally:
+            db.close()
+
+class Holdout(object):
+    """
+    training is the list of ratings to build the similarities from, and
+    tests a list of (known, hidden) pairs of {channel id: rating}
+    dictionaries, one for each test user: the ratings the engines are given
+    and the ones they're supposed to predict.
+    """
+    def __init__(self, training, tests):
+        self.training = training
+        self.tests = tests
+
+    def hidden_count(self):
+        return sum(len(hidden) for known, hidden in self.tests)
+
+def split(dataset, test_fraction=0.5, seed=0):
+    """
+    Pick test_fraction of the users with at least MIN_TEST_RATINGS ratings
+    and hide a random half of each one's ratings.  Everything else, including
+    the half of each test user's ratings which isn't hidden, is for
+    training.
+    """
+    generator = random.Random(seed)
+    by_user = {}
+    for user_id, channel_id, rating in dataset.ratings:
+        by_user.setdefault(user_id, []).append((channel_id, rating))
+    training = []
+    tests = []
+    for user_id in sorted(by_user):
+        ratings = by_user[user_id]
+        if (len(ratings) >= MIN_TEST_RATINGS and
+            generator.random() < test_fraction):
+            generator.shuffle(ratings)
+            known = ratings[:len(ratings) / 2]
+            tests.append((dict(known), dict(ratings[len(ratings) / 2:])))
+        else:
+            known = ratings
+        training.extend([(user_id, channel_id, rating)
+                         for channel_id, rating in known])
+    return Holdout(training, tests)
+
+class SimilarityRow(object):
+    """Enough of a Similarity for utils.calculate_scores()."""
+    __slots__ = ('channel1_id', 'channel2_id', 'cosine')
+
+    def __init__(self, channel1_id, channel2_id, cosine):
+        self.channel1_id = channel1_id
+        self.channel2_id = channel2_id
+        self.cosine = cosine
+
+class TableEngine(object):
+    """
+    Scores from every similarity of the rated channels, the way
+    Similarity.objects.recommend_from_ratings() used to get them from the
+    table.
+    """
+    def __init__(self, similarities):
+        self.rows = {} # channel id -> [SimilarityRow]
+        for channel1, channel2, similarity in similarities:
+            row = SimilarityRow(channel1, channel2, similarity)
+            self.rows.setdefault(channel1, []).append(row)
+            self.rows.setdefault(channel2, []).append(row)
+
+    def score(self, ratings):
+        # a row between two rated channels turns up twice, which
+        # calculate_scores() doesn't mind
+        rows = []
+        for channel_id in ratings:
+            rows.extend(self.rows.get(channel_id, ()))
+        return utils.calculate_scores(rows, ratings)[0]
+
+class NeighborEngine(object):
+    """Scores from a neighbors.NeighborIndex, the way the site gets them."""
+    def __init__(self, similarities, size=neighbors.NEIGHBORS,
+                 threshold=neighbors.MIN_SIMILARITY):
+        self.index = neighbors.NeighborIndex(similarities, size, threshold)
+
+    def score(self, ratings):
+        return utils.calculate_neighbor_scores(self.index, ratings)[0]
+
+ENGINES = (
+    ('table', TableEngine),
+    ('neighbors', NeighborEngine),
+    )
+
+class Timer(object):
+    """
+    Keeps the wall-clock seconds and the growth in peak RSS (in KB) of each
+    phase of an evaluation.  Peak RSS only ever grows, so a phase which
+    uses less memory than some earlier one shows up as 0.
+    """
+    def __init__(self):
+        self.phases = []
+
+    def run(self, name, function, *args):
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        result = function(*args)
+        seconds = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.phases.append((name, seconds, after - before))
+        return result
+
+def build_similarities(ratings, channel_data):
+    """Return a list of (channel1 id, channel2 id, similarity) for the
+    ratings, the same as Similarity.objects.recalculate_all() would."""
+    return list(utils.SimilarityMatrix(ratings,
+                                       channel_data).similarities())
+
+def predict(engine, tests):
+    """Return a list of (rating, predicted score or None) for every hidden
+    rating which isn't empty."""
+    predictions = []
+    for known, hidden in tests:
+        scores = engine.score(known)
+        for channel_id, rating in hidden.items():
+            if rating is not None:
+                predictions.append((rating, scores.get(channel_id)))
+    return predictions
+
+def accuracy(predictions):
+    """Return the RMSE of the scores which were predicted (None if there
+    weren't any) and the fraction of ratings which got one."""
+    errors = [(rating - score) ** 2 for rating, score in predictions
+              if score is not None]
+    if not predictions:
+        return None, 0.0
+    coverage = float(len(errors)) / len(predictions)
+    if not errors:
+        return None, coverage
+    return math.sqrt(sum(errors) / len(errors)), coverage
+
+def evaluate(dataset, holdout, engines=ENGINES, timer=None):
+    """
+    Build the similarities from the holdout's training ratings and run its
+    tests through each of the (name, engine) pairs.  Returns a list of
+    (name, RMSE, coverage) and the Timer with the phases.
+    """
+    if timer is None:
+        timer = Timer()
+    similarities = timer.run('similarities', build_similarities,
+                             holdout.training, dataset.channel_data())
+    results = []
+    for name, factory in engines:
+        engine = timer.run('%s: build' % name, factory, similarities)
+        predictions = timer.run('%s: score' % name, predict, engine,
+                                holdout.tests)
+        rmse, coverage = accuracy(predictions)
+        results.append((name, rmse, coverage))
+    return results, timer
@@ -0,0 +1,115 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import connection, models, reset_queries
+
+from channelguide.channels.models import Channel
+from channelguide.ratings.models import Rating
+from channelguide.recommendations import neighbors, utils
+from channelguide.recommendations.models import Similarity
+
+def recalculate_pair_by_pair():
+    """Similarity.objects.recalculate_all the way it used to work, with
+    queries for each pair of channels."""
+    Similarity.objects.all().delete()
+    done = set()
+    for channel1 in Channel.objects.approved():
+        for channel2_id in utils.find_relevant_similar(channel1):
+            pair = (min(channel1.pk, channel2_id),
+                    max(channel1.pk, channel2_id))
+            if pair in done:
+                continue
+            done.add(pair)
+            channel2 = Channel.objects.get(pk=channel2_id)
+            Similarity.objects.create(
+                channel1_id=pair[0], channel2_id=pair[1],
+                cosine=utils.get_similarity(channel1, channel2))
+
+def score_from_table(ratings):
+    """recommend_from_ratings' scoring the way it used to work, with every
+    similarity of every rated channel."""
+    recommendations = Similarity.objects.filter(
+        models.Q(channel1__in=ratings.keys()) |
+        models.Q(channel2__in=ratings.keys()))
+    return utils.calculate_scores(recommendations, ratings)
+
+def score_from_index(ratings):
+    return utils.calculate_neighbor_scores(neighbors.get_index(), ratings)
+
+class Command(NoArgsCommand):
+    """
+    Rebuild the similarity table pair by pair (the old way) and with
+    utils.SimilarityMatrix, and compare the time, queries and results.  The
+    table is left as the matrix rebuild made it.  Then compare scoring the
+    recommendations for the heaviest raters from the whole table and from
+    the neighbor index.
+    """
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--scoring-only', action='store_true',
+                    dest='scoring_only', default=False,
+                    help="Don't rebuild the table, only compare scoring"),)
+
+    def run(self, function):
+        settings.DEBUG = True
+        reset_queries()
+        start = time.time()
+        try:
+            function()
+        finally:
+            settings.DEBUG = False
+        return time.time() - start, len(connection.queries)
+
+    def similarities(self):
+        return dict(((channel1, channel2), cosine)
+                    for channel1, channel2, cosine in
+                    Similarity.objects.values_list('channel1', 'channel2',
+                                                   'cosine'))
+
+    def handle_noargs(self, **options):
+        if not options['scoring_only']:
+            self.benchmark_rebuild()
+        self.benchmark_scoring()
+
+    def benchmark_rebuild(self):
+        old_debug = settings.DEBUG
+        try:
+            before = self.run(recalculate_pair_by_pair)
+            old = self.similarities()
+            after = self.run(Similarity.objects.recalculate_all)
+            new = self.similarities()
+        finally:
+            settings.DEBUG = old_debug
+        print '%i similarities' % len(new)
+        print '%-8s %10s %10s' % ('', 'seconds', 'queries')
+        for name, (seconds, queries) in (('before', before),
+                                         ('after', after)):
+            print '%-8s %10.2f %10i' % (name, seconds, queries)
+        if set(old) != set(new):
+            print 'different pairs: %i missing, %i extra' % (
+                len(set(old) - set(new)), len(set(new) - set(old)))
+        common = set(old) & set(new)
+        if common:
+            print 'largest difference: %g' % max(
+                [abs(old[pair] - new[pair]) for pair in common])
+
+    def benchmark_scoring(self, users=20):
+        raters = Rating.objects.values('user').annotate(
+            count=models.Count('id')).order_by('-count')[:users]
+        all_ratings = []
+        for row in raters:
+            all_ratings.append(dict(Rating.objects.filter(
+                        user=row['user']).values_list('channel', 'rating')))
+        start = time.time()
+        neighbors.get_index()
+        print 'neighbor index built in %.3fs' % (time.time() - start)
+        print '%-8s %14s' % ('scoring', 'ms per user')
+        for name, function in (('before', score_from_table),
+                               ('after', score_from_index)):
+            start = time.time()
+            for ratings in all_ratings:
+                function(ratings)
+            print '%-8s %14.2f' % (name, (time.time() - start) * 1000 /
+                                   len(all_ratings))
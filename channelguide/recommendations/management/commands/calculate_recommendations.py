@@ -1,13 +1,20 @@
 from django.core.management.base import BaseCommand
 
 class Command(BaseCommand):
+    args = '[full]'
 
     def handle(self, *args, **kwargs):
         """
-        Calculate the item-item channel recomendations.
+        Calculate the item-item channel recomendations.  Ratings keep them
+        up to date as they change, so 'full' is only needed when the
+        statistics they're calculated from have to be rebuilt.  Either way,
+        every process rebuilds the neighbor index personalized
+        recommendations are scored from afterwards, in case a change was
+        missed.
         """
+        from channelguide.recommendations import neighbors
         from channelguide.recommendations.models import Similarity
-        if len(args) > 2 and args[2] == 'full':
+        if 'full' in args:
             Similarity.objects.recalculate_all()
         else:
-            Similarity.objects.recalculate_recent()
+            neighbors.invalidate()
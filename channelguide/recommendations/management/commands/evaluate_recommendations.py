@@ -0,0 +1,80 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+from channelguide.recommendations import evaluation
+
+class Command(NoArgsCommand):
+    """
+    Hide some of the ratings, predict them with each recommendation engine
+    from similarities built without them, and print how close the
+    predictions were and how long and how much memory each phase took.
+    The ratings come from the database unless --generate or --dataset is
+    given; --save keeps them in a SQLite file for --dataset to use later.
+    """
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dataset', help='Read the ratings from this SQLite '
+                    'file'),
+        make_option('--generate', action='store_true', default=False,
+                    help='Make up the ratings instead'),
+        make_option('--users', type='int', default=500,
+                    help='Users to generate'),
+        make_option('--channels', type='int', default=200,
+                    help='Channels to generate'),
+        make_option('--ratings-per-user', type='int', default=15,
+                    dest='ratings_per_user',
+                    help='Average ratings per generated user'),
+        make_option('--save', help='Write the ratings to this SQLite file'),
+        make_option('--engines', help='Comma-separated engines to run (%s)'
+                    % ', '.join([name for name, engine in
+                                 evaluation.ENGINES])),
+        make_option('--test-fraction', type='float', default=0.5,
+                    dest='test_fraction',
+                    help='Fraction of the users to hide ratings of'),
+        make_option('--seed', type='int', default=0,
+                    help='Random seed for the split and generated data'),)
+
+    def get_engines(self, names):
+        engines = dict(evaluation.ENGINES)
+        if not names:
+            return evaluation.ENGINES
+        selected = []
+        for name in names.split(','):
+            if name not in engines:
+                raise CommandError('unknown engine: %s' % name)
+            selected.append((name, engines[name]))
+        return selected
+
+    def handle_noargs(self, **options):
+        engines = self.get_engines(options['engines'])
+        timer = evaluation.Timer()
+        if options['dataset']:
+            dataset = timer.run('load', evaluation.Dataset.load,
+                                options['dataset'])
+        elif options['generate']:
+            dataset = timer.run('load', evaluation.Dataset.generate,
+                                options['users'], options['channels'],
+                                options['ratings_per_user'], options['seed'])
+        else:
+            dataset = timer.run('load', evaluation.Dataset.from_database)
+        if options['save']:
+            timer.run('save', dataset.save, options['save'])
+        holdout = timer.run('split', evaluation.split, dataset,
+                            options['test_fraction'], options['seed'])
+        print '%i ratings, %i test users, %i hidden' % (
+            len(dataset), len(holdout.tests), holdout.hidden_count())
+        results, timer = evaluation.evaluate(dataset, holdout, engines,
+                                             timer)
+        print
+        print '%-20s %10s %10s' % ('engine', 'RMSE', 'coverage')
+        for name, rmse, coverage in results:
+            if rmse is None:
+                rmse = '-'
+            else:
+                rmse = '%.4f' % rmse
+            print '%-20s %10s %9.1f%%' % (name, rmse, coverage * 100)
+        print
+        print '%-20s %10s %12s' % ('phase', 'seconds', 'peak RSS KB')
+        for name, seconds, memory in timer.phases:
+            print '%-20s %10.3f %12i' % (name, seconds, memory)
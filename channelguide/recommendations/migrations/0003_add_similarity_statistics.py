@@ -0,0 +1,149 @@
+
+from south.db import db
+from django.db import models
+from channelguide.recommendations.models import *
+
+class Migration:
+    
+    def forwards(self, orm):
+        
+        # Adding model 'SimilarityStatistics'
+        db.create_table('cg_channel_recommendation_statistics', (
+            ('id', orm['recommendations.SimilarityStatistics:id']),
+            ('channel1', orm['recommendations.SimilarityStatistics:channel1']),
+            ('channel2', orm['recommendations.SimilarityStatistics:channel2']),
+            ('raters', orm['recommendations.SimilarityStatistics:raters']),
+            ('count', orm['recommendations.SimilarityStatistics:count']),
+            ('sum1', orm['recommendations.SimilarityStatistics:sum1']),
+            ('sum2', orm['recommendations.SimilarityStatistics:sum2']),
+            ('squares1', orm['recommendations.SimilarityStatistics:squares1']),
+            ('squares2', orm['recommendations.SimilarityStatistics:squares2']),
+            ('products', orm['recommendations.SimilarityStatistics:products']),
+        ))
+        db.send_create_signal('recommendations', ['SimilarityStatistics'])
+        
+        # Creating unique_together for [channel1, channel2] on SimilarityStatistics.
+        db.create_unique('cg_channel_recommendation_statistics', ['channel1_id', 'channel2_id'])
+        
+        # the statistics have to be filled in once, with
+        # "manage.py calculate_recommendations full"
+    
+    
+    def backwards(self, orm):
+        
+        # Deleting unique_together for [channel1, channel2] on SimilarityStatistics.
+        db.delete_unique('cg_channel_recommendation_statistics', ['channel1_id', 'channel2_id'])
+        
+        # Deleting model 'SimilarityStatistics'
+        db.delete_table('cg_channel_recommendation_statistics')
+        
+    
+    
+    models = {
+        'labels.language': {
+            'Meta': {'db_table': "'cg_channel_language'"},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        },
+        'auth.user': {
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(2009, 7, 22, 15, 53, 29, 847282)'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True', 'blank': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(2009, 7, 22, 15, 53, 29, 847156)'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'labels.tag': {
+            'Meta': {'db_table': "'cg_tag'"},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        },
+        'auth.permission': {
+            'Meta': {'unique_together': "(('content_type', 'codename'),)"},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'unique_together': "(('app_label', 'model'),)", 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'channels.channel': {
+            'Meta': {'db_table': "'cg_channel'"},
+            'adult': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'approved_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'archived': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'categories': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['labels.Category']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'featured': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'featured_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'featured_by': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'featured_set'", 'null': 'True', 'to': "orm['auth.User']"}),
+            'feed_etag': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'feed_modified': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'geoip': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100'}),
+            'hi_def': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'language': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'channels'", 'db_column': "'primary_language_id'", 'to': "orm['labels.Language']"}),
+            'last_moderated_by': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'last_moderated_set'", 'null': 'True', 'to': "orm['auth.User']"}),
+            'license': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '40'}),
+            'moderator_shared_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'moderator_shared_by': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'moderator_shared_set'", 'null': 'True', 'to': "orm['auth.User']"}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'owner': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'channels'", 'to': "orm['auth.User']"}),
+            'postal_code': ('django.db.models.fields.CharField', [], {'max_length': '15'}),
+            'publisher': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'state': ('django.db.models.fields.CharField', [], {'default': "'N'", 'max_length': '1'}),
+            'tags': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['labels.Tag']"}),
+            'thumbnail_extension': ('django.db.models.fields.CharField', [], {'default': 'None', 'max_length': '8', 'null': 'True'}),
+            'url': ('django.db.models.fields.URLField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'waiting_for_reply_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'was_featured': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'website_url': ('django.db.models.fields.URLField', [], {'max_length': '255'})
+        },
+        'recommendations.similarity': {
+            'Meta': {'db_table': "u'cg_channel_recommendations'"},
+            'channel1': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['channels.Channel']"}),
+            'channel2': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'similarity2_set'", 'to': "orm['channels.Channel']"}),
+            'cosine': ('django.db.models.fields.FloatField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'recommendations.similaritystatistics': {
+            'Meta': {'unique_together': "[('channel1', 'channel2')]", 'db_table': "'cg_channel_recommendation_statistics'"},
+            'channel1': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'similarity_statistics1_set'", 'to': "orm['channels.Channel']"}),
+            'channel2': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'similarity_statistics2_set'", 'to': "orm['channels.Channel']"}),
+            'count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'products': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'raters': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'squares1': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'squares2': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'sum1': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'sum2': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        },
+        'labels.category': {
+            'Meta': {'db_table': "'cg_category'"},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'on_frontpage': ('django.db.models.fields.BooleanField', [], {'default': 'True', 'blank': 'True'})
+        },
+        'auth.group': {
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'blank': 'True'})
+        }
+    }
+    
+    complete_apps = ['recommendations']
@@ -1,56 +1,99 @@
-from datetime import datetime, timedelta
+from django.db import connection, models, transaction
+from django.db.models import F
+from django.db.models import signals
 
-from django.db import models
-
-from channelguide.channels.models import Channel
+from channelguide.channels.models import AddedChannel
 from channelguide.ratings.models import Rating
 
-from channelguide.recommendations import utils
+from channelguide.recommendations import neighbors, store, utils
 
-class SimilarityManager(models.Manager):
+# rows in each INSERT statement
+INSERT_BATCH_SIZE = 1000
+
+def replace_table(model, fields, rows):
+    """
+    Replace everything in a model's table with rows of values for fields,
+    using a DELETE and batched INSERTs.
+    """
+    qn = connection.ops.quote_name
+    opts = model._meta
+    table = qn(opts.db_table)
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        table, ', '.join([qn(opts.get_field(name).column)
+                          for name in fields]),
+        ', '.join(['%s'] * len(fields)))
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s' % table)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == INSERT_BATCH_SIZE:
+            cursor.executemany(sql, batch)
+            batch = []
+    if batch:
+        cursor.executemany(sql, batch)
+    transaction.set_dirty()
 
-    def calculate(self, channel1, channel2):
-        if channel2.pk < channel1.pk:
-            # channel1 always has the lower id
-            channel1, channel2 = channel2, channel1
-        try:
-            similarity = self.get(channel1=channel1,
-                                  channel2=channel2)
-        except self.model.DoesNotExist:
-            similarity = self.create(
-                channel1=channel1,
-                channel2=channel2,
-                cosine = utils.get_similarity(channel1, channel2))
-
-        return similarity.cosine
+class SimilarityManager(models.Manager):
 
     def recalculate_all(self):
-        self.all().delete()
-        for channel1 in Channel.objects.approved():
-            for channel2 in utils.find_relevant_similar(channel1):
-                self.calculate(channel1, channel2)
-
-    def recalculate_recent(self):
-        for channel1_id in Rating.objects.filter(
-            timestamp__gt=(datetime.now()-timedelta(days=1)),
-            channel__state=Channel.APPROVED).values_list('channel',
-                                                         flat=True).distinct():
-            channel1 = Channel.objects.get(pk=channel1_id)
-            for channel2_id in utils.find_relevant_similar(channel1):
-                channel2 = Channel.objects.get(pk=channel2_id)
-                self.filter(channel1=channel1,
-                                          channel2=channel2).delete()
-                self.filter(channel1=channel2,
-                                          channel2=channel1).delete()
-                self.calculate(channel1, channel2)
+        """
+        Replace every similarity, and the statistics they come from,
+        computed all at once with utils.SimilarityMatrix.  Every process's
+        neighbor index is rebuilt once they're committed.
+        """
+        self._replace_all()
+        neighbors.invalidate()
+
+    @transaction.commit_on_success
+    def _replace_all(self):
+        matrix = utils.SimilarityMatrix()
+        statistics = matrix.pair_statistics()
+        replace_table(SimilarityStatistics,
+                      ('channel1', 'channel2') + SimilarityStatistics.SUMS,
+                      [pair + tuple(sums)
+                       for pair, sums in statistics.iteritems()])
+        replace_table(self.model, ('channel1', 'channel2', 'cosine'),
+                      matrix.similarities(statistics))
+
+    def refresh(self, channel_id, other_ids):
+        """
+        Recalculate the similarities between a channel and some others from
+        their SimilarityStatistics, and note the change for the neighbor
+        indexes.
+        """
+        approved, languages, categories = utils.load_channel_data(
+            [channel_id] + list(other_ids))
+        statistics = SimilarityStatistics.objects.filter(
+            models.Q(channel1=channel_id, channel2__in=other_ids) |
+            models.Q(channel2=channel_id, channel1__in=other_ids))
+        statistics = dict(((s.channel1_id, s.channel2_id), s)
+                          for s in statistics)
+        for other_id in other_ids:
+            pair = (min(channel_id, other_id), max(channel_id, other_id))
+            similarities = self.filter(channel1=pair[0], channel2=pair[1])
+            stats = statistics.get(pair)
+            if stats is None or stats.raters <= 0:
+                # nobody has rated both any more
+                if stats is not None:
+                    stats.delete()
+                similarities.delete()
+            elif pair[0] not in approved and pair[1] not in approved:
+                similarities.delete()
+            else:
+                cosine = utils.similarity_from_sums(
+                    stats.sums(), languages.get(pair[0]),
+                    languages.get(pair[1]), categories.get(pair[0], set()),
+                    categories.get(pair[1], set()))
+                if not similarities.update(cosine=cosine):
+                    self.create(channel1_id=pair[0], channel2_id=pair[1],
+                                cosine=cosine)
+        neighbors.note_changed([channel_id] + list(other_ids))
 
     def recommend_from_ratings(self, ratings):
         ratings_dict = dict((r.channel_id, r.rating) for r in ratings)
-        recommendations = self.filter(
-            models.Q(channel1__in=ratings_dict.keys()) |
-            models.Q(channel2__in=ratings_dict.keys()))
-        scores, numScores, topThree = utils.calculate_scores(recommendations,
-                                                             ratings_dict)
+        scores, numScores, topThree = utils.calculate_neighbor_scores(
+            neighbors.get_index(), ratings_dict)
         return utils.filter_scores(scores, numScores), topThree
 
 class Similarity(models.Model):
@@ -63,3 +106,110 @@ class Similarity(models.Model):
 
     class Meta:
         db_table = u'cg_channel_recommendations'
+
+def rating_sums(rating1, rating2):
+    """What one user's ratings of two channels add to their
+    SimilarityStatistics, other than raters."""
+    if not rating1 or not rating2:
+        return (0, 0, 0, 0, 0, 0)
+    return (1, rating1, rating2, rating1 ** 2, rating2 ** 2,
+            rating1 * rating2)
+
+class SimilarityStatisticsManager(models.Manager):
+
+    def rating_changed(self, user_id, channel_id, old, new, raters=0):
+        """
+        Update the statistics for the channels the user has rated along
+        with channel_id, when their rating of it changes from old to new
+        (either can be None).  raters is 1 if the user hadn't rated the
+        channel before and -1 if the rating was deleted.  Then the
+        similarities for those pairs are recalculated.
+        """
+        changed = []
+        for other_id, other in Rating.objects.filter(user=user_id).exclude(
+            channel=channel_id).values_list('channel', 'rating'):
+            if channel_id < other_id:
+                pair = (channel_id, other_id)
+                new_sums = rating_sums(new, other)
+                old_sums = rating_sums(old, other)
+            else:
+                pair = (other_id, channel_id)
+                new_sums = rating_sums(other, new)
+                old_sums = rating_sums(other, old)
+            deltas = [raters] + [new_sum - old_sum for new_sum, old_sum
+                                 in zip(new_sums, old_sums)]
+            if not [delta for delta in deltas if delta]:
+                continue
+            if not self.filter(channel1=pair[0], channel2=pair[1]).update(
+                **dict((name, F(name) + delta)
+                       for name, delta in zip(self.model.SUMS, deltas))):
+                self.create(channel1_id=pair[0], channel2_id=pair[1],
+                            **dict(zip(self.model.SUMS, deltas)))
+            changed.append(other_id)
+        if changed:
+            Similarity.objects.refresh(channel_id, changed)
+
+class SimilarityStatistics(models.Model):
+    """
+    The sums the rating part of the similarity between two channels comes
+    from (see utils.SimilarityMatrix.pair_statistics), kept up to date as
+    ratings change so that the similarity can be recalculated without
+    looking at every rating.  channel1 has the lower id.
+    """
+    channel1 = models.ForeignKey('channels.Channel',
+                                 related_name='similarity_statistics1_set')
+    channel2 = models.ForeignKey('channels.Channel',
+                                 related_name='similarity_statistics2_set')
+    raters = models.IntegerField(default=0)
+    count = models.IntegerField(default=0)
+    sum1 = models.IntegerField(default=0)
+    sum2 = models.IntegerField(default=0)
+    squares1 = models.IntegerField(default=0)
+    squares2 = models.IntegerField(default=0)
+    products = models.IntegerField(default=0)
+
+    objects = SimilarityStatisticsManager()
+
+    SUMS = ('raters', 'count', 'sum1', 'sum2', 'squares1', 'squares2',
+            'products')
+
+    class Meta:
+        db_table = 'cg_channel_recommendation_statistics'
+        unique_together = [('channel1', 'channel2')]
+
+    def sums(self):
+        """The utils.pearson_from_sums() arguments."""
+        return (self.count, self.sum1, self.sum2, self.squares1,
+                self.squares2, self.products)
+
+def pre_rating_save(instance=None, **kwargs):
+    # remember the rating it's replacing
+    instance._previous_ratings = list(Rating.objects.filter(
+            channel=instance.channel_id, user=instance.user_id).values_list(
+            'rating', flat=True))
+
+def post_rating_save(instance=None, **kwargs):
+    previous = getattr(instance, '_previous_ratings', [])
+    if not previous:
+        SimilarityStatistics.objects.rating_changed(
+            instance.user_id, instance.channel_id, None, instance.rating, 1)
+    elif previous[0] != instance.rating:
+        SimilarityStatistics.objects.rating_changed(
+            instance.user_id, instance.channel_id, previous[0],
+            instance.rating)
+    store.bump(instance.user_id)
+
+def post_rating_delete(instance=None, **kwargs):
+    SimilarityStatistics.objects.rating_changed(
+        instance.user_id, instance.channel_id, instance.rating, None, -1)
+    store.bump(instance.user_id)
+
+signals.pre_save.connect(pre_rating_save, sender=Rating)
+signals.post_save.connect(post_rating_save, sender=Rating)
+signals.post_delete.connect(post_rating_delete, sender=Rating)
+
+def added_channel_changed(instance=None, **kwargs):
+    store.bump(instance.user_id)
+
+signals.post_save.connect(added_channel_changed, sender=AddedChannel)
+signals.post_delete.connect(added_channel_changed, sender=AddedChannel)
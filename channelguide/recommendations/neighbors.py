@@ -0,0 +1,303 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+"""The most similar channels to each channel, for scoring recommendations.
+
+Scoring a user's recommendations only needs the strongest similarities of
+the channels they've rated, so instead of querying every similarity those
+channels have, NeighborIndex keeps the NEIGHBORS strongest ones for each
+channel (ignoring any weaker than MIN_SIMILARITY) in packed arrays.
+
+Each process builds its own index from the similarity table; it's too big
+to share through memcached.  As ratings change the similarities,
+note_changed() bumps a version counter in the cache and stores the ids of
+the channels whose similarities changed under the new version, the way
+search.suggest does.  The process which made the change updates its index
+straight away, and the others look at the counter every CHECK_INTERVAL
+seconds and load the neighbors of just the channels which changed.  When
+they're too far behind, or invalidate() says everything changed (after
+calculate_recommendations, which cron runs), a new index is built in a
+thread while the old one is used; only a process's first index is built
+during a request.  With settings.RECOMMENDATION_REBUILD_THREAD off, which
+the tests use, it's built straight away instead.
+"""
+
+import heapq
+import logging
+import threading
+import time
+from array import array
+
+from django.conf import settings
+from django.core import cache
+from django.db import connection, models
+
+NEIGHBORS = getattr(settings, 'RECOMMENDATION_NEIGHBORS', 50)
+MIN_SIMILARITY = getattr(settings, 'RECOMMENDATION_MIN_SIMILARITY', 0.01)
+REBUILD_THREAD = getattr(settings, 'RECOMMENDATION_REBUILD_THREAD', True)
+# how long a process uses its index before checking for changes
+CHECK_INTERVAL = 5
+# a process more changes behind than this builds the whole index again
+MAX_CHANGES = 200
+
+VERSION_KEY = 'recommendations:version'
+
+def changed_key(version):
+    return 'recommendations:changed:%i' % version
+
+def strongest(similarities, size, threshold, channel_ids=None):
+    """
+    Return a dictionary mapping channel ids to lists of (strength, other
+    channel id, similarity) for their size strongest similarities,
+    strongest first.  similarities is an iterable of (channel1 id, channel2
+    id, similarity); if a pair is in it more than once, the last one counts.
+    Only the channels with the given ids are included, if it's given.
+    """
+    pairs = {}
+    for channel1, channel2, similarity in similarities:
+        pairs[min(channel1, channel2), max(channel1, channel2)] = \
+            similarity
+    candidates = {}
+    for (channel1, channel2), similarity in pairs.iteritems():
+        if abs(similarity) < threshold:
+            continue
+        for channel, other in ((channel1, channel2),
+                               (channel2, channel1)):
+            if channel_ids is not None and channel not in channel_ids:
+                continue
+            heap = candidates.setdefault(channel, [])
+            entry = (abs(similarity), other, similarity)
+            if len(heap) < size:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+    for heap in candidates.itervalues():
+        heap.sort(reverse=True)
+    return candidates
+
+class NeighborIndex(object):
+    """
+    For each channel, the ids of its most similar channels and their
+    similarities, strongest (by absolute value) first.  update() replaces
+    some channels' neighbors in place; the old ones are left in the arrays
+    until there are as many of them as there are current ones, and then
+    the arrays are packed again.  neighbors() works while another thread
+    updates it, and sees the neighbors from before or after the update.
+    """
+    def __init__(self, similarities, size=NEIGHBORS,
+                 threshold=MIN_SIMILARITY):
+        """similarities is an iterable of (channel1 id, channel2 id,
+        similarity).  If a pair is in it more than once, the last one
+        counts.
+        """
+        self.size = size
+        self.threshold = threshold
+        # channel id -> (start, end), ids, similarities; replaced all at
+        # once when they're packed
+        self.data = ({}, array('i'), array('d'))
+        self.current = 0 # entries in the arrays which are still used
+        self._store(strongest(similarities, size, threshold))
+
+    def _store(self, candidates):
+        offsets, ids, similarities = self.data
+        for channel, heap in candidates.iteritems():
+            start = len(ids)
+            ids.extend([other for strength, other, similarity in heap])
+            similarities.extend([similarity for strength, other,
+                                 similarity in heap])
+            old_start, old_end = offsets.get(channel, (0, 0))
+            offsets[channel] = (start, len(ids))
+            self.current += len(heap) - (old_end - old_start)
+        if len(ids) > 2 * self.current + self.size:
+            self._pack()
+
+    def _pack(self):
+        offsets, ids, similarities = self.data
+        packed = ({}, array('i'), array('d'))
+        for channel, (start, end) in offsets.items():
+            if start == end:
+                continue
+            packed[0][channel] = (len(packed[1]),
+                                  len(packed[1]) + end - start)
+            packed[1].extend(ids[start:end])
+            packed[2].extend(similarities[start:end])
+        self.data = packed
+
+    def update(self, channel_ids, similarities):
+        """Replace the neighbors of the channels with the given ids.
+        similarities is an iterable of every similarity they have."""
+        channel_ids = set(channel_ids)
+        candidates = strongest(similarities, self.size, self.threshold,
+                               channel_ids)
+        for channel in channel_ids:
+            candidates.setdefault(channel, [])
+        self._store(candidates)
+
+    def neighbors(self, channel_id):
+        """Return a list of (other channel id, similarity) pairs."""
+        offsets, ids, similarities = self.data
+        try:
+            start, end = offsets[channel_id]
+        except KeyError:
+            return []
+        return zip(ids[start:end], similarities[start:end])
+
+    def __len__(self):
+        return len([1 for (start, end) in self.data[0].itervalues()
+                    if start != end])
+
+def load_similarities(channel_ids=None):
+    """Return an iterator over (channel1 id, channel2 id, similarity) for
+    every similarity in the table, or the ones of the channels with the
+    given ids."""
+    from channelguide.recommendations.models import Similarity
+    similarities = Similarity.objects.order_by('id')
+    if channel_ids is not None:
+        channel_ids = list(channel_ids)
+        similarities = similarities.filter(
+            models.Q(channel1__in=channel_ids) |
+            models.Q(channel2__in=channel_ids))
+    return similarities.values_list('channel1', 'channel2',
+                                    'cosine').iterator()
+
+def load_index():
+    """Build a NeighborIndex from the similarity table."""
+    return NeighborIndex(load_similarities())
+
+def get_version():
+    """Return the current version of the similarities, starting one if
+    there isn't one."""
+    version = cache.cache.get(VERSION_KEY)
+    if version is None:
+        # from the time, so that a counter which was evicted doesn't come
+        # back with a version some process already has
+        cache.cache.add(VERSION_KEY, int(time.time() * 1000))
+        version = cache.cache.get(VERSION_KEY)
+    return version
+
+_lock = threading.Lock()
+_index = None
+_version = None
+_checked = 0
+_rebuilding = False
+# the channels loaded at the last check, which are loaded again at the next
+# one in case their changes hadn't been committed yet
+_recent = set()
+
+def note_changed(channel_ids=None):
+    """Note that the similarities of the channels with the given ids (or
+    all of them, if it's None) have changed."""
+    global _checked
+    if channel_ids is not None:
+        channel_ids = list(channel_ids)
+    try:
+        version = cache.cache.incr(VERSION_KEY)
+    except ValueError:
+        pass # there's no version, so every process will rebuild its index
+    else:
+        cache.cache.set(changed_key(version), channel_ids)
+    if _index is None:
+        return
+    if channel_ids is None:
+        _checked = 0 # so that the next get_index() rebuilds it
+        return
+    # this process sees its own changes straight away
+    _lock.acquire()
+    try:
+        _index.update(channel_ids, load_similarities(channel_ids))
+    finally:
+        _lock.release()
+
+def invalidate():
+    """Note that every similarity might have changed, so that every
+    process builds its index again."""
+    note_changed(None)
+
+def _rebuild(version):
+    """Build a new index and use it from now on, with the changes noted
+    since version still to be loaded."""
+    global _index, _version, _rebuilding, _recent
+    try:
+        index = load_index()
+        _lock.acquire()
+        try:
+            _index = index
+            _version = version
+            _recent = set()
+        finally:
+            _lock.release()
+    finally:
+        _rebuilding = False
+
+def _rebuild_in_thread(version):
+    try:
+        _rebuild(version)
+    except:
+        logging.exception('error building the neighbor index')
+    # the thread's own connection, which would otherwise sit idle until the
+    # database drops it
+    connection.close()
+
+def get_index():
+    """
+    Return this process's NeighborIndex, brought up to date if it hasn't
+    been checked for CHECK_INTERVAL seconds.  Only the first one is built
+    while the request waits.
+    """
+    global _version, _checked, _rebuilding, _recent
+    now = time.time()
+    if _index is not None and now - _checked < CHECK_INTERVAL:
+        return _index
+    if _index is None:
+        version = get_version()
+        _rebuilding = True
+        _rebuild(version)
+        _checked = now
+        return _index
+    if not _lock.acquire(False):
+        return _index # someone else is checking
+    try:
+        version = get_version()
+        behind = version - _version
+        changed = None
+        if 0 <= behind <= MAX_CHANGES:
+            changed = cache.cache.get_many([
+                    changed_key(v) for v in range(_version + 1,
+                                                  version + 1)])
+            if len(changed) < behind or None in changed.values():
+                changed = None # some were evicted, or it all changed
+        if changed is None:
+            if not _rebuilding:
+                _rebuilding = True
+                if REBUILD_THREAD:
+                    thread = threading.Thread(target=_rebuild_in_thread,
+                                              args=(version,))
+                    thread.setDaemon(True)
+                    thread.start()
+                else:
+                    _lock.release()
+                    try:
+                        _rebuild(version)
+                    finally:
+                        _lock.acquire()
+        else:
+            channel_ids = set()
+            for ids in changed.values():
+                channel_ids.update(ids)
+            if channel_ids or _recent:
+                _index.update(channel_ids | _recent,
+                              load_similarities(channel_ids | _recent))
+            _recent = channel_ids
+            _version = version
+        _checked = now
+        return _index
+    finally:
+        _lock.release()
+
+def reset():
+    """Forget this process's index; the next get_index() builds it
+    again."""
+    global _index, _version, _checked, _recent
+    _index = _version = None
+    _checked = 0
+    _recent = set()
@@ -0,0 +1,86 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+"""Each user's recommendations, worked out once and kept in the cache.
+
+A user's recommendations only change when they rate a channel or add one,
+so they're stored under a version number for the user which the rating and
+AddedChannel signal handlers in recommendations.models bump.  Finding out
+whether the stored recommendations are still good is one cache get, with
+no queries.
+"""
+
+import operator
+import time
+
+from django.core import cache
+
+MIN_SCORE = 3.25 # recommend channels we guess they'd rate at least this
+MAX_RECOMMENDATIONS = 99
+
+class Recommendations(object):
+    """
+    ids is the list of recommended channel ids, best first, scores maps
+    them to the rating we guess the user would give and reasons maps them to
+    lists of up to three (score, rated channel id), lowest score first.
+    """
+    def __init__(self, ids, scores, reasons):
+        self.ids = ids
+        self.scores = scores
+        self.reasons = reasons
+
+    def __len__(self):
+        return len(self.ids)
+
+def version_key(user_id):
+    return 'recommendations:version:%i' % user_id
+
+def recommendations_key(user_id, version):
+    return 'recommendations:user:%i:%s' % (user_id, version)
+
+def get_version(user_id):
+    """Return the user's current version, starting one if they haven't got
+    one."""
+    key = version_key(user_id)
+    version = cache.cache.get(key)
+    if version is None:
+        # start from the time rather than 0, so a counter which was evicted
+        # doesn't come back with a version some old recommendations used.
+        # add() so that processes racing to start it agree on it.
+        cache.cache.add(key, int(time.time() * 1000))
+        version = cache.cache.get(key)
+    return version
+
+def bump(user_id):
+    """Note that the user's recommendations have changed."""
+    try:
+        cache.cache.incr(version_key(user_id))
+    except ValueError:
+        pass # there's no version yet, so nothing has been stored under it
+
+def calculate(user_id):
+    """Work out a user's Recommendations from their ratings."""
+    from channelguide.channels.models import AddedChannel
+    from channelguide.ratings.models import Rating
+    from channelguide.recommendations.models import Similarity
+    ratings = Rating.objects.filter(user=user_id)
+    scores, reasons = Similarity.objects.recommend_from_ratings(ratings)
+    added = set(AddedChannel.objects.filter(user=user_id).values_list(
+            'channel', flat=True))
+    ranked = sorted(scores.items(), key=operator.itemgetter(1),
+                    reverse=True)
+    ids = [id for (id, score) in ranked
+           if score >= MIN_SCORE and id not in added][:MAX_RECOMMENDATIONS]
+    return Recommendations(
+        ids, dict((id, scores[id]) for id in ids),
+        dict((id, reasons[id][-3:]) for id in ids if id in reasons))
+
+def get_recommendations(user_id):
+    """Return the user's Recommendations, calculating them if the stored
+    ones are out of date."""
+    key = recommendations_key(user_id, get_version(user_id))
+    recommendations = cache.cache.get(key)
+    if recommendations is None:
+        recommendations = calculate(user_id)
+        cache.cache.set(key, recommendations)
+    return recommendations
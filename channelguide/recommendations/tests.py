@@ -4,14 +4,19 @@
 
 from datetime import datetime, timedelta
 import math
+import os
+import tempfile
 
+from django.core import cache
 from django.core.management import call_command
 
+from channelguide.labels.models import Category
 from channelguide.ratings.models import Rating
 from channelguide.subscriptions.models import Subscription
-from channelguide.recommendations.models import Similarity
+from channelguide.recommendations.models import (Similarity,
+                                                 SimilarityStatistics)
 from channelguide.testframework import TestCase
-from channelguide.recommendations import utils
+from channelguide.recommendations import evaluation, neighbors, store, utils
 
 cos45 = float('%6f' % math.cos(math.radians(45)))
 
@@ -192,37 +197,6 @@ class ChannelRecommendationsTest(RecommendationsTestBase):
         self.assertEquals(utils.get_similarity_from_subscriptions(c4,
             c5.id), 0)
 
-    def get_recommendation_from_database(self, channel1, channel2,
-                                         returnOne=True):
-        if returnOne:
-            method = Similarity.objects.get
-        else:
-            method = Similarity.objects.filter
-
-        return method(channel1=channel1,
-                      channel2=channel2)
-
-    def insert_recommendations(self):
-        """
-        Insert some dummy recommendations into the database.
-        """
-        c0, c1, c2 = self.channels[:3]
-        Similarity.objects.all().delete()
-        Similarity.objects.calculate(c0, c1)
-        Similarity.objects.calculate(c1, c2)
-
-    def test_insert_similarity(self):
-        """
-        insert_similarity should add a new row to the recommendations
-        table.  It should keep the first channel id lower than the second
-        channel id.
-        """
-        c0, c1, c2 = self.channels[:3]
-        Similarity.objects.calculate(c0, c1)
-        self.assertTrue(self.get_recommendation_from_database(c0, c1))
-        Similarity.objects.calculate(c2, c1)
-        self.assertTrue(self.get_recommendation_from_database(c1, c2))
-
     def test_find_relevant_similar_subscription(self):
         """
         find_relevant_similar when given an IP address should return the other
@@ -259,8 +233,8 @@ class ChannelRecommendationsTest(RecommendationsTestBase):
 
     def test_calculation(self):
         """
-        manage.calculate_recommendations should update the
-        recommendations table.
+        The ratings should have kept the recommendations table up to date,
+        which manage.calculate_recommendations leaves as it is.
         """
         c0, c1, c2, c3, c4 = self.channels[:5]
         call_command('calculate_recommendations')
@@ -278,6 +252,74 @@ class ChannelRecommendationsTest(RecommendationsTestBase):
                         ))
         self.assertEquals(rows, check)
 
+    def test_recalculate_all(self):
+        """
+        recalculate_all should find the same pairs and similarities as
+        calculating each pair separately.
+        """
+        category = Category.objects.create(name='Foo')
+        self.channels[2].categories.add(category)
+        self.channels[3].categories.add(category)
+        # a pair with an unapproved channel and an empty rating
+        Rating.objects.create(channel=self.channels[10], user=self.users[0])
+        Similarity.objects.recalculate_all()
+        rows = self.get_similarities()
+        pairs = set()
+        for channel in self.channels:
+            if channel.state != 'A':
+                continue
+            for other_id in utils.find_relevant_similar(channel):
+                pairs.add((min(channel.id, other_id),
+                           max(channel.id, other_id)))
+        self.assertEquals(set(rows), pairs)
+        channels = dict((channel.id, channel) for channel in self.channels)
+        for (channel1, channel2), cosine in rows.items():
+            self.assertAlmostEquals(cosine, utils.get_similarity(
+                    channels[channel1], channels[channel2]))
+
+    def get_statistics(self):
+        return sorted(SimilarityStatistics.objects.values_list(
+                'channel1', 'channel2', *SimilarityStatistics.SUMS))
+
+    def assertSameAsRecalculated(self):
+        similarities = self.get_similarities()
+        statistics = self.get_statistics()
+        Similarity.objects.recalculate_all()
+        self.assertEquals(statistics, self.get_statistics())
+        recalculated = self.get_similarities()
+        self.assertEquals(set(similarities), set(recalculated))
+        for pair, cosine in similarities.items():
+            self.assertAlmostEquals(cosine, recalculated[pair])
+
+    def get_similarities(self):
+        return dict(((channel1, channel2), cosine)
+                    for channel1, channel2, cosine in
+                    Similarity.objects.values_list('channel1', 'channel2',
+                                                   'cosine'))
+
+    def test_rating_changes_update_similarities(self):
+        """
+        Adding, changing and deleting ratings should keep the statistics and
+        similarities the same as recalculating them all.
+        """
+        self.assertSameAsRecalculated()
+        rating = Rating.objects.get(user=self.users[0],
+                                    channel=self.channels[1])
+        rating.rating = 5
+        rating.save()
+        self.assertSameAsRecalculated()
+        Rating.objects.get(user=self.users[2],
+                           channel=self.channels[0]).delete()
+        self.assertSameAsRecalculated()
+        Rating.objects.create(user=self.users[4], channel=self.channels[6],
+                              rating=4)
+        rating = Rating.objects.create(user=self.users[3],
+                                       channel=self.channels[6])
+        self.assertSameAsRecalculated()
+        rating.rating = 2
+        rating.save()
+        self.assertSameAsRecalculated()
+
 class PersonalizedRecommendationsTest(RecommendationsTestBase):
 
     def setUp(self):
@@ -295,6 +337,7 @@ class PersonalizedRecommendationsTest(RecommendationsTestBase):
                 channel1_id=row[0],
                 channel2_id=row[1],
                 cosine=row[2])
+        neighbors.invalidate()
 
     def test_calculate_scores(self):
         ratings = [
@@ -319,3 +362,152 @@ class PersonalizedRecommendationsTest(RecommendationsTestBase):
                 [(0.5 * 0.2, self.channels[4].id),
                     (2.5 * 0.6, self.channels[0].id)],
             })
+
+    def test_index_rebuilt_on_invalidate(self):
+        """
+        Rating a channel should update the neighbor index instead of
+        rebuilding it, but invalidate() should rebuild it.
+        """
+        index = neighbors.get_index()
+        rating = Rating.objects.get(user=self.users[0],
+                                    channel=self.channels[0])
+        rating.rating = 1
+        rating.save()
+        self.assert_(neighbors.get_index() is index)
+        self.assertEquals(index.neighbors(self.channels[0].id),
+                          neighbors.load_index().neighbors(
+                self.channels[0].id))
+        neighbors.invalidate()
+        self.assert_(neighbors.get_index() is not index)
+
+    def test_index_sees_other_changes(self):
+        """
+        The index should load the channels another process noted changes
+        for when it next checks.
+        """
+        index = neighbors.get_index()
+        first, second = self.channels[0].id, self.channels[1].id
+        Similarity.objects.filter(channel1=first, channel2=second).update(
+            cosine=-0.7)
+        version = cache.cache.incr(neighbors.VERSION_KEY)
+        cache.cache.set(neighbors.changed_key(version), [first, second])
+        self.assertEquals(index.neighbors(second)[0], (first, 0.5))
+        neighbors._checked = 0
+        self.assert_(neighbors.get_index() is index)
+        self.assertEquals(index.neighbors(second)[0], (first, -0.7))
+        self.assert_((second, -0.7) in index.neighbors(first))
+
+    def test_store_version(self):
+        """
+        Rating a channel should change the version the user's stored
+        recommendations are kept under.
+        """
+        user = self.users[0]
+        version = store.get_version(user.id)
+        self.assertEquals(store.get_version(user.id), version)
+        rating = Rating.objects.get(user=user, channel=self.channels[0])
+        rating.rating = 5
+        rating.save()
+        self.assertNotEquals(store.get_version(user.id), version)
+
+class NeighborIndexTest(TestCase):
+
+    def test_keeps_strongest(self):
+        """
+        The index should keep the strongest similarities for each channel,
+        in both directions, and drop the ones under the threshold.
+        """
+        index = neighbors.NeighborIndex([
+                (1, 2, 0.5), (1, 3, -0.9), (1, 4, 0.1), (1, 5, 0.001),
+                (2, 3, 0.3), (1, 2, 0.6)], size=2, threshold=0.01)
+        self.assertEquals(index.neighbors(1), [(3, -0.9), (2, 0.6)])
+        self.assertEquals(index.neighbors(2), [(1, 0.6), (3, 0.3)])
+        self.assertEquals(index.neighbors(4), [(1, 0.1)])
+        self.assertEquals(index.neighbors(5), [])
+
+    def test_update(self):
+        """
+        update() should replace just the given channels' neighbors, and
+        pack the arrays once most of the entries are old ones.
+        """
+        index = neighbors.NeighborIndex([(1, 2, 0.5), (1, 3, 0.4),
+                                         (2, 3, 0.3)], size=2)
+        index.update([2], [(1, 2, -0.8), (2, 3, 0.3)])
+        self.assertEquals(index.neighbors(1), [(2, 0.5), (3, 0.4)])
+        self.assertEquals(index.neighbors(2), [(1, -0.8), (3, 0.3)])
+        index.update([3], [])
+        self.assertEquals(index.neighbors(3), [])
+        self.assertEquals(len(index), 2)
+        for i in range(10):
+            index.update([1], [(1, 2, i / 10.0)])
+        self.assertEquals(index.neighbors(1), [(2, 0.9)])
+        self.assert_(len(index.data[1]) <= 2 * 2 + 2)
+
+    def test_top_three(self):
+        """
+        Only the three highest scores should be kept as reasons.
+        """
+        index = neighbors.NeighborIndex([(i, 10, i / 10.0)
+                                         for i in range(1, 6)])
+        ratings = dict((i, 5) for i in range(1, 6))
+        scores, numScores, topThree = utils.calculate_neighbor_scores(
+            index, ratings)
+        self.assertEquals(numScores, {10: 5})
+        self.assertEquals([channel for score, channel in topThree[10]],
+                          [3, 4, 5])
+
+    def test_zero_similarities(self):
+        """
+        A channel whose similarities to the rated channels are all 0 should
+        be left out instead of dividing by 0.
+        """
+        index = neighbors.NeighborIndex([(1, 10, 0.0), (1, 11, 0.5)],
+                                        threshold=0)
+        scores, numScores, topThree = utils.calculate_neighbor_scores(
+            index, {1: 5})
+        self.assertEquals(scores, {11: 5.0})
+        self.assertEquals(numScores, {11: 1})
+        self.assertEquals(topThree.keys(), [11])
+
+class EvaluationTest(TestCase):
+
+    def test_dataset_round_trip(self):
+        dataset = evaluation.Dataset.generate(users=20, channels=10)
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            dataset.save(path)
+            loaded = evaluation.Dataset.load(path)
+        finally:
+            os.remove(path)
+        self.assertEquals(loaded.ratings, dataset.ratings)
+        self.assertEquals(loaded.approved, dataset.approved)
+        self.assertEquals(loaded.languages, dataset.languages)
+        self.assertEquals(loaded.categories, dataset.categories)
+
+    def test_evaluate(self):
+        """
+        A neighbor index which keeps every similarity should predict the
+        same as the whole table, and the hidden ratings shouldn't be used
+        for training.
+        """
+        dataset = evaluation.Dataset.generate(users=60, channels=20)
+        holdout = evaluation.split(dataset)
+        self.assertTrue(holdout.tests)
+        training = set((user, channel) for user, channel, rating in
+                       holdout.training)
+        self.assertEquals(len(training) + holdout.hidden_count(),
+                          len(dataset))
+        def everything(similarities):
+            return evaluation.NeighborEngine(similarities, size=1000,
+                                             threshold=0)
+        results, timer = evaluation.evaluate(dataset, holdout, (
+                ('table', evaluation.TableEngine),
+                ('everything', everything)))
+        (name1, rmse1, coverage1), (name2, rmse2, coverage2) = results
+        self.assertAlmostEquals(rmse1, rmse2)
+        self.assertEquals(coverage1, coverage2)
+        self.assertTrue(0 < coverage1 <= 1)
+        self.assertEquals([phase[0] for phase in timer.phases], [
+                'similarities', 'table: build', 'table: score',
+                'everything: build', 'everything: score'])
@@ -1,6 +1,7 @@
 # Copyright (c) 2008-2009 Participatory Culture Foundation
 # See LICENSE for details.
 
+import heapq
 import math
 from datetime import datetime, timedelta
 
@@ -48,10 +49,169 @@ def calculate_scores(recommendations, ratings):
                 thisTop = topThree[channel2_id]
                 thisTop.append((score, channel1_id))
                 thisTop.sort()
+    return finish_scores(scores, numScores, topThree, totalSim)
+
+
+
+def load_channel_data(channel_ids=None):
+    """
+    Return the set of approved channel ids, a dictionary mapping channel ids
+    to language ids and one mapping channel ids to sets of category ids, for
+    every channel or just the ones in channel_ids.
+    """
+    filters = {}
+    through = Channel.categories.through.objects.all()
+    if channel_ids is not None:
+        filters['pk__in'] = channel_ids
+        through = through.filter(channel__in=channel_ids)
+    approved = set(Channel.objects.approved(**filters).values_list(
+            'id', flat=True))
+    languages = dict(Channel.objects.filter(**filters).values_list(
+            'id', 'language'))
+    categories = {}
+    for channel_id, category_id in through.values_list('channel',
+                                                       'category'):
+        categories.setdefault(channel_id, set()).add(category_id)
+    return approved, languages, categories
+
+def similarity_from_sums(sums, language1, language2, categories1,
+                         categories2):
+    """
+    Return what get_similarity() would for two channels, given the
+    pearson_from_sums() arguments for their ratings and their language ids
+    and sets of category ids.
+    """
+    from_rat = pearson_from_sums(*sums)
+    if sums[0] < 5:
+        from_rat /= 2
+    if language1 == language2:
+        from_lang = 1.0
+    else:
+        from_lang = 0.0
+    if categories1 or categories2:
+        from_cat = (float(len(categories1 & categories2)) /
+                    len(categories1 | categories2))
+    else:
+        from_cat = 0.0
+    return sum((from_rat * 6, from_lang * 3, from_cat)) / 10
+
+class SimilarityMatrix(object):
+    """
+    Every channel-channel similarity at once.  The ratings, languages and
+    categories are each loaded with one query, and the rating part of each
+    similarity comes from sums collected in one pass over each user's
+    ratings, so the numbers are the same as get_similarity() gives without
+    any queries per pair.
+    """
+    def __init__(self, ratings=None, channel_data=None):
+        """ratings is an iterable of (user id, channel id, rating) and
+        channel_data is what load_channel_data() returns; each is loaded
+        from the database if it isn't given.
+        """
+        if ratings is None:
+            ratings = Rating.objects.values_list('user', 'channel', 'rating')
+        if channel_data is None:
+            channel_data = load_channel_data()
+        self.load(ratings, channel_data)
+
+    def load(self, ratings, channel_data):
+        self.approved, self.languages, self.categories = channel_data
+        self.ratings = {} # user id -> [(channel id, rating)]
+        for user_id, channel_id, rating in ratings:
+            self.ratings.setdefault(user_id, []).append((channel_id, rating))
+
+    def pair_statistics(self):
+        """
+        Return a dictionary mapping each (channel1 id, channel2 id) pair,
+        with the lower id first, which some user has rated both of to
+        [raters, count, sum1, sum2, sum of squares 1, sum of squares 2, dot
+        product].  raters is the number of users who rated both channels;
+        the rest are the pearson_from_sums() arguments, which only count
+        ratings which aren't empty or 0, as in
+        get_similarity_from_ratings().
+        """
+        statistics = {}
+        for ratings in self.ratings.values():
+            ratings.sort()
+            for i, (channel1, rating1) in enumerate(ratings):
+                for channel2, rating2 in ratings[i + 1:]:
+                    try:
+                        sums = statistics[channel1, channel2]
+                    except KeyError:
+                        sums = statistics[channel1, channel2] = [0] * 7
+                    sums[0] += 1
+                    if not rating1 or not rating2:
+                        continue
+                    sums[1] += 1
+                    sums[2] += rating1
+                    sums[3] += rating2
+                    sums[4] += rating1 ** 2
+                    sums[5] += rating2 ** 2
+                    sums[6] += rating1 * rating2
+        return statistics
+
+    def similarity(self, channel1, channel2, sums):
+        return similarity_from_sums(
+            sums, self.languages.get(channel1), self.languages.get(channel2),
+            self.categories.get(channel1, set()),
+            self.categories.get(channel2, set()))
+
+    def similarities(self, statistics=None):
+        """
+        Yield (channel1 id, channel2 id, similarity) for each pair of
+        channels which have been rated by the same user, with at least one
+        of them approved (the pairs find_relevant_similar() finds).
+        """
+        if statistics is None:
+            statistics = self.pair_statistics()
+        for (channel1, channel2), sums in statistics.items():
+            if channel1 in self.approved or channel2 in self.approved:
+                yield (channel1, channel2,
+                       self.similarity(channel1, channel2, sums[1:]))
+
+def finish_scores(scores, numScores, topThree, totalSim):
+    """
+    Turn the weighted sums of scores into averages.  Channels whose
+    similarities to the rated ones are all 0 don't say anything about them,
+    so they're left out instead of dividing by 0.
+    """
+    for id in [id for id in scores if not totalSim[id]]:
+        del scores[id]
+        del numScores[id]
+        topThree.pop(id, None)
     scores = dict((id, (scores[id] / totalSim[id]) + 2.5) for id in scores)
     return scores, numScores, topThree
 
-
+def calculate_neighbor_scores(index, ratings):
+    """
+    calculate_scores() for the neighbors in a neighbors.NeighborIndex,
+    which only looks at each rated channel's strongest similarities.  Each
+    topThree list is only the three highest scores, lowest first.
+    """
+    scores = {}
+    numScores = {}
+    totalSim = {}
+    topThree = {}
+    for channel1_id, rating in ratings.items():
+        if rating is None:
+            continue
+        for channel2_id, cosine in index.neighbors(channel1_id):
+            if channel2_id in ratings:
+                continue
+            score = cosine * (rating - 2.5)
+            scores[channel2_id] = scores.get(channel2_id, 0) + score
+            totalSim[channel2_id] = totalSim.get(channel2_id, 0) + abs(
+                cosine)
+            numScores[channel2_id] = numScores.get(channel2_id, 0) + 1
+            if rating > 2:
+                heap = topThree.setdefault(channel2_id, [])
+                if len(heap) < 3:
+                    heapq.heappush(heap, (score, channel1_id))
+                elif (score, channel1_id) > heap[0]:
+                    heapq.heapreplace(heap, (score, channel1_id))
+    for heap in topThree.values():
+        heap.sort()
+    return finish_scores(scores, numScores, topThree, totalSim)
 
 def find_relevant_similar(channel):
     #return set(
@@ -161,14 +321,15 @@ def get_similarity_from_languages(channel, other):
     return float(len(lang1 & lang2)) / len(lang1 | lang2)
 
 def pearson_coefficient(vector1, vector2):
-    n = float(len(vector1))
+    return pearson_from_sums(len(vector1), sum(vector1), sum(vector2),
+                             sum([v**2 for v in vector1]),
+                             sum([v**2 for v in vector2]),
+                             dotProduct(vector1, vector2))
+
+def pearson_from_sums(n, sum1, sum2, sq1, sq2, dp):
+    n = float(n)
     if n < 3: # two points always have a linear corelation
         return 0.0
-    sum1 = sum(vector1)
-    sum2 = sum(vector2)
-    sq1 = sum([v**2 for v in vector1])
-    sq2 = sum([v**2 for v in vector2])
-    dp = dotProduct(vector1, vector2)
     numerator = dp - (sum1*sum2/n)
     denominator = math.sqrt((sq1 - sum1**2 / n) * (sq2 - sum2**2 / n))
     if denominator == 0:
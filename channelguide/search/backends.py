@@ -0,0 +1,392 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+"""Search engines the channel search can use.
+
+settings.SEARCH_BACKEND names the class to use.  IndexBackend, the
+default, keeps its own inverted index in a SQLite file
+(settings.SEARCH_INDEX_PATH; the update_search_data command fills it), and
+the channels' items in a second one next to it
+(settings.SEARCH_ITEM_INDEX_PATH).  The files have to be on a local disk,
+so each web server has its own.  Changes aren't made to the index directly:
+ChannelSearchDataManager.update() and the Channel signal handlers in
+search.models log them as SearchChanges in the database, and before a
+search each server's index makes the ones it hasn't yet (catch_up()).  How
+far it's got is part of the key the results are cached under, so a server
+which is behind can't cache its results for the others.  MySQLBackend uses
+the MySQL full-text indexes on cg_channel_search_data instead, only works
+with MyISAM tables, and doesn't search items.
+
+A backend turns a Channel QuerySet into one with just the channels matching
+some terms, best first.  The items are logged by the items_changed handler
+in the same way, with just the items a feed update changed, so a new
+episode reaches every server's index.
+"""
+
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.encoding import force_unicode
+from django.utils.importlib import import_module
+
+from channelguide import util
+from channelguide.search.index import SearchIndex
+
+SEARCH_BACKEND = getattr(settings, 'SEARCH_BACKEND',
+                         'channelguide.search.backends.IndexBackend')
+SEARCH_INDEX_PATH = getattr(settings, 'SEARCH_INDEX_PATH', None)
+SEARCH_ITEM_INDEX_PATH = getattr(settings, 'SEARCH_ITEM_INDEX_PATH', None)
+# the most results a search returns
+MAX_RESULTS = getattr(settings, 'SEARCH_MAX_RESULTS', 1000)
+# the most matching items a search looks at to find channels by their items
+MAX_ITEM_RESULTS = getattr(settings, 'SEARCH_MAX_ITEM_RESULTS', 10000)
+# items indexed in one transaction
+ITEM_BATCH_SIZE = 500
+# the most logged changes made before one search
+CHANGE_BATCH_SIZE = 500
+# seconds a change is waited for when a later one has been logged before it
+# (one in a transaction which hadn't been committed yet); one which doesn't
+# turn up was rolled back
+GAP_TIMEOUT = 60
+# changes missing from a bigger run of ids than this were deleted by
+# SearchChangeManager.prune(), not still being committed
+MAX_GAP = 200
+
+class SearchBackend(object):
+    """The methods every backend has.  The ones which feed the backend do
+    nothing here, for backends which search the database itself."""
+
+    def update(self, channel, important_text, text):
+        """Index the channel's search data."""
+
+    def update_attributes(self, channel, names=None):
+        """Note that the channel's attributes the search can be filtered by
+        might have changed.  names is a list of the ones to check; they all
+        are if it's None."""
+
+    def remove(self, channel_id):
+        """Take a deleted channel, and its items, out of the index."""
+
+    def update_items(self, items):
+        """Index a list of new or changed Items."""
+
+    def remove_items(self, item_ids):
+        """Take deleted items out of the index."""
+
+    def clear(self):
+        """Remove everything from the index."""
+
+    def catch_up(self, limit=CHANGE_BATCH_SIZE):
+        """
+        Make up to limit of the logged SearchChanges the index hasn't, and
+        return how far it's got, for the key of the cached results.  That's
+        None for backends which search the database itself.
+        """
+
+    def make_changes(self, limit=CHANGE_BATCH_SIZE):
+        """Make up to limit of the logged changes the index hasn't, and
+        return how many there were."""
+        return 0
+
+    def skip_changes(self, position):
+        """Note that the index has the changes logged up to the one with id
+        position, as it does once it's been rebuilt from the database."""
+
+    def matching_items(self, channel_ids, terms, per_channel=3):
+        """
+        Return a dictionary mapping the ids of the given channels which have
+        items matching every one of the terms to lists of up to per_channel
+        of those items' ids, best first.
+        """
+        return {}
+
+    def search_ids(self, terms, **filters):
+        """
+        Return a list of the ids of the channels which match every one of
+        the terms, best first.  filters maps attribute names ('state',
+        'language', 'category', 'hi_def') to a value or list of values the
+        results have to have one of.
+        """
+        raise NotImplementedError
+
+    def search_channels(self, query, terms, **filters):
+        """Return the channels in query which search_ids() finds, sorted by
+        whether they're archived and then by how well they match."""
+        return order_by_ids(query, self.search_ids(terms, **filters))
+
+class MySQLBackend(SearchBackend):
+    """MATCH ... AGAINST on the cg_channel_search_data full-text indexes.
+    The filters are left to the query."""
+
+    @staticmethod
+    def search_score(terms):
+        query = ' '.join(terms)
+        important = ('(MATCH(cg_channel_search_data.important_text) '
+                     'AGAINST(%s))')
+        normal = ('MATCH(cg_channel_search_data.important_text,'
+                  'cg_channel_search_data.text) AGAINST(%s)')
+        return '(%s) * 50 + %s' % (important, normal), [query, query]
+
+    @staticmethod
+    def search_where(terms):
+        query = ' '.join(u'+%s*' % t for t in terms)
+        return ('MATCH(cg_channel_search_data.important_text,'
+                'cg_channel_search_data.text) AGAINST(%s IN BOOLEAN MODE)',
+                [query])
+
+    # filter name -> Channel lookup
+    LOOKUPS = {'state': 'state__in', 'language': 'language__in',
+               'category': 'categories__in', 'hi_def': 'hi_def__in'}
+
+    def search_ids(self, terms, **filters):
+        from channelguide.channels.models import Channel
+        query = Channel.objects.all()
+        for name, values in filters.items():
+            query = query.filter(**{self.LOOKUPS[name]:
+                                        util.ensure_list(values)})
+        sql, args = self.search_score(terms)
+        query = query.extra(select = {'search_score': sql},
+                            select_params = args)
+        sql, args = self.search_where(terms)
+        query = query.filter(search_data__text__isnull=False) # hack to join
+                                                              # the search
+                                                              # table
+        query = query.extra(where = [sql],
+                            params = args)
+        query = query.order_by().extra(order_by=['-search_score'])
+        return [id for (id, score) in
+                query.values_list('id', 'search_score')[:MAX_RESULTS]]
+
+class IndexBackend(SearchBackend):
+    """A search.index.SearchIndex of the channels, which doesn't use the
+    database at all to find the matching channels."""
+
+    FIELDS = ('important_text', 'text')
+    # a word in the name counts for this many in the rest of the text
+    WEIGHTS = {'important_text': 5}
+
+    def __init__(self, path=None, item_path=None):
+        if path is None:
+            path = SEARCH_INDEX_PATH
+        if path is None:
+            path = os.path.join(settings.ROOT_DIR, 'search-index.db')
+        if item_path is None:
+            item_path = SEARCH_ITEM_INDEX_PATH
+        if item_path is None:
+            if path == ':memory:':
+                item_path = path
+            else:
+                item_path = '%s-items%s' % os.path.splitext(path)
+        self.index = SearchIndex(path, self.FIELDS, self.WEIGHTS)
+        # kept apart so that there being millions of items doesn't make
+        # searching the channels any slower
+        self.items = SearchIndex(item_path, self.FIELDS, self.WEIGHTS)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def attributes(channel, names=None):
+        attributes = {}
+        if names is None or 'state' in names:
+            attributes['state'] = channel.state
+        if names is None or 'language' in names:
+            attributes['language'] = channel.language_id
+        if names is None or 'hi_def' in names:
+            attributes['hi_def'] = bool(channel.hi_def)
+        if names is None or 'category' in names:
+            attributes['category'] = list(channel.categories.values_list(
+                    'id', flat=True))
+        return attributes
+
+    def update(self, channel, important_text, text):
+        self.index.add(channel.id, {'important_text': important_text,
+                                    'text': text},
+                       self.attributes(channel))
+
+    def update_attributes(self, channel, names=None):
+        self.index.set_attributes(channel.id,
+                                  self.attributes(channel, names))
+
+    def remove(self, channel_id):
+        self.index.remove(channel_id)
+        self.items.remove_many(self.items.filter({'channel': channel_id}))
+
+    def update_items(self, items):
+        items = list(items)
+        for start in range(0, len(items), ITEM_BATCH_SIZE):
+            self.items.add_many([
+                    (item.id, {'important_text': item.name,
+                               'text': u' '.join([
+                                    force_unicode(text or u'',
+                                                  errors='replace')
+                                    for text in (item.description,
+                                                 item.url)])},
+                     {'channel': item.channel_id})
+                    for item in items[start:start + ITEM_BATCH_SIZE]])
+
+    def remove_items(self, item_ids):
+        self.items.remove_many(item_ids)
+
+    def clear(self):
+        self.index.clear()
+        self.items.clear()
+
+    def index_channels(self, ids):
+        """Index the channels with the given ids from their search data,
+        and take out the ones which have been deleted."""
+        from channelguide.channels.models import Channel
+        from channelguide.search.models import ChannelSearchData
+        ids = list(ids)
+        channels = Channel.objects.in_bulk(ids)
+        search_data = ChannelSearchData.objects.in_bulk(ids)
+        for id in ids:
+            if id not in channels:
+                self.remove(id)
+            elif id in search_data:
+                self.update(channels[id], search_data[id].important_text,
+                            search_data[id].text)
+            else:
+                # not indexed yet, so this does nothing
+                self.update_attributes(channels[id])
+
+    def index_items(self, ids):
+        """Index the items with the given ids, and take out the ones which
+        have been deleted."""
+        from channelguide.channels.models import Item
+        ids = list(ids)
+        items = Item.objects.in_bulk(ids)
+        self.update_items(items.values())
+        self.remove_items([id for id in ids if id not in items])
+
+    def version(self):
+        """Return the id of the last logged change the index has made, and
+        a list of the ones before it which it's still waiting for."""
+        return (self.index.get_state('position', 0),
+                sorted(self.missing_changes()))
+
+    def missing_changes(self):
+        """Return a dictionary mapping the ids of the changes the index is
+        waiting for to when it noticed they were missing."""
+        missing = {}
+        for change in (self.index.get_state('missing') or '').split():
+            id, noticed = change.split(':')
+            missing[int(id)] = float(noticed)
+        return missing
+
+    def catch_up(self, limit=CHANGE_BATCH_SIZE):
+        # another thread catching up doesn't hold up the search
+        if self.lock.acquire(False):
+            try:
+                self.make_changes(limit)
+            finally:
+                self.lock.release()
+        return self.version()
+
+    def make_changes(self, limit=CHANGE_BATCH_SIZE):
+        from channelguide.search.models import SearchChange
+        position = self.index.get_state('position', 0)
+        missing = self.missing_changes()
+        changes = SearchChange.objects.since(position, missing, limit)
+        now = time.time()
+        channel_ids = set()
+        item_ids = set()
+        for id, kind, object_id in changes:
+            if kind == SearchChange.ITEM:
+                item_ids.add(object_id)
+            else:
+                channel_ids.add(object_id)
+            missing.pop(id, None)
+            if id > position:
+                if position and id - position <= MAX_GAP:
+                    for skipped in range(position + 1, id):
+                        missing.setdefault(skipped, now)
+                position = id
+        self.index_channels(channel_ids)
+        self.index_items(item_ids)
+        # the ones still missing weren't there when the log was just read
+        missing = [(id, noticed) for (id, noticed) in missing.items()
+                   if now - noticed < GAP_TIMEOUT]
+        self.index.set_state('position', position)
+        self.index.set_state('missing', ' '.join([
+                    '%i:%f' % change for change in sorted(missing)]))
+        return len(changes)
+
+    def skip_changes(self, position):
+        if position > self.index.get_state('position', 0):
+            self.index.set_state('position', position)
+            self.index.set_state('missing', '')
+
+    def item_channels(self, terms, filters):
+        """Return the ids of the channels with filters which have items
+        matching the terms, the one with the best item first."""
+        ranked = self.items.search(terms, limit=MAX_ITEM_RESULTS)
+        channels = self.items.get_values([id for (id, score) in ranked],
+                                         'channel')
+        ids = []
+        seen = set()
+        for id, score in ranked:
+            channel_id = channels.get(id)
+            if channel_id is not None and channel_id not in seen:
+                seen.add(channel_id)
+                ids.append(channel_id)
+        if filters:
+            allowed = self.index.filter(filters, ids)
+            ids = [id for id in ids if id in allowed]
+        return ids
+
+    def matching_items(self, channel_ids, terms, per_channel=3):
+        if not channel_ids:
+            return {}
+        ranked = self.items.search(terms, {'channel': list(channel_ids)})
+        channels = self.items.get_values([id for (id, score) in ranked],
+                                         'channel')
+        matches = {}
+        for id, score in ranked:
+            ids = matches.setdefault(channels[id], [])
+            if len(ids) < per_channel:
+                ids.append(id)
+        return matches
+
+    def search_ids(self, terms, **filters):
+        ids = [id for (id, score) in self.index.search(terms, filters,
+                                                       limit=MAX_RESULTS)]
+        if len(ids) < MAX_RESULTS:
+            # then the channels which only match because of their items
+            found = set(ids)
+            ids.extend([id for id in self.item_channels(terms, filters)
+                        if id not in found][:MAX_RESULTS - len(ids)])
+        return ids
+
+def order_by_ids(query, ids):
+    """Return the channels in query with the given ids, sorted by whether
+    they're archived and then in the order of the ids."""
+    if not ids:
+        return query.none()
+    from channelguide.channels.models import Channel
+    # the ids are ints from the index or the cache, so they're safe to put
+    # in the SQL, and that keeps long lists under SQLite's limit on
+    # parameters
+    qn = connection.ops.quote_name
+    column = '%s.%s' % (qn(Channel._meta.db_table),
+                        qn(Channel._meta.pk.column))
+    ids = [int(id) for id in ids]
+    rank = 'CASE %s %s END' % (column, ' '.join([
+                'WHEN %i THEN %i' % (id, i)
+                for (i, id) in enumerate(ids)]))
+    query = query.extra(select={'search_rank': rank},
+                        where=['%s IN (%s)' % (
+                column, ', '.join([str(id) for id in ids]))])
+    query = query.order_by().order_by('archived')
+    return query.extra(order_by=['search_rank'])
+
+_backend = None
+
+def get_backend():
+    """Return the SEARCH_BACKEND for this process."""
+    global _backend
+    if _backend is None:
+        module, name = SEARCH_BACKEND.rsplit('.', 1)
+        _backend = getattr(import_module(module), name)()
+    return _backend
@@ -0,0 +1,403 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+"""An inverted index kept in a SQLite file of its own.
+
+Each document has a few text fields, which are split into words and stored
+as postings (word, document, field, frequency), and some attributes
+(name, value) the results can be filtered by.  A search finds the documents
+which have a word starting with each of the terms, ranks them with BM25F
+(BM25 with the fields weighted and each one's length normalized on its own)
+and returns them best first.  Nothing here touches the site's database, so
+searching costs the same whatever that database is.  The index can also
+keep a few named values of its own (get_state() and set_state()), which
+are cleared with it.
+
+The file is opened in WAL mode, so that searches don't wait for updates,
+which SQLite only supports on a local disk; an index on a network
+filesystem is refused.
+"""
+
+import math
+import os
+import re
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+# BM25 parameters: how quickly more of the same word stops counting, and how
+# much a field's length matters
+K1 = 1.2
+B = 0.75
+
+def tokenize(text):
+    """Return a list of the lowercase words in text."""
+    if isinstance(text, str):
+        text = text.decode('utf8', 'replace')
+    return WORD.findall(text.lower())
+
+# most values in one IN (...); SQLite allows 999 parameters
+CHUNK_SIZE = 500
+# the most documents matching the earlier terms of a search which the later
+# ones are looked up for one by one, rather than scanning all their postings
+CANDIDATE_LIMIT = 2000
+
+def chunks(values):
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
+
+# filesystem types (from /proc/mounts) which SQLite's WAL mode doesn't work
+# on
+NETWORK_FILESYSTEMS = frozenset(['nfs', 'nfs4', 'cifs', 'smbfs', 'smb3',
+                                 'ncpfs', 'afs', 'coda', 'glusterfs',
+                                 'lustre', 'ceph', 'fuse.sshfs', '9p'])
+
+def filesystem_type(path, mounts='/proc/mounts'):
+    """Return the type of the filesystem path is on ('ext3', 'nfs', ...),
+    or None if there's no mounts file to tell from."""
+    directory = os.path.realpath(os.path.dirname(os.path.abspath(path)))
+    try:
+        lines = open(mounts).readlines()
+    except IOError:
+        return None
+    found = None
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        mount_point = fields[1].replace('\\040', ' ')
+        if (directory == mount_point or
+                directory.startswith(mount_point.rstrip('/') + '/')):
+            if found is None or len(mount_point) > len(found[0]):
+                found = (mount_point, fields[2])
+    return found and found[1]
+
+def prefix_end(prefix):
+    """Return the first string after every string starting with prefix."""
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+class SearchIndex(object):
+    """
+    fields is a list of the text field names, and weights maps them to how
+    much a word in that field counts (1 if it isn't given).  path ':memory:'
+    keeps the index in memory, a separate one for each thread, which is
+    only useful for tests.  Raises ValueError if path is on a network
+    filesystem.
+    """
+    def __init__(self, path, fields, weights=None):
+        if path != ':memory:':
+            filesystem = filesystem_type(path)
+            if filesystem in NETWORK_FILESYSTEMS:
+                raise ValueError('%s is on a network filesystem (%s); '
+                                 'the search index has to be on a local '
+                                 'disk' % (path, filesystem))
+        self.path = path
+        self.fields = tuple(fields)
+        if weights is None:
+            weights = {}
+        self.weights = [float(weights.get(field, 1)) for field in
+                        self.fields]
+        self.local = threading.local()
+
+    def connection(self):
+        db = getattr(self.local, 'connection', None)
+        if db is None:
+            # transactions are begun and ended by write()
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            if self.path != ':memory:':
+                # readers don't wait for writers
+                db.execute('PRAGMA journal_mode=WAL')
+            self.create_tables(db)
+            self.local.connection = db
+        return db
+
+    def create_tables(self, db):
+        lengths = ''.join([', length%i INTEGER NOT NULL' % i
+                           for i in range(len(self.fields))])
+        db.executescript('''
+CREATE TABLE IF NOT EXISTS document (id INTEGER PRIMARY KEY%s);
+CREATE TABLE IF NOT EXISTS posting (term TEXT NOT NULL,
+    document INTEGER NOT NULL, field INTEGER NOT NULL,
+    frequency INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS posting_term ON posting (term, document);
+CREATE INDEX IF NOT EXISTS posting_document ON posting (document);
+CREATE TABLE IF NOT EXISTS attribute (document INTEGER NOT NULL,
+    name TEXT NOT NULL, value);
+CREATE INDEX IF NOT EXISTS attribute_value ON attribute (name, value);
+CREATE INDEX IF NOT EXISTS attribute_document ON attribute (document);
+CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value);
+''' % lengths)
+
+    def __len__(self):
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM document').fetchone()[0]
+
+    def __contains__(self, id):
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM document WHERE id=?', (id,)).fetchone()[0]
+
+    def add(self, id, fields, attributes=None):
+        """
+        Index the document with the given id, replacing whatever was
+        indexed for it before.  fields maps field names to their text, and
+        attributes maps attribute names to a value or a list of values.
+        """
+        self.add_many([(id, fields, attributes)])
+
+    def add_many(self, documents):
+        """add() each of a list of (id, fields, attributes), in one
+        transaction with a few batched statements."""
+        rows = []
+        postings = []
+        attributes = []
+        for id, fields, document_attributes in documents:
+            lengths = []
+            for i, field in enumerate(self.fields):
+                words = tokenize(fields.get(field) or u'')
+                lengths.append(len(words))
+                frequencies = {}
+                for word in words:
+                    frequencies[word] = frequencies.get(word, 0) + 1
+                postings.extend([(word, id, i, frequency)
+                                 for word, frequency in frequencies.items()])
+            rows.append([id] + lengths)
+            attributes.extend(self._attribute_rows(id, document_attributes
+                                                   or {}))
+        if not rows:
+            return
+        def add(db):
+            self._delete(db, [row[0] for row in rows])
+            db.executemany('INSERT INTO document VALUES (?%s)' % (
+                    ', ?' * len(self.fields)), rows)
+            db.executemany('INSERT INTO posting VALUES (?, ?, ?, ?)',
+                           postings)
+            db.executemany('INSERT INTO attribute VALUES (?, ?, ?)',
+                           attributes)
+        self.write(add)
+
+    def remove(self, id):
+        self.remove_many([id])
+
+    def remove_many(self, ids):
+        if ids:
+            self.write(self._delete, list(ids))
+
+    def write(self, function, *args):
+        """Call function with the connection and args in a transaction
+        which holds the write lock from the start."""
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            function(db, *args)
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def set_attributes(self, id, attributes):
+        """
+        Replace the values of the given attributes of a document which has
+        been indexed (documents which haven't are left alone, since their
+        attributes are set when they're added).  Nothing is written if the
+        values are the same.
+        """
+        if id not in self:
+            return
+        if self.get_attributes(id, attributes.keys()) == \
+                self._normalize(attributes):
+            return
+        def set_attributes(db):
+            db.execute('DELETE FROM attribute WHERE document=? AND name IN '
+                       '(%s)' % ', '.join('?' * len(attributes)),
+                       [id] + attributes.keys())
+            db.executemany('INSERT INTO attribute VALUES (?, ?, ?)',
+                           self._attribute_rows(id, attributes))
+        self.write(set_attributes)
+
+    def get_attributes(self, id, names=None):
+        """Return a dictionary mapping the document's attribute names to
+        sets of values."""
+        result = {}
+        if names is not None:
+            for name in names:
+                result[name] = set()
+        for name, value in self.connection().execute(
+            'SELECT name, value FROM attribute WHERE document=?', (id,)):
+            if names is None or name in result:
+                result.setdefault(name, set()).add(value)
+        return result
+
+    def get_values(self, ids, name):
+        """Return a dictionary mapping each of the documents with the given
+        ids to one of its values of the named attribute."""
+        values = {}
+        db = self.connection()
+        for chunk in chunks(list(ids)):
+            values.update(db.execute(
+                    'SELECT document, value FROM attribute WHERE name=? AND '
+                    'document IN (%s)' % ', '.join('?' * len(chunk)),
+                    [name] + chunk))
+        return values
+
+    def filter(self, filters, ids=None):
+        """Return the set of the documents (of the given ids, or all of
+        them) which have one of the values of each of the filters."""
+        db = self.connection()
+        filters = self._normalize(filters).items()
+        if ids is None:
+            if not filters:
+                return set([row[0] for row in db.execute(
+                            'SELECT id FROM document')])
+            name, values = filters.pop()
+            values = list(values)
+            matching = set([row[0] for row in db.execute(
+                        'SELECT document FROM attribute WHERE name=? AND '
+                        'value IN (%s)' % ', '.join('?' * len(values)),
+                        [name] + values)])
+        else:
+            matching = set(ids)
+        for name, values in filters:
+            values = list(values)
+            found = set()
+            # looked up through the documents rather than the values, so
+            # that this costs the same however many documents have them
+            for chunk in chunks(list(matching)):
+                found.update([row[0] for row in db.execute(
+                            'SELECT document FROM attribute WHERE document '
+                            'IN (%s) AND name=? AND value IN (%s)' % (
+                                ', '.join('?' * len(chunk)),
+                                ', '.join('?' * len(values))),
+                            chunk + [name] + values)])
+            matching = found
+        return matching
+
+    def get_state(self, name, default=None):
+        """Return the value set_state() kept under name."""
+        row = self.connection().execute(
+            'SELECT value FROM state WHERE name=?', (name,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def set_state(self, name, value):
+        """Keep a value in the index under name."""
+        def set_state(db):
+            db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)',
+                       (name, value))
+        self.write(set_state)
+
+    def clear(self):
+        def clear(db):
+            for table in ('document', 'posting', 'attribute', 'state'):
+                db.execute('DELETE FROM %s' % table)
+        self.write(clear)
+
+    def _delete(self, db, ids):
+        for chunk in chunks(ids):
+            placeholders = ', '.join('?' * len(chunk))
+            for table, column in (('document', 'id'),
+                                  ('posting', 'document'),
+                                  ('attribute', 'document')):
+                db.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                        table, column, placeholders), chunk)
+
+    @staticmethod
+    def _normalize(attributes):
+        normalized = {}
+        for name, values in attributes.items():
+            if not isinstance(values, (list, tuple, set, frozenset)):
+                values = [values]
+            normalized[name] = set([value for value in values
+                                    if value is not None])
+        return normalized
+
+    def _attribute_rows(self, id, attributes):
+        return [(id, name, value)
+                for name, values in self._normalize(attributes).items()
+                for value in values]
+
+    def search(self, terms, filters=None, limit=None, prefix=True):
+        """
+        Return a list of (document id, score) for the documents which match
+        every one of the terms, best first.  With prefix, a term matches any
+        word that starts with it.  filters maps attribute names to a value
+        or list of values, one of which a document has to have.
+        """
+        words = []
+        for term in terms:
+            for word in tokenize(term):
+                if word not in words:
+                    words.append(word)
+        if not words:
+            return []
+        db = self.connection()
+        sums = db.execute('SELECT COUNT(*)%s FROM document' % ''.join([
+                    ', SUM(length%i)' % i
+                    for i in range(len(self.fields))])).fetchone()
+        documents = sums[0]
+        if not documents:
+            return []
+        averages = [float(total or 0) / documents or 1
+                    for total in sums[1:]]
+        lengths = ''.join([', document.length%i' % i
+                           for i in range(len(self.fields))])
+        conditions = []
+        for word in words:
+            if prefix:
+                where = 'posting.term >= ? AND posting.term < ?'
+                params = [word, prefix_end(word)]
+            else:
+                where = 'posting.term = ?'
+                params = [word]
+            # how many documents have the word, which the idf is worked out
+            # from; this only reads the (term, document) index
+            count = db.execute('SELECT COUNT(DISTINCT document) FROM posting '
+                               'WHERE %s' % where, params).fetchone()[0]
+            if not count:
+                return []
+            conditions.append((count, where, params))
+        # the rarest word first, so that with millions of documents the
+        # commoner words only have to be looked up for the ones it matched
+        conditions.sort(key=lambda condition: condition[0])
+        scores = None
+        for count, where, params in conditions:
+            idf = math.log(1 + (documents - count + 0.5) / (count + 0.5))
+            candidates = ''
+            if scores is not None and len(scores) <= CANDIDATE_LIMIT:
+                # ints from the index, so they're safe to put in the SQL
+                candidates = ' AND posting.document IN (%s)' % ', '.join([
+                        str(int(id)) for id in scores])
+            weighted = {} # document id -> weighted, normalized frequency
+            for row in db.execute(
+                'SELECT posting.document, posting.field, posting.frequency%s '
+                'FROM posting JOIN document ON document.id=posting.document '
+                'WHERE %s%s' % (lengths, where, candidates), params):
+                id, field, frequency = row[:3]
+                if scores is not None and id not in scores:
+                    continue
+                length = row[3 + field]
+                normalized = frequency / (
+                    1 - B + B * length / averages[field])
+                weighted[id] = weighted.get(id, 0) + (
+                    self.weights[field] * normalized)
+            previous = scores
+            scores = dict((id, (previous or {}).get(id, 0) +
+                           idf * frequency / (K1 + frequency))
+                          for id, frequency in weighted.items())
+            if filters and previous is None:
+                # only the documents with the rarest word have their
+                # attributes looked up
+                allowed = self.filter(filters, scores.keys())
+                scores = dict([(id, score) for (id, score) in scores.items()
+                               if id in allowed])
+            if not scores:
+                return []
+        ranked = sorted(scores.items(), key=lambda (id, score): (-score, id))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return ranked
@@ -0,0 +1,133 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from channelguide.search.backends import IndexBackend
+from channelguide.search.index import SearchIndex
+from channelguide.search.suggest import SuggestionIndex
+
+class Command(NoArgsCommand):
+    """
+    Build a search index of made-up channels in a temporary SQLite file and
+    time indexing them and searching it: single words, several words,
+    prefixes, and a word filtered by state and category.  Then time
+    suggestions for prefixes of the channels' names.
+    """
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--channels', type='int', default=5000,
+                    help='Channels to index'),
+        make_option('--words', type='int', default=20000,
+                    help='Words in the vocabulary'),
+        make_option('--searches', type='int', default=200,
+                    help='Searches of each kind'),
+        make_option('--seed', type='int', default=0),)
+
+    def make_vocabulary(self, generator, count):
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        words = set()
+        while len(words) < count:
+            words.add(''.join([generator.choice(letters) for i in
+                               range(generator.randint(3, 10))]))
+        words = sorted(words)
+        generator.shuffle(words)
+        return words
+
+    def zipf(self, generator, words):
+        """Pick a word, with the first ones much more likely."""
+        return words[min(int(generator.paretovariate(1)) - 1,
+                         len(words) - 1)]
+
+    def time_searches(self, index, searches):
+        times = []
+        results = 0
+        for terms, filters in searches:
+            start = time.time()
+            results += len(index.search(terms, filters))
+            times.append(time.time() - start)
+        times.sort()
+        return (sum(times) / len(times), times[int(len(times) * 0.95)],
+                float(results) / len(searches))
+
+    def handle_noargs(self, **options):
+        generator = random.Random(options['seed'])
+        words = self.make_vocabulary(generator, options['words'])
+        directory = tempfile.mkdtemp()
+        try:
+            index = SearchIndex(os.path.join(directory, 'index.db'),
+                                IndexBackend.FIELDS, IndexBackend.WEIGHTS)
+            suggestions = SuggestionIndex()
+            names = []
+            start = time.time()
+            for id in range(1, options['channels'] + 1):
+                name = ' '.join([self.zipf(generator, words)
+                                 for i in range(generator.randint(1, 4))])
+                names.append(name)
+                text = ' '.join([self.zipf(generator, words) for i in
+                                 range(generator.randint(20, 200))])
+                index.add(id, {'important_text': name, 'text': text},
+                          {'state': generator.choice('AAAAUNR'),
+                           'category': generator.sample(range(1, 20), 2),
+                           'hi_def': generator.random() < 0.2})
+            seconds = time.time() - start
+            print '%i channels indexed in %.2fs (%.2f ms each), %.1f MB' % (
+                options['channels'], seconds,
+                seconds * 1000 / options['channels'],
+                os.path.getsize(os.path.join(directory, 'index.db')) /
+                1048576.0)
+            count = options['searches']
+            def word():
+                return generator.choice(words[:2000])
+            kinds = (
+                ('one word', [([word()], None) for i in range(count)]),
+                ('two words', [([word(), word()], None)
+                               for i in range(count)]),
+                ('prefix', [([word()[:3]], None) for i in range(count)]),
+                ('filtered', [([word()], {'state': ['A', 'U'],
+                                          'category': 3})
+                              for i in range(count)]),
+                )
+            print '%-12s %10s %10s %10s' % ('search', 'mean ms', '95% ms',
+                                            'results')
+            for name, searches in kinds:
+                mean, p95, results = self.time_searches(index, searches)
+                print '%-12s %10.2f %10.2f %10.1f' % (name, mean * 1000,
+                                                      p95 * 1000, results)
+            index.connection().close()
+
+            start = time.time()
+            for id, name in enumerate(names):
+                suggestions.add_channel(id, name, generator.randint(0, 1000),
+                                        [('tag', self.zipf(generator, words))])
+            print '%i channels added to the suggestions in %.2fs' % (
+                len(names), time.time() - start)
+            print '%-12s %10s %10s %10s' % ('suggest', 'mean ms', '95% ms',
+                                            'first ms')
+            for length in (1, 2, 3, 5):
+                prefixes = [generator.choice(names)[:length]
+                            for i in range(count)]
+                first = []
+                for prefix in prefixes:
+                    suggestions.memo.clear()
+                    start = time.time()
+                    suggestions.suggest(prefix)
+                    first.append(time.time() - start)
+                for prefix in prefixes:
+                    suggestions.suggest(prefix)
+                times = []
+                for prefix in prefixes:
+                    start = time.time()
+                    suggestions.suggest(prefix)
+                    times.append(time.time() - start)
+                times.sort()
+                print '%-12s %10.3f %10.3f %10.3f' % (
+                    '%i letters' % length, sum(times) * 1000 / count,
+                    times[int(count * 0.95)] * 1000,
+                    sum(first) * 1000 / count)
+        finally:
+            shutil.rmtree(directory)
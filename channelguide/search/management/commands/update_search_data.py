@@ -1,16 +1,58 @@
 import logging
 import traceback
+from datetime import datetime, timedelta
+from optparse import make_option
 from django.core.management.base import BaseCommand
-from channelguide.search.models import ChannelSearchData
+from channelguide.search import backends
+from channelguide.search.models import (CHANGE_DAYS, ChannelSearchData,
+                                        SearchChange)
 from channelguide.channels.management import utils
 
 class Command(BaseCommand):
+    """
+    Refresh every channel's search data, logging the ones which changed for
+    the other servers, and index them in this server's index.  With
+    --items, their items are indexed as well, which builds a new index;
+    the changes logged before it started aren't made again.  With
+    --changes, just make the changes logged since it last caught up, which
+    cron can do every few minutes so that searches rarely have to.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--items', action='store_true', default=False,
+                    help="Index every channel's items as well, for a new "
+                    "index (the logged changes keep them up to date after "
+                    "that)"),
+        make_option('--changes', action='store_true', default=False,
+                    help='Only make the changes logged since the index '
+                    'last caught up'),)
 
     def handle(self, **kwargs):
+        backend = backends.get_backend()
+        if kwargs.get('changes'):
+            while backend.make_changes(backends.CHANGE_BATCH_SIZE):
+                pass
+            return
+        now = datetime.now()
+        SearchChange.objects.prune(now - timedelta(days=CHANGE_DAYS))
+        # the ones logged since might not have been read from the database
+        # yet, or committed
+        position = SearchChange.objects.last_id(
+            now - timedelta(seconds=backends.GAP_TIMEOUT))
         for channel in utils.all_channel_iterator('update search data'):
             try:
-                ChannelSearchData.objects.update(channel)
+                search_data, changed = ChannelSearchData.objects.refresh(
+                    channel)
+                if changed:
+                    SearchChange.objects.log(SearchChange.CHANNEL,
+                                             [channel.id])
+                backend.update(channel, search_data.important_text,
+                               search_data.text)
+                if kwargs.get('items'):
+                    backend.update_items(channel.items.all())
             except:
                 logging.warn('error updating search data for %i:\n%s' % (
                         channel.id,
                         traceback.format_exc()))
+        if kwargs.get('items'):
+            backend.skip_changes(position)
@@ -1,19 +1,43 @@
 # Copyright (c) 2008 Participatory Culture Foundation
 # See LICENSE for details.
 
-import time
+from datetime import datetime
 
-from django.core import cache
-from django.db import models
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Max, Q, signals
+
+from channelguide.cache import utils as cache_utils
+from channelguide.channels.models import Channel, items_changed
+from channelguide.labels.models import Category, Tag, TagMap
+from channelguide.search import suggest
+
+# days the logged SearchChanges are kept; a server whose index has been
+# out of use for longer has to be rebuilt with update_search_data
+CHANGE_DAYS = getattr(settings, 'SEARCH_CHANGE_DAYS', 7)
+# most changes in one INSERT; SQLite allows 999 parameters
+INSERT_SIZE = 200
 
 class ChannelSearchDataManager(models.Manager):
 
     def update(self, channel):
+        """Save the channel's search data, and log the change for every
+        server's index."""
+        self.refresh(channel)
+        SearchChange.objects.log(SearchChange.CHANNEL, [channel.id])
+
+    def refresh(self, channel):
+        """Save the channel's search data if it's changed, without logging
+        it.  Returns the ChannelSearchData and whether it changed."""
         search_data, created = self.get_or_create(channel=channel)
-        search_data.text = self._get_search_data(channel)
-        search_data.important_text = channel.name
-        search_data.save()
-        cache.cache.set('search', time.time())
+        text = self._get_search_data(channel)
+        changed = created or (search_data.important_text,
+                              search_data.text) != (channel.name, text)
+        if changed:
+            search_data.text = text
+            search_data.important_text = channel.name
+            search_data.save() # bumps the 'search' cache tag
+        return search_data, changed
 
     @staticmethod
     def _get_search_data(channel):
@@ -38,6 +62,71 @@ class ChannelSearchData(models.Model):
     class Meta:
         db_table = 'cg_channel_search_data'
 
+class SearchChangeManager(models.Manager):
+
+    def log(self, kind, ids):
+        """Note that the channels or items (kind is SearchChange.CHANNEL or
+        SearchChange.ITEM) with the given ids have changed or been deleted,
+        in the current transaction."""
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        columns = ', '.join([qn(opts.get_field(name).column)
+                             for name in ('kind', 'object_id', 'timestamp')])
+        now = opts.get_field('timestamp').get_db_prep_save(
+            datetime.now(), connection=connection)
+        rows = [(kind, int(id), now) for id in set(ids)]
+        cursor = connection.cursor()
+        for start in range(0, len(rows), INSERT_SIZE):
+            values = rows[start:start + INSERT_SIZE]
+            cursor.execute('INSERT INTO %s (%s) VALUES %s' % (
+                    qn(opts.db_table), columns,
+                    ', '.join(['(%s, %s, %s)'] * len(values))),
+                           [value for row in values for value in row])
+        if rows:
+            transaction.commit_unless_managed()
+
+    def since(self, position, missing=(), limit=None):
+        """Return a list of (id, kind, object id) for the changes after the
+        one with id position, and the ones with the missing ids, in
+        order."""
+        query = Q(pk__gt=position)
+        if missing:
+            query |= Q(pk__in=list(missing))
+        return list(self.filter(query).order_by('pk').values_list(
+                'pk', 'kind', 'object_id')[:limit])
+
+    def last_id(self, before=None):
+        """Return the id of the last change, or the last one logged before
+        the given datetime."""
+        query = self
+        if before is not None:
+            query = self.filter(timestamp__lt=before)
+        return query.aggregate(last=Max('pk'))['last'] or 0
+
+    def prune(self, before):
+        """Delete the changes logged before the given datetime."""
+        self.filter(timestamp__lt=before).delete()
+
+class SearchChange(models.Model):
+    """
+    A change to a channel's or an item's search data, which every web
+    server's index makes before it's searched again (see search.backends),
+    so that they all find the same channels.  The changed object is read
+    from the database when the change is made, so the change doesn't say
+    what it was, and an object which isn't there any more is taken out.
+    """
+    CHANNEL = 'c'
+    ITEM = 'i'
+
+    kind = models.CharField(max_length=1)
+    object_id = models.IntegerField()
+    timestamp = models.DateTimeField(db_index=True)
+
+    objects = SearchChangeManager()
+
+    class Meta:
+        db_table = 'cg_search_change'
+
 class ItemSearchData(models.Model):
     item = models.OneToOneField('channels.Item', primary_key=True)
     important_text = models.CharField(max_length=255)
@@ -46,11 +135,86 @@ class ItemSearchData(models.Model):
     class Meta:
         db_table = 'cg_item_search_data'
 
+# log the changes to the attributes searches are filtered by for the
+# indexes; the text only changes when ChannelSearchDataManager.update() is
+# called.  Changing them changes the results, so the 'search' tag the cached
+# results depend on is bumped.  The suggestions change with the channels'
+# names, publishers, states and labels.
+
+def attribute_values(channel):
+    return (channel.state, channel.language_id, bool(channel.hi_def))
+
+def suggestion_values(channel):
+    return (channel.name, channel.publisher, channel.state)
+
+def channel_initialized(instance=None, **kwargs):
+    instance._attribute_values = attribute_values(instance)
+    instance._suggestion_values = suggestion_values(instance)
+
+def channel_saved(instance=None, created=False, **kwargs):
+    values = attribute_values(instance)
+    if not created and values != getattr(instance, '_attribute_values',
+                                         None):
+        SearchChange.objects.log(SearchChange.CHANNEL, [instance.id])
+        cache_utils.bump('search')
+    instance._attribute_values = values
+    values = suggestion_values(instance)
+    if created or values != getattr(instance, '_suggestion_values', None):
+        suggest.note_changed(instance.id)
+        instance._suggestion_values = values
+
+def channel_deleted(instance=None, **kwargs):
+    SearchChange.objects.log(SearchChange.CHANNEL, [instance.id])
+    suggest.note_changed(instance.id)
+
+def tag_map_changed(instance=None, **kwargs):
+    suggest.note_changed(instance.channel_id)
+
+def label_saved(instance=None, created=False, **kwargs):
+    if not created: # renamed, maybe
+        suggest.note_changed()
+
+def categories_changed(instance=None, action=None, reverse=False,
+                       pk_set=None, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            SearchChange.objects.log(SearchChange.CHANNEL, [instance.id])
+            cache_utils.bump('search')
+            suggest.note_changed(instance.id)
+        return
+    # instance is a Category, and pk_set has Channel ids
+    if action == 'pre_clear':
+        instance._cleared_channel_ids = list(instance.channels.values_list(
+                'id', flat=True))
+        return
+    elif action == 'post_clear':
+        pk_set = instance._cleared_channel_ids
+    elif not action.startswith('post_'):
+        return
+    SearchChange.objects.log(SearchChange.CHANNEL, pk_set)
+    for channel_id in pk_set:
+        suggest.note_changed(channel_id)
+    cache_utils.bump('search')
+
+def channel_items_changed(added=None, deleted=None, items=None, **kwargs):
+    # only the items the feed update touched are reindexed
+    SearchChange.objects.log(SearchChange.ITEM,
+                             list(deleted or ()) + list(items or ()))
+
+signals.post_init.connect(channel_initialized, sender=Channel)
+signals.post_save.connect(channel_saved, sender=Channel)
+signals.post_delete.connect(channel_deleted, sender=Channel)
+signals.post_save.connect(tag_map_changed, sender=TagMap)
+signals.post_delete.connect(tag_map_changed, sender=TagMap)
+signals.post_save.connect(label_saved, sender=Tag)
+signals.post_save.connect(label_saved, sender=Category)
+signals.m2m_changed.connect(categories_changed,
+                            sender=Channel.categories.through)
+items_changed.connect(channel_items_changed, sender=Channel)
 
 from django.conf import settings
 if settings.DATABASE_ENGINE == 'mysql':
     from django.db import connections
-    from django.db.models import signals
 
     def create_fulltext_indexes(created_models=None, **kwargs):
         """
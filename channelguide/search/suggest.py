@@ -0,0 +1,269 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+"""Suggestions for what someone is typing into the search box.
+
+Every process keeps a SuggestionIndex in memory: a sorted list of the
+approved channels' names and publishers and the names of their tags and
+categories, with each starting word-by-word, so that a prefix is found with
+bisect and nothing is read from the database as it's typed.  Each
+suggestion is weighted by the channels' subscriptions in the last month.
+
+When a process changes a channel's suggestions it notes that with
+note_changed(), which bumps a version counter in the cache and stores the
+channel id under the new version.  Other processes look at the counter
+every CHECK_INTERVAL seconds and reload just the channels which changed
+since their own version, or the whole index if they're too far behind.
+"""
+
+import bisect
+import heapq
+import threading
+import time
+
+from django.core import cache
+
+from channelguide.search.index import prefix_end, tokenize
+
+# how long a process uses its index before checking for changes
+CHECK_INTERVAL = 5
+# a process more changes behind than this loads the whole index again
+MAX_CHANGES = 200
+# most words of a name which a suggestion can be found by
+MAX_WORDS = 6
+# most prefixes whose suggestions are remembered
+MEMO_SIZE = 10000
+# most suggestions remembered for each prefix, and returned by suggest()
+MAX_SUGGESTIONS = 50
+
+VERSION_KEY = 'suggest:version'
+
+def changed_key(version):
+    return 'suggest:changed:%i' % version
+
+class SuggestionIndex(object):
+    """
+    A suggestion is (kind, value): ('channel', id) or ('tag', 'category' or
+    'publisher', name).  Channels are added with add_channel(), which also
+    adds their labels, weighted by the total of the weights of their
+    channels.  It changes in place, and even suggest() changes the memo, so
+    threads sharing one have to take turns.
+    """
+    def __init__(self):
+        self.entries = [] # sorted (key, kind, value)
+        self.weights = {} # (kind, value) -> [total weight, channels]
+        self.channels = {} # channel id -> (name, weight, labels)
+        self.memo = {} # normalized prefix -> best MAX_SUGGESTIONS
+
+    def __len__(self):
+        return len(self.weights)
+
+    @staticmethod
+    def keys(text):
+        """Return the keys text is found by: all of it, and what's left
+        after each of its first few words."""
+        words = tokenize(text)
+        return [u' '.join(words[i:])
+                for i in range(min(len(words), MAX_WORDS))]
+
+    def _forget(self, text):
+        """Forget the remembered suggestions for the prefixes of text's
+        keys, which a change to a suggestion with that text affects."""
+        if not self.memo:
+            return
+        for key in self.keys(text):
+            for end in range(1, len(key) + 1):
+                self.memo.pop(key[:end], None)
+
+    def _add(self, kind, value, text, weight):
+        self._forget(text)
+        suggestion = (kind, value)
+        if suggestion in self.weights:
+            self.weights[suggestion][0] += weight
+            self.weights[suggestion][1] += 1
+            return
+        self.weights[suggestion] = [weight, 1]
+        for key in self.keys(text):
+            bisect.insort(self.entries, (key, kind, value))
+
+    def _remove(self, kind, value, text, weight):
+        self._forget(text)
+        suggestion = (kind, value)
+        totals = self.weights[suggestion]
+        totals[0] -= weight
+        totals[1] -= 1
+        if totals[1]:
+            return
+        del self.weights[suggestion]
+        for key in self.keys(text):
+            entry = (key, kind, value)
+            i = bisect.bisect_left(self.entries, entry)
+            if i < len(self.entries) and self.entries[i] == entry:
+                del self.entries[i]
+
+    def add_channel(self, id, name, weight, labels):
+        """labels is a list of (kind, name) for the channel's tags,
+        categories and publisher."""
+        self.remove_channel(id)
+        self._add('channel', id, name, weight)
+        for kind, label in labels:
+            self._add(kind, label, label, weight)
+        self.channels[id] = (name, weight, labels)
+
+    def remove_channel(self, id):
+        if id not in self.channels:
+            return
+        name, weight, labels = self.channels.pop(id)
+        self._remove('channel', id, name, weight)
+        for kind, label in labels:
+            self._remove(kind, label, label, weight)
+
+    def name(self, kind, value):
+        if kind == 'channel':
+            return self.channels[value][0]
+        return value
+
+    def suggest(self, prefix, limit=10):
+        """Return a list of up to limit (kind, value, name) whose names
+        have a word starting with prefix, the most subscribed to first."""
+        key = u' '.join(tokenize(prefix))
+        if not key:
+            return []
+        suggestions = self.memo.get(key)
+        if suggestions is None:
+            start = bisect.bisect_left(self.entries, (key,))
+            end = bisect.bisect_left(self.entries, (prefix_end(key),))
+            found = set([(kind, value) for (entry_key, kind, value)
+                         in self.entries[start:end]])
+            def rank(suggestion):
+                weight, channels = self.weights[suggestion]
+                return (-weight, -channels, self.name(*suggestion))
+            suggestions = [suggestion + (self.name(*suggestion),)
+                           for suggestion in heapq.nsmallest(
+                    MAX_SUGGESTIONS, found, key=rank)]
+            if len(self.memo) >= MEMO_SIZE:
+                self.memo.clear()
+            self.memo[key] = suggestions
+        return suggestions[:limit]
+
+    def load(self, channel_ids=None):
+        """Add the approved channels with the given ids (or all of them),
+        and remove the ones which aren't approved any more."""
+        from channelguide.channels.models import Channel
+        from channelguide.labels.models import TagMap
+        from channelguide.subscriptions.models import GeneratedStats
+        channels = Channel.objects.approved()
+        tag_maps = TagMap.objects.filter(
+            channel__state__in=(Channel.APPROVED, Channel.AUDIO))
+        categories = Channel.categories.through.objects.filter(
+            channel__state__in=(Channel.APPROVED, Channel.AUDIO))
+        stats = GeneratedStats.objects.filter(
+            channel__state__in=(Channel.APPROVED, Channel.AUDIO))
+        if channel_ids is not None:
+            channel_ids = list(channel_ids)
+            channels = channels.filter(pk__in=channel_ids)
+            tag_maps = tag_maps.filter(channel__in=channel_ids)
+            categories = categories.filter(channel__in=channel_ids)
+            stats = stats.filter(channel__in=channel_ids)
+        labels = {}
+        for channel_id, name in tag_maps.values_list('channel',
+                                                     'tag__name').distinct():
+            labels.setdefault(channel_id, []).append(('tag', name))
+        for channel_id, name in categories.values_list('channel',
+                                                       'category__name'):
+            labels.setdefault(channel_id, []).append(('category', name))
+        weights = dict(stats.values_list('channel',
+                                         'subscription_count_month'))
+        found = set()
+        for id, name, publisher in channels.values_list('id', 'name',
+                                                        'publisher'):
+            channel_labels = labels.get(id, [])
+            if publisher:
+                channel_labels.append(('publisher', publisher))
+            self.add_channel(id, name, weights.get(id, 0), channel_labels)
+            found.add(id)
+        if channel_ids is not None:
+            for id in channel_ids:
+                if id not in found:
+                    self.remove_channel(id)
+
+def get_version():
+    """Return the current version of the suggestions, starting one if
+    there isn't one."""
+    version = cache.cache.get(VERSION_KEY)
+    if version is None:
+        # from the time, so that a counter which was evicted doesn't come
+        # back with a version some process already has
+        cache.cache.add(VERSION_KEY, int(time.time() * 1000))
+        version = cache.cache.get(VERSION_KEY)
+    return version
+
+_lock = threading.Lock()
+_index = None
+_version = None
+_checked = 0
+
+def note_changed(channel_id=None):
+    """Note that a channel's suggestions (or everything's, if channel_id is
+    None) have changed."""
+    try:
+        version = cache.cache.incr(VERSION_KEY)
+    except ValueError:
+        pass # there's no version, so every process will load everything
+    else:
+        cache.cache.set(changed_key(version), channel_id)
+    if _index is not None:
+        # this process sees its own changes straight away
+        _lock.acquire()
+        try:
+            if channel_id is None:
+                _index.load()
+            else:
+                _index.load([channel_id])
+        finally:
+            _lock.release()
+
+def get_index():
+    """Return this process's SuggestionIndex, brought up to date if it
+    hasn't been checked for CHECK_INTERVAL seconds."""
+    global _index, _version, _checked
+    now = time.time()
+    if _index is not None and now - _checked < CHECK_INTERVAL:
+        return _index
+    _lock.acquire()
+    try:
+        version = get_version()
+        behind = _version is not None and version - _version
+        changed = None
+        if _index is not None and 0 <= behind <= MAX_CHANGES:
+            changed = cache.cache.get_many([
+                    changed_key(v) for v in range(_version + 1,
+                                                  version + 1)])
+            if len(changed) < behind or None in changed.values():
+                changed = None # some were evicted, or it all changed
+        if changed is None:
+            index = SuggestionIndex()
+            index.load()
+            _index = index
+        elif changed:
+            _index.load(set(changed.values()))
+        _version = version
+        _checked = now
+        return _index
+    finally:
+        _lock.release()
+
+def reset():
+    """Forget this process's index; the next get_index() loads it again."""
+    global _index, _version, _checked
+    _index = _version = None
+    _checked = 0
+
+def suggest(prefix, limit=10):
+    index = get_index()
+    # note_changed() and get_index() change the index under the lock
+    _lock.acquire()
+    try:
+        return index.suggest(prefix, limit)
+    finally:
+        _lock.release()
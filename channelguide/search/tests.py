@@ -1,8 +1,18 @@
 # Copyright (c) 2008-2009 Participatory Culture Foundation
 # See LICENSE for details.
 
+from datetime import datetime
+import os
+import shutil
+import tempfile
+
+from django.core import cache
+
 from channelguide.channels.models import Channel
-from channelguide.search.models import ChannelSearchData
+from channelguide.search import backends, index, suggest
+from channelguide.search import utils as search_utils
+from channelguide.search.index import SearchIndex
+from channelguide.search.models import ChannelSearchData, SearchChange
 from channelguide.testframework import TestCase, test_data_path
 
 class ChannelSearchTest(TestCase):
@@ -89,3 +99,241 @@ class ChannelSearchTest(TestCase):
 
         _check("foobar barfoo")
         _check("foobar y barfoo")
+
+    def test_index_attributes_follow_channel(self):
+        """
+        Changing a channel's state should change the state the index
+        filters it by, once it's made the logged changes.
+        """
+        backend = backends.get_backend()
+        index = backend.index
+        backend.catch_up()
+        self.assertEquals(index.search(['Rocketboom'], {'state': 'A'}),
+                          index.search(['Rocketboom']))
+        self.channel.state = Channel.REJECTED
+        self.channel.save()
+        backend.catch_up()
+        self.assertEquals(index.search(['Rocketboom'], {'state': 'A'}), [])
+        self.assertEquals(len(index.search(['Rocketboom'])), 1)
+        self.channel.delete()
+        backend.catch_up()
+        self.assertEquals(index.search(['Rocketboom']), [])
+
+    def test_other_servers(self):
+        """
+        Another server's index should make the logged changes before it's
+        searched, waiting for one logged after a later one until it turns
+        up, and cache its results under how far it's got.
+        """
+        other = backends.IndexBackend(':memory:')
+        def search(*args):
+            return [id for (id, score) in other.index.search(*args)]
+        self.assertEquals(search(['rocketboom']), [])
+        version = other.catch_up()
+        self.assertEquals(search(['rocketboom']), [self.channel.id])
+        self.assertEquals(other.item_channels(['rb_06_dec_13'], {}),
+                          [self.channel.id])
+        self.channel.state = Channel.REJECTED
+        self.channel.save()
+        self.assertNotEquals(other.catch_up(), version)
+        self.assertEquals(search(['rocketboom'], {'state': 'A'}), [])
+        # last + 1 is in a transaction which hasn't been committed yet
+        last = SearchChange.objects.last_id()
+        def log(id):
+            SearchChange.objects.create(id=id, kind=SearchChange.CHANNEL,
+                                        object_id=self.channel.id,
+                                        timestamp=datetime.now())
+        log(last + 2)
+        self.assertEquals(other.catch_up(), (last + 2, [last + 1]))
+        log(last + 1)
+        self.assertEquals(other.catch_up(), (last + 2, []))
+        self.channel.delete()
+        other.catch_up()
+        self.assertEquals(search(['rocketboom']), [])
+
+    def test_cached_ids(self):
+        """
+        Searches for the same words should share one cached list of ids,
+        which is only replaced when the search data changes.
+        """
+        self.assertEquals(search_utils.search_ids(['Rocketboom', 'Colan'],
+                                                  state='A'),
+                          [self.channel.id])
+        # taken out of the index without changing the search data
+        backends.get_backend().remove(self.channel.id)
+        self.assertEquals(search_utils.search_ids(['colan', 'ROCKETBOOM',
+                                                   'colan'], state=['A']),
+                          [self.channel.id])
+        self.assertEquals(search_utils.search_ids(['rocketboom']), [])
+        ChannelSearchData.objects.update(self.channel)
+        self.assertEquals(search_utils.search_ids(['rocketboom', 'colan'],
+                                                  state='A'),
+                          [self.channel.id])
+        self.channel.state = Channel.REJECTED
+        self.channel.save()
+        self.assertEquals(search_utils.search_ids(['rocketboom', 'colan'],
+                                                  state='A'), [])
+
+    def test_item_search(self):
+        """
+        Channels should be found by their items, which are shown with them;
+        a feed update should log the items it changed to be reindexed.
+        """
+        results = self.feed_search('rb_06_dec_13')
+        self.assertEquals([c.id for c in results], [self.channel.id])
+        self.assertEquals([item.name for item in results[0].matching_items],
+                          ['rb_06_dec_13'])
+        backend = backends.get_backend()
+        def matching():
+            backend.catch_up()
+            ids = backend.matching_items([self.channel.id], ['rb_06_dec'],
+                                         per_channel=10)[self.channel.id]
+            return sorted(self.channel.items.filter(pk__in=ids).values_list(
+                    'name', flat=True))
+        self.assertEquals(matching(), ['rb_06_dec_07', 'rb_06_dec_08',
+                                       'rb_06_dec_11', 'rb_06_dec_12',
+                                       'rb_06_dec_13'])
+        self.channel.update_items(
+            feedparser_input=open(test_data_path('feed-future.xml')))
+        self.assertEquals(matching(), ['rb_06_dec_11', 'rb_06_dec_12',
+                                       'rb_06_dec_13', 'rb_06_dec_14',
+                                       'rb_06_dec_15'])
+        self.assertEquals(backend.item_channels(['rb_06_dec'], {}),
+                          [self.channel.id])
+        self.assertEquals(backend.item_channels(['rb_06_dec'],
+                                                {'state': 'R'}), [])
+        self.channel.delete()
+        backend.catch_up()
+        self.assertEquals(backend.item_channels(['rb_06_dec'], {}), [])
+
+class SearchIndexTest(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.index = SearchIndex(':memory:', ('title', 'body'),
+                                 {'title': 5})
+        self.index.add(1, {'title': u'Rocketboom',
+                           'body': u'daily news with Joanne Colan'},
+                       {'state': 'A', 'category': [1, 2]})
+        self.index.add(2, {'title': u'Colan',
+                           'body': u'Colan Colan news'},
+                       {'state': 'A', 'category': [2]})
+        self.index.add(3, {'title': u'Other news', 'body': u'rockets'},
+                       {'state': 'R'})
+
+    def tearDown(self):
+        self.index.connection().close()
+        TestCase.tearDown(self)
+
+    def ids(self, *args, **kwargs):
+        return [id for (id, score) in self.index.search(*args, **kwargs)]
+
+    def test_ranking(self):
+        """
+        More of a word, and having it in the title, should rank a document
+        higher.
+        """
+        self.assertEquals(self.ids(['colan']), [2, 1])
+        self.assertEquals(self.ids(['news']), [3, 2, 1])
+
+    def test_every_term(self):
+        self.assertEquals(self.ids(['news', 'joanne']), [1])
+        self.assertEquals(self.ids(['news', 'nothing']), [])
+
+    def test_prefix(self):
+        self.assertEquals(self.ids(['rocket']), [1, 3])
+        self.assertEquals(self.ids(['rocket'], prefix=False), [])
+
+    def test_filters(self):
+        self.assertEquals(self.ids(['news'], {'state': 'A'}), [2, 1])
+        self.assertEquals(self.ids(['news'], {'state': ['A', 'R'],
+                                              'category': 1}), [1])
+        self.index.set_attributes(1, {'category': [3]})
+        self.assertEquals(self.ids(['news'], {'category': 1}), [])
+        self.assertEquals(self.index.get_attributes(1), {
+                'state': set(['A']), 'category': set([3])})
+
+    def test_replace_and_remove(self):
+        self.index.add(1, {'title': u'Something else'})
+        self.assertEquals(self.ids(['rocketboom']), [])
+        self.assertEquals(self.ids(['something']), [1])
+        self.index.remove(1)
+        self.assertEquals(self.ids(['something']), [])
+        self.assertEquals(len(self.index), 2)
+
+    def test_many(self):
+        self.index.add_many([(4, {'title': u'news'}, {'state': 'A'}),
+                             (5, {'body': u'more news'}, {'state': 'R'})])
+        self.assertEquals(sorted(self.ids(['news'])), [1, 2, 3, 4, 5])
+        self.assertEquals(self.index.filter({'state': 'R'}), set([3, 5]))
+        self.assertEquals(self.index.filter({'state': 'A'}, [1, 3, 4]),
+                          set([1, 4]))
+        self.assertEquals(self.index.get_values([1, 3, 5], 'state'),
+                          {1: 'A', 3: 'R', 5: 'R'})
+        self.index.remove_many([1, 2, 4])
+        self.assertEquals(self.ids(['news']), [3, 5])
+
+    def test_filesystem_type(self):
+        """
+        The filesystem is found from the longest mount point the path is
+        under, so that an index on NFS can be refused.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            mounts = os.path.join(directory, 'mounts')
+            f = open(mounts, 'w')
+            f.write('/dev/sda1 / ext3 rw 0 0\n'
+                    'server:/export /mnt/shared\\040dir nfs rw 0 0\n')
+            f.close()
+            self.assertEquals(index.filesystem_type('/var/search.db',
+                                                    mounts), 'ext3')
+            self.assertEquals(index.filesystem_type(
+                    '/mnt/shared dir/search.db', mounts), 'nfs')
+            self.assertEquals(index.filesystem_type(
+                    '/mnt/shared/search.db', mounts), 'ext3')
+            self.assertEquals(index.filesystem_type(
+                    '/var/search.db', os.path.join(directory, 'none')), None)
+        finally:
+            shutil.rmtree(directory)
+
+class SuggestTest(TestCase):
+
+    def test_ranking(self):
+        index = suggest.SuggestionIndex()
+        index.add_channel(1, u'Rocketboom Daily', 10,
+                          [('tag', u'news'), ('publisher', u'Rocketboom')])
+        index.add_channel(2, u'The Daily Show', 20, [('tag', u'news')])
+        self.assertEquals(index.suggest(u'dai'), [
+                ('channel', 2, u'The Daily Show'),
+                ('channel', 1, u'Rocketboom Daily')])
+        self.assertEquals(index.suggest(u'rocket'), [
+                ('publisher', u'Rocketboom', u'Rocketboom'),
+                ('channel', 1, u'Rocketboom Daily')])
+        self.assertEquals(index.suggest(u'n', limit=1),
+                          [('tag', u'news', u'news')])
+        index.remove_channel(2)
+        self.assertEquals(index.suggest(u'the'), [])
+        self.assertEquals(index.weights[('tag', u'news')], [10, 1])
+        index.remove_channel(1)
+        self.assertEquals(index.entries, [])
+
+    def test_other_processes(self):
+        """
+        A process should reload the channels other processes note have
+        changed once it checks the version again.
+        """
+        channel = self.make_channel(self.make_user('ralph'),
+                                    state=Channel.APPROVED)
+        channel.name = u'Rocketboom'
+        channel.save()
+        self.assertEquals(suggest.suggest(u'rocket'),
+                          [('channel', channel.id, u'Rocketboom')])
+        # what another process does when it renames the channel
+        Channel.objects.filter(pk=channel.pk).update(name=u'Colan')
+        version = cache.cache.incr(suggest.VERSION_KEY)
+        cache.cache.set(suggest.changed_key(version), channel.id)
+        self.assertEquals(len(suggest.suggest(u'rocket')), 1) # not checked
+        suggest._checked = 0
+        self.assertEquals(suggest.suggest(u'rocket'), [])
+        self.assertEquals(suggest.suggest(u'colan'),
+                          [('channel', channel.id, u'Colan')])
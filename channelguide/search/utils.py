@@ -1,45 +1,87 @@
 # Copyright (c) 2008-2009 Participatory Culture Foundation
 # See LICENSE for details.
 
-"""search channels."""
-from channelguide import util
-from channelguide.channels.models import Channel
+"""search channels.
+
+The ranked ids a search finds are cached under its normalized terms and
+filters, so searches for the same words in another order or case, the
+other pages of the results, and both the feeds and the sites in them all
+use the one list.  The lists depend on the 'search' cache tag, which only
+changes with the channels' search data and the attributes searches are
+filtered by, and on how far the index has got through the logged changes
+(see search.backends); a channel which only matches through its items can
+take up to CACHE_TIMEOUT seconds to show up.
+"""
+from django.conf import settings
+from django.core import cache
 
-def search_score(terms):
-    query = ' '.join(terms)
-    important = '(MATCH(cg_channel_search_data.important_text) AGAINST(%s))'
-    normal = ('MATCH(cg_channel_search_data.important_text,'
-              'cg_channel_search_data.text) AGAINST(%s)')
-    return '(%s) * 50 + %s' % (important, normal), [query, query]
+from channelguide import util
+from channelguide.cache import utils as cache_utils
+from channelguide.channels.models import Channel, Item
+from channelguide.search import backends
 
-def search_where(terms):
-    query = ' '.join(u'+%s*' % t for t in terms)
-    return ('MATCH(cg_channel_search_data.important_text,'
-            'cg_channel_search_data.text) AGAINST(%s IN BOOLEAN MODE)',
-            [query])
+CACHE_TIMEOUT = getattr(settings, 'SEARCH_CACHE_TIMEOUT', 600)
 
 def contains_hd(terms):
     return 'hd' in [term.lower() for term in terms]
 
-def search_channels(query, terms):
+def search_channels(query, terms, states=None):
+    """
+    Return the channels in query which match the search terms, best first
+    (see search.backends).  states is a list of the states the channels in
+    query can be in, if it's limited to some.
+    """
     terms = util.ensure_list(terms)
+    filters = {}
+    if states is not None:
+        filters['state'] = states
     if contains_hd(terms):
         query = query.filter(hi_def=True)
+        filters['hi_def'] = True
         terms = [t for t in terms if t.lower() != 'hd']
-    terms = [t for t in terms if len(t) >= 3] # strip short terms
-    sql, args = search_score(terms)
-
-    query = query.extra(select = {'search_score': sql},
-                        select_params = args)
-
-    sql, args = search_where(terms)
-    query = query.filter(search_data__text__isnull=False) # hack to join the
-                                                          # search table
-    query = query.extra(where = [sql],
-                        params = args)
-    query = query.order_by().order_by('archived')
-    query = query.extra(order_by=['-search_score'])
-    return query
+    return backends.order_by_ids(query, search_ids(terms, **filters))
+
+def normalize_terms(terms):
+    """Return the terms searched for, lowercase, without duplicates and
+    sorted, since none of that changes the results."""
+    return sorted(set([term.lower() for term in clean_terms(terms)]))
+
+def search_ids(terms, **filters):
+    """Return the backend's ranked list of the ids of the channels matching
+    the terms and filters, from the cache if it's there."""
+    terms = normalize_terms(terms)
+    filters = sorted([(name, sorted(util.ensure_list(value)))
+                      for name, value in filters.items()])
+    backend = backends.get_backend()
+    version = backend.catch_up()
+    stamp = cache_utils.get_stamps(['search'])['search']
+    key = cache_utils.digest_key('search:ids', (stamp, version, terms,
+                                                filters))
+    ids = cache.cache.get(key)
+    if ids is None:
+        ids = backend.search_ids(terms, **dict(filters))
+        cache.cache.set(key, ids, CACHE_TIMEOUT)
+    return ids
+
+def clean_terms(terms):
+    """Return the terms which are searched for."""
+    return [t for t in terms if len(t) >= 3] # strip short terms, and 'hd'
+
+def add_matching_items(channels, terms, per_channel=3):
+    """
+    Set matching_items on each of the channels from a search for terms to
+    a list of up to per_channel of its items which match them, best first.
+    """
+    terms = clean_terms(util.ensure_list(terms))
+    backend = backends.get_backend()
+    backend.catch_up()
+    matches = backend.matching_items(
+        [channel.id for channel in channels], terms, per_channel)
+    items = Item.objects.in_bulk([id for ids in matches.values()
+                                  for id in ids])
+    for channel in channels:
+        channel.matching_items = [items[id] for id in
+                                  matches.get(channel.id, ()) if id in items]
 
 def search_feeds(terms):
     query = search_channels(terms)
@@ -15,7 +15,9 @@ def get_search_terms(query):
 def terms_too_short(terms):
     return len([term for term in terms if len(term) >= 3]) == 0
 
-@cache_with_sites('search')
+@cache_with_sites('search',
+                  query_params=('query', 'page', 'sort', 'geoip'),
+                  fragment_mode=True)
 def search(request):
     try:
         search_query = request.GET['query']
@@ -0,0 +1,252 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+"""Subscription hits, kept in memory and written in batches.
+
+subscribe_hit() is the busiest write on the site, so it doesn't touch the
+database for a hit.  The hit goes into this process's SubscriptionBuffer,
+and a thread writes what's waiting every FLUSH_INTERVAL seconds (or as soon
+as FLUSH_SIZE hits are) with Subscription.objects.add_many().  An atexit
+handler writes whatever is left when the process shuts down, and a batch
+which can't be written is kept for the next try, which waits longer after
+each failure.  While the database is down, only the newest MAX_HITS are
+kept.
+
+Instead of counting the address's subscriptions in the last second, hits
+are throttled with a TokenBucket for each address, kept in memory.  Each
+process has its own, so an address spread over several processes gets a
+few more hits through.
+
+With SUBSCRIPTION_FLUSH_INTERVAL set to 0 there's no thread, and every hit
+is written as it comes, which the tests use.
+"""
+
+import atexit
+import logging
+from datetime import datetime
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+# seconds between writes
+FLUSH_INTERVAL = getattr(settings, 'SUBSCRIPTION_FLUSH_INTERVAL', 1)
+# hits waiting which are written straight away
+FLUSH_SIZE = 1000
+# most hits kept when they can't be written; the oldest are dropped
+MAX_HITS = 100000
+# most seconds between tries while writing fails
+MAX_BACKOFF = 60
+# an address gets THROTTLE_BURST hits at once, and another one every
+# 1 / THROTTLE_RATE seconds
+THROTTLE_RATE = 1.0
+THROTTLE_BURST = 1
+# most addresses throttled at once
+MAX_ADDRESSES = 10000
+
+class TokenBucket(object):
+    """
+    Each key has up to burst tokens, and gets rate more every second.
+    take() uses one, if there's one left.  Keys with a full bucket are the
+    same as keys which aren't there, so they're dropped when there are too
+    many.
+    """
+    def __init__(self, rate=THROTTLE_RATE, burst=THROTTLE_BURST,
+                 max_keys=MAX_ADDRESSES):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.buckets = {} # key -> (tokens, time)
+
+    def take(self, key, now=None):
+        """Return True and use a token if the key has one."""
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            if key in self.buckets:
+                tokens, then = self.buckets[key]
+                tokens = min(self.burst, tokens + (now - then) * self.rate)
+            else:
+                if len(self.buckets) >= self.max_keys:
+                    self._prune(now)
+                tokens = self.burst
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return False
+            self.buckets[key] = (tokens - 1, now)
+            return True
+        finally:
+            self.lock.release()
+
+    def _prune(self, now):
+        full = float(self.burst) / self.rate
+        for key, (tokens, then) in self.buckets.items():
+            if now - then + tokens / self.rate >= full:
+                del self.buckets[key]
+        if len(self.buckets) >= self.max_keys:
+            # a flood of addresses; start again rather than grow
+            self.buckets.clear()
+
+class SubscriptionBuffer(object):
+    """
+    Hits are (channel id, ip address, timestamp,
+    ignore_for_recommendations).  The thread is started by the first add()
+    in each process, so a buffer made before the server forks works in
+    every child.
+    """
+    def __init__(self, interval=FLUSH_INTERVAL, size=FLUSH_SIZE,
+                 max_hits=MAX_HITS):
+        self.interval = interval
+        self.size = size
+        self.max_hits = max_hits
+        self.failures = 0 # writes which have failed in a row
+        self.condition = threading.Condition()
+        self.hits = []
+        self.thread = None
+        self.pid = None
+        self.stopping = False
+
+    def __len__(self):
+        return len(self.hits)
+
+    def add(self, channel_id, ip_address, timestamp,
+            ignore_for_recommendations):
+        self.condition.acquire()
+        try:
+            if self.pid != os.getpid():
+                # forked: the parent writes the hits it had
+                self.pid = os.getpid()
+                self.hits = []
+                self.thread = None
+            self.hits.append((channel_id, ip_address, timestamp,
+                              ignore_for_recommendations))
+            # after stop() there's no thread to write it
+            write_now = not self.interval or self.stopping
+            if not write_now and self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+            elif len(self.hits) >= self.size and not self.failures:
+                self.condition.notify()
+        finally:
+            self.condition.release()
+        if write_now:
+            self.flush()
+
+    def flush(self):
+        """Write the hits waiting, in the calling thread.  If that fails
+        they're put back, as many as there's room for, and the error is
+        raised."""
+        self.condition.acquire()
+        try:
+            hits = self.hits
+            self.hits = []
+        finally:
+            self.condition.release()
+        if not hits:
+            return 0
+        from channelguide.subscriptions.models import Subscription
+        try:
+            return Subscription.objects.add_many(self.existing(hits))
+        except:
+            self.condition.acquire()
+            try:
+                self.hits[:0] = hits
+                dropped = len(self.hits) - self.max_hits
+                if dropped > 0:
+                    del self.hits[:dropped]
+            finally:
+                self.condition.release()
+            if dropped > 0:
+                logging.warn('dropped %i subscriptions which could not be '
+                             'written' % dropped)
+            raise
+
+    @staticmethod
+    def existing(hits):
+        """Return the hits for channels which still exist."""
+        from channelguide.channels.models import Channel
+        ids = Channel.objects.filter(
+            pk__in=set([hit[0] for hit in hits])).values_list('id', flat=True)
+        ids = set(ids)
+        return [hit for hit in hits if hit[0] in ids]
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                if self.stopping:
+                    pass
+                elif self.failures:
+                    # the database is having trouble; don't add to it
+                    self.condition.wait(min(
+                            self.interval * 2 ** min(self.failures, 16),
+                            MAX_BACKOFF))
+                elif len(self.hits) < self.size:
+                    self.condition.wait(self.interval)
+                stopping = self.stopping
+            finally:
+                self.condition.release()
+            if stopping:
+                return
+            try:
+                self.flush()
+            except:
+                self.failures += 1
+                logging.exception('error writing %i subscriptions' %
+                                  len(self.hits))
+            else:
+                self.failures = 0
+            # the thread's own connection, which would otherwise sit idle
+            # until the database drops it
+            connection.close()
+
+    def stop(self):
+        """Stop the thread and write what's left.  Returns how many hits
+        were written."""
+        self.condition.acquire()
+        try:
+            self.stopping = True
+            self.condition.notify()
+            thread = self.thread
+        finally:
+            self.condition.release()
+        if thread is not None and thread is not threading.currentThread():
+            thread.join()
+        return self.flush()
+
+_lock = threading.Lock()
+_buffer = None
+_throttle = TokenBucket()
+
+def get_buffer():
+    """Return this process's SubscriptionBuffer, which is written out when
+    the process exits."""
+    global _buffer
+    _lock.acquire()
+    try:
+        if _buffer is None:
+            _buffer = SubscriptionBuffer()
+            atexit.register(_buffer.stop)
+        return _buffer
+    finally:
+        _lock.release()
+
+def add(channel_id, ip_address, timestamp=None,
+        ignore_for_recommendations=False):
+    if timestamp is None:
+        timestamp = datetime.now()
+    get_buffer().add(channel_id, ip_address, timestamp,
+                     ignore_for_recommendations)
+
+def allow(ip_address):
+    """Return True if the address isn't sending hits too quickly."""
+    return _throttle.take(ip_address)
+
+def reset():
+    """Forget the throttled addresses, for the tests."""
+    _throttle.buckets.clear()
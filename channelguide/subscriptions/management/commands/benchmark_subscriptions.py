@@ -0,0 +1,80 @@
+import time
+from datetime import datetime
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from channelguide import util
+from channelguide.channels.models import Channel
+from channelguide.labels.models import Language
+from channelguide.subscriptions.buffer import SubscriptionBuffer, TokenBucket
+from channelguide.subscriptions.models import Subscription
+
+class Command(NoArgsCommand):
+    """
+    Time recording subscription hits the old way (a throttling COUNT and an
+    INSERT for each one) and with subscriptions.buffer (a token bucket, and
+    an append to the buffer, which is then written in one batch).  A
+    throwaway channel is created for the benchmark and deleted afterwards,
+    with its subscriptions.
+    """
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--hits', type='int', default=2000,
+                    help='Hits to record each way'),
+        make_option('--addresses', type='int', default=500,
+                    help='Addresses the hits come from'),)
+
+    def time_hits(self, hits, function):
+        times = []
+        for hit in hits:
+            start = time.time()
+            function(*hit)
+            times.append(time.time() - start)
+        times.sort()
+        return (sum(times) * 1000 / len(times),
+                times[int(len(times) * 0.99)] * 1000)
+
+    def handle_noargs(self, **options):
+        channel = Channel(owner=User.objects.all()[0],
+                          language=Language.objects.all()[0],
+                          name='Benchmark %s' % util.random_string(10),
+                          url='http://example.com/benchmark/%s' % (
+                util.random_string(20),),
+                          website_url='http://example.com/',
+                          publisher='benchmark@example.com',
+                          description='Benchmark channel')
+        channel.download_feed = lambda: None
+        channel.save()
+        try:
+            hits = [('10.0.%i.%i' % divmod(i % options['addresses'], 256),)
+                    for i in range(options['hits'])]
+
+            def add(ip):
+                # what subscribe_hit used to do for each hit
+                Subscription.objects.add(channel, ip)
+                transaction.commit_unless_managed()
+
+            # written when it's stopped, all at once
+            buffer = SubscriptionBuffer(interval=3600,
+                                        size=options['hits'] + 1)
+            throttle = TokenBucket()
+            def buffered(ip):
+                if throttle.take(ip):
+                    buffer.add(channel.pk, ip, datetime.now(), False)
+
+            print '%i hits from %i addresses' % (options['hits'],
+                                                 options['addresses'])
+            print '%-12s %10s %10s' % ('hit', 'mean ms', '99% ms')
+            mean, p99 = self.time_hits(hits, add)
+            print '%-12s %10.3f %10.3f' % ('before', mean, p99)
+            mean, p99 = self.time_hits(hits, buffered)
+            print '%-12s %10.3f %10.3f' % ('after', mean, p99)
+            start = time.time()
+            written = buffer.stop()
+            print '%i buffered hits written in %.1f ms' % (
+                written, (time.time() - start) * 1000)
+        finally:
+            channel.delete()
@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from channelguide.subscriptions.models import Subscription
+
+class Command(NoArgsCommand):
+    """
+    Delete the subscriptions older than --days days.  The counts of them are
+    kept in the SubscriptionDays, so the stats don't change, and the
+    SubscriptionHours older than two days are deleted as well.  The
+    recommendations and the throttling only look at the last 31 days, so
+    keep at least that many.
+    """
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='int', default=31,
+                    help='Days of subscriptions to keep'),)
+
+    def handle_noargs(self, **options):
+        before = datetime.now() - timedelta(days=options['days'])
+        deleted = Subscription.objects.compact(before)
+        if int(options.get('verbosity', 1)) > 1:
+            print '%i subscriptions deleted' % deleted
@@ -1,24 +1,49 @@
+import time
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
 
-from channelguide.subscriptions.models import Subscription, GeneratedStats
+from channelguide.subscriptions.models import GeneratedStats, SubscriptionDay
 from channelguide.channels.models import Channel
+from channelguide.search import suggest
 
 class Command(BaseCommand):
 
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', default=False,
+                    dest='dry_run',
+                    help="Time counting the subscriptions and finding the "
+                    "rows to change, but don't write anything"),)
+
     def handle(self, **kwargs):
         """
         Refreshes the statistics table so that we can calculate the ranks of
         channels.
         """
-        for channel in Channel.objects.approved():
-            sizes = {}
-            for size in None, 'month', 'day':
-                sizes[size] = Subscription.objects.total(channel, size,
-                                                         use_cache=False)
-            generated_stat, created = GeneratedStats.objects.get_or_create(
-                channel=channel)
-            generated_stat.subscription_count_today = sizes['day']
-            generated_stat.subscription_count_month = sizes['month']
-            generated_stat.subscription_count = sizes[None]
-            generated_stat.save()
+        if kwargs.get('dry_run'):
+            self.dry_run()
+            return
+        start = time.time()
+        inserted, updated = GeneratedStats.objects.refresh()
+        # the suggestions are weighted by the monthly counts
+        suggest.note_changed()
+        if int(kwargs.get('verbosity', 1)) > 1:
+            print '%i rows inserted and %i updated in %.2fs' % (
+                inserted, updated, time.time() - start)
 
+    def dry_run(self):
+        start = time.time()
+        counts = SubscriptionDay.objects.count_all()
+        counted = time.time()
+        channel_ids = list(Channel.objects.approved().values_list(
+                'id', flat=True))
+        inserts, updates = GeneratedStats.objects.find_changes(counts,
+                                                               channel_ids)
+        compared = time.time()
+        print '%i channels with subscriptions, %i approved' % (
+            len(counts), len(channel_ids))
+        print '%i rows would be inserted and %i updated' % (len(inserts),
+                                                            len(updates))
+        print '%-20s %10s' % ('phase', 'seconds')
+        print '%-20s %10.3f' % ('count', counted - start)
+        print '%-20s %10.3f' % ('compare', compared - counted)
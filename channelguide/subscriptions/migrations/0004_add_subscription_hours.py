@@ -0,0 +1,164 @@
+from datetime import datetime, timedelta
+
+from south.db import db
+from django.db import models
+from channelguide.subscriptions.models import *
+
+class Migration:
+    
+    def forwards(self, orm):
+        
+        # Adding model 'SubscriptionHour'
+        db.create_table('cg_channel_subscription_hour', (
+            ('id', orm['subscriptions.SubscriptionHour:id']),
+            ('channel', orm['subscriptions.SubscriptionHour:channel']),
+            ('hour', orm['subscriptions.SubscriptionHour:hour']),
+            ('count', orm['subscriptions.SubscriptionHour:count']),
+        ))
+        db.send_create_signal('subscriptions', ['SubscriptionHour'])
+        
+        # Creating unique_together for [channel, hour] on SubscriptionHour.
+        db.create_unique('cg_channel_subscription_hour', ['channel_id', 'hour'])
+        
+        # count the last days' subscriptions; truncating to the hour isn't
+        # the same SQL everywhere, so it's done here
+        hours = {}
+        subscriptions = orm.Subscription.objects.filter(
+            timestamp__gte=datetime.now() - timedelta(days=2))
+        for channel_id, timestamp in subscriptions.values_list('channel',
+                                                               'timestamp'):
+            key = (channel_id, timestamp.replace(minute=0, second=0,
+                                                 microsecond=0))
+            hours[key] = hours.get(key, 0) + 1
+        for (channel_id, hour), count in hours.items():
+            orm.SubscriptionHour.objects.create(channel_id=channel_id,
+                                                hour=hour, count=count)
+    
+    
+    def backwards(self, orm):
+        
+        # Deleting unique_together for [channel, hour] on SubscriptionHour.
+        db.delete_unique('cg_channel_subscription_hour', ['channel_id', 'hour'])
+        
+        # Deleting model 'SubscriptionHour'
+        db.delete_table('cg_channel_subscription_hour')
+        
+    
+    
+    models = {
+        'labels.language': {
+            'Meta': {'db_table': "'cg_channel_language'"},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        },
+        'auth.user': {
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(2009, 7, 22, 17, 29, 27, 740517)'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True', 'blank': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(2009, 7, 22, 17, 29, 27, 740393)'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'labels.tag': {
+            'Meta': {'db_table': "'cg_tag'"},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        },
+        'subscriptions.generatedstats': {
+            'Meta': {'db_table': "'cg_channel_generated_stats'"},
+            'channel': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'stats'", 'unique': 'True', 'primary_key': 'True', 'to': "orm['channels.Channel']"}),
+            'subscription_count': ('django.db.models.fields.IntegerField', [], {'default': '0', 'db_column': "'subscription_count_total'"}),
+            'subscription_count_month': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'subscription_count_today': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        },
+        'auth.permission': {
+            'Meta': {'unique_together': "(('content_type', 'codename'),)"},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'unique_together': "(('app_label', 'model'),)", 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'channels.channel': {
+            'Meta': {'db_table': "'cg_channel'"},
+            'adult': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'approved_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'archived': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'categories': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['labels.Category']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'featured': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'featured_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'featured_by': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'featured_set'", 'null': 'True', 'to': "orm['auth.User']"}),
+            'feed_etag': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'feed_modified': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'geoip': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100'}),
+            'hi_def': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'language': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'channels'", 'db_column': "'primary_language_id'", 'to': "orm['labels.Language']"}),
+            'last_moderated_by': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'last_moderated_set'", 'null': 'True', 'to': "orm['auth.User']"}),
+            'license': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '40'}),
+            'moderator_shared_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'moderator_shared_by': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'moderator_shared_set'", 'null': 'True', 'to': "orm['auth.User']"}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'owner': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'channels'", 'to': "orm['auth.User']"}),
+            'postal_code': ('django.db.models.fields.CharField', [], {'max_length': '15'}),
+            'publisher': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'state': ('django.db.models.fields.CharField', [], {'default': "'N'", 'max_length': '1'}),
+            'tags': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['labels.Tag']"}),
+            'thumbnail_extension': ('django.db.models.fields.CharField', [], {'default': 'None', 'max_length': '8', 'null': 'True'}),
+            'url': ('django.db.models.fields.URLField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'waiting_for_reply_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'was_featured': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'website_url': ('django.db.models.fields.URLField', [], {'max_length': '255'})
+        },
+        'subscriptions.subscription': {
+            'Meta': {'db_table': "'cg_channel_subscription'"},
+            'channel': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['channels.Channel']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'ignore_for_recommendations': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'ip_address': ('django.db.models.fields.IPAddressField', [], {'max_length': '15'}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {})
+        },
+        'subscriptions.subscriptionday': {
+            'Meta': {'unique_together': "(('channel', 'day'),)", 'db_table': "'cg_channel_subscription_day'"},
+            'channel': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['channels.Channel']"}),
+            'count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'day': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'subscriptions.subscriptionhour': {
+            'Meta': {'unique_together': "(('channel', 'hour'),)", 'db_table': "'cg_channel_subscription_hour'"},
+            'channel': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['channels.Channel']"}),
+            'count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'hour': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'labels.category': {
+            'Meta': {'db_table': "'cg_category'"},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'on_frontpage': ('django.db.models.fields.BooleanField', [], {'default': 'True', 'blank': 'True'})
+        },
+        'auth.group': {
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'blank': 'True'})
+        }
+    }
+    
+    complete_apps = ['subscriptions']
@@ -1,8 +1,45 @@
-from datetime import datetime, timedelta
+import bisect
+from datetime import date, datetime, timedelta
 
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import F, Sum
 from django.core import cache
 
+# the windows counted for each channel besides the total: size -> how many
+# days it covers.  The month is counted in calendar days, counting today,
+# from the SubscriptionDays, and the day in hours from the
+# SubscriptionHours, so that it doesn't start again at midnight.
+WINDOWS = {'month': 31,
+           'day': 1}
+# days of SubscriptionHours which are kept
+HOUR_DAYS = 2
+# how long a count is good for
+TOTAL_TIMEOUT = 600
+# most subscriptions in one INSERT; SQLite allows 999 parameters
+INSERT_SIZE = 200
+# how long the rank index is kept; it's replaced whenever the stats change
+RANKS_TIMEOUT = 3600 * 24
+
+def total_key(channel_id, size):
+    return 'subscription:%i:%s' % (channel_id, size)
+
+def window_start(size, today=None):
+    """Return the first day in the window."""
+    if today is None:
+        today = date.today()
+    return today - timedelta(days=WINDOWS[size] - 1)
+
+def hour_of(timestamp):
+    """Return the start of the hour the timestamp is in."""
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+def day_start(now=None):
+    """Return the first hour in the 'day' window: the last 24 hours, counting
+    this one."""
+    if now is None:
+        now = datetime.now()
+    return hour_of(now) - timedelta(hours=24 * WINDOWS['day'] - 1)
+
 class SubscriptionManager(models.Manager):
 
     def _should_throttle_ip_address(self, ip_address, timestamp):
@@ -25,27 +62,89 @@ class SubscriptionManager(models.Manager):
             ip_address=ip_address,
             timestamp=timestamp,
             ignore_for_recommendations=ignore_for_recommendations)
+        SubscriptionDay.objects.add(channel.pk, timestamp.date())
+        SubscriptionHour.objects.add(channel.pk, hour_of(timestamp))
+
+    @transaction.commit_on_success
+    def add_many(self, hits):
+        """
+        Write a list of (channel id, ip address, timestamp,
+        ignore_for_recommendations) with multi-row INSERTs, and add them to
+        the SubscriptionDays and SubscriptionHours with one update for each
+        channel and day or hour.  Nothing is throttled.  Returns how many
+        were written.
+        """
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        fields = [opts.get_field(name) for name in (
+                'channel', 'ip_address', 'timestamp',
+                'ignore_for_recommendations')]
+        rows = []
+        days = {}
+        hours = {}
+        for hit in hits:
+            rows.extend([field.get_db_prep_save(value, connection=connection)
+                         for field, value in zip(fields, hit)])
+            key = (hit[0], hit[2].date())
+            days[key] = days.get(key, 0) + 1
+            key = (hit[0], hour_of(hit[2]))
+            hours[key] = hours.get(key, 0) + 1
+        if not rows:
+            return 0
+        row = '(%s)' % ', '.join(['%s'] * len(fields))
+        cursor = connection.cursor()
+        step = INSERT_SIZE * len(fields)
+        for start in range(0, len(rows), step):
+            values = rows[start:start + step]
+            cursor.execute('INSERT INTO %s (%s) VALUES %s' % (
+                    qn(opts.db_table),
+                    ', '.join([qn(field.column) for field in fields]),
+                    ', '.join([row] * (len(values) / len(fields)))), values)
+        transaction.set_dirty()
+        SubscriptionDay.objects.add_counts(days)
+        SubscriptionHour.objects.add_counts(hours)
+        return len(rows) / len(fields)
 
     def total(self, channel, size=None, use_cache=True):
-        key = 'subscription:%i:%s' % (channel.pk, size)
+        """
+        Return how many subscriptions the channel has had in all, or in the
+        last month or day if size is 'month' or 'day', counted from its
+        SubscriptionDays or SubscriptionHours.
+        """
+        key = total_key(channel.pk, size)
         if use_cache:
             val = cache.cache.get(key)
             if val is not None:
                 return val
         if size is None:
-            val = self.filter(channel=channel).count()
+            query = SubscriptionDay.objects.filter(channel=channel)
+        elif size == 'day':
+            query = SubscriptionHour.objects.filter(channel=channel,
+                                                    hour__gte=day_start())
+        elif size in WINDOWS:
+            query = SubscriptionDay.objects.filter(
+                channel=channel, day__gte=window_start(size))
         else:
-            if size == 'month':
-                delta = timedelta(days=31)
-            elif size == 'day':
-                delta = timedelta(days=1)
-            else:
-                raise ValueError('invalid size: %r' % size)
-            val = self.filter(channel=channel,
-                            timestamp__gt=(datetime.now() - delta)).count()
-        cache.cache.set(key, val, 600) # statistics are good for 10 minutes
+            raise ValueError('invalid size: %r' % size)
+        val = query.aggregate(total=Sum('count'))['total'] or 0
+        cache.cache.set(key, val, TOTAL_TIMEOUT)
         return val
 
+    def compact(self, before):
+        """
+        Delete the subscriptions from before the given datetime; their
+        counts are kept in the SubscriptionDays.  Returns how many were
+        deleted.  The recommendations and the throttling only look at the
+        last month of them.  The SubscriptionHours older than HOUR_DAYS are
+        deleted as well.
+        """
+        query = self.filter(timestamp__lt=before)
+        count = query.count()
+        query.delete()
+        SubscriptionHour.objects.filter(hour__lt=hour_of(
+                datetime.now() - timedelta(days=HOUR_DAYS))).delete()
+        return count
+
 class Subscription(models.Model):
     channel = models.ForeignKey('channels.Channel')
     ip_address = models.IPAddressField()
@@ -57,6 +156,239 @@ class Subscription(models.Model):
     class Meta:
         db_table = 'cg_channel_subscription'
 
+class BucketManager(models.Manager):
+    """For models counting the subscriptions to a channel in a period,
+    named by the field called period."""
+
+    period = None
+
+    def add(self, channel_id, period, count=1):
+        """Count more subscriptions to the channel in the period."""
+        bucket = self.filter(**{'channel': channel_id, self.period: period})
+        if bucket.update(count=F('count') + count):
+            return
+        try:
+            self.create(**{'channel_id': channel_id, self.period: period,
+                           'count': count})
+        except IntegrityError:
+            # another process created it first
+            bucket.update(count=F('count') + count)
+
+    def add_counts(self, counts):
+        """add() each of a dictionary mapping (channel id, period) to a
+        count."""
+        for (channel_id, period), count in counts.items():
+            self.add(channel_id, period, count)
+
+class SubscriptionDayManager(BucketManager):
+
+    period = 'day'
+
+    def count_all(self, now=None):
+        """
+        Return a dictionary mapping the id of every channel with
+        subscriptions to (total, month, day) counts, from one pass over the
+        days grouped by channel and one over the last day's hours.
+        """
+        if now is None:
+            now = datetime.now()
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        count = qn(opts.get_field('count').column)
+        channel = qn(opts.get_field('channel').column)
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT %s, SUM(%s), '
+            'SUM(CASE WHEN %s >= %%s THEN %s ELSE 0 END) '
+            'FROM %s GROUP BY %s' % (
+                channel, count, qn(opts.get_field('day').column), count,
+                qn(opts.db_table), channel),
+            [window_start('month', now.date())])
+        day = SubscriptionHour.objects.count_since(day_start(now))
+        return dict((row[0], (int(row[1] or 0), int(row[2] or 0),
+                              day.get(row[0], 0)))
+                    for row in cursor.fetchall())
+
+    def totals_by_day(self, start, end=None):
+        """Return a dictionary mapping the days from start to end (or the
+        last one) which had subscriptions to how many there were."""
+        query = self.filter(day__gte=start)
+        if end is not None:
+            query = query.filter(day__lte=end)
+        return dict(query.values_list('day').annotate(Sum('count')))
+
+class SubscriptionDay(models.Model):
+    """
+    How many subscriptions a channel had on a day.  Subscription.objects.add()
+    keeps these up to date, so the counts over days are sums of a few
+    hundred of them instead of counts of every subscription.
+    """
+    channel = models.ForeignKey('channels.Channel')
+    day = models.DateField(db_index=True)
+    count = models.IntegerField(default=0)
+
+    objects = SubscriptionDayManager()
+
+    class Meta:
+        db_table = 'cg_channel_subscription_day'
+        unique_together = (('channel', 'day'),)
+
+class SubscriptionHourManager(BucketManager):
+
+    period = 'hour'
+
+    def count_since(self, start):
+        """Return a dictionary mapping the ids of the channels with
+        subscriptions since the start hour to how many they've had."""
+        return dict(self.filter(hour__gte=start).values_list(
+                'channel').annotate(Sum('count')))
+
+class SubscriptionHour(models.Model):
+    """
+    How many subscriptions a channel had in an hour, kept for the last
+    HOUR_DAYS days so that the day's count covers the last 24 hours.
+    """
+    channel = models.ForeignKey('channels.Channel')
+    hour = models.DateTimeField(db_index=True)
+    count = models.IntegerField(default=0)
+
+    objects = SubscriptionHourManager()
+
+    class Meta:
+        db_table = 'cg_channel_subscription_hour'
+        unique_together = (('channel', 'hour'),)
+
+class GeneratedStatsManager(models.Manager):
+
+    # GeneratedStats fields, in the order SubscriptionDay.objects.count_all()
+    # counts them
+    FIELDS = ('subscription_count', 'subscription_count_month',
+              'subscription_count_today')
+
+    def find_changes(self, counts, channel_ids):
+        """
+        Return (inserts, updates): lists of the rows to insert and update
+        so that the channels with the given ids have the counts (which map
+        channel ids to count_all() tuples; channels which aren't in it have
+        no subscriptions).  Rows which are already right are left out.
+        """
+        existing = dict((row[0], row[1:]) for row in
+                        self.values_list('channel', *self.FIELDS))
+        inserts = []
+        updates = []
+        for channel_id in channel_ids:
+            values = counts.get(channel_id, (0, 0, 0))
+            old = existing.get(channel_id)
+            if old is None:
+                inserts.append((channel_id,) + values)
+            elif tuple(old) != values:
+                updates.append(values + (channel_id,))
+        return inserts, updates
+
+    def write_changes(self, inserts, updates):
+        """Write the rows find_changes() found in one transaction, with a
+        statement for each kind."""
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table = qn(opts.db_table)
+        columns = [qn(opts.get_field(name).column) for name in self.FIELDS]
+        pk = qn(opts.pk.column)
+        cursor = connection.cursor()
+        if inserts:
+            cursor.executemany('INSERT INTO %s (%s, %s) VALUES (%s)' % (
+                    table, pk, ', '.join(columns),
+                    ', '.join(['%s'] * (len(columns) + 1))), inserts)
+        if updates:
+            cursor.executemany('UPDATE %s SET %s WHERE %s = %%s' % (
+                    table, ', '.join(['%s = %%s' % column
+                                      for column in columns]), pk), updates)
+        transaction.set_dirty()
+
+    def refresh(self, now=None):
+        """
+        Recount every approved channel's subscriptions with one grouped
+        query and write the counts which changed with two batched
+        statements, instead of counting each channel on its own.  The
+        counts are cached for Subscription.objects.total() as well.
+        Returns the number of rows (inserted, updated).
+        """
+        from channelguide.cache import utils as cache_utils
+        counts, channel_ids, inserts, updates = self._refresh_rows(now)
+        # only once they're committed, so that no other process can cache
+        # the old counts or ranks under the new stamp
+        cache_counts(counts, channel_ids)
+        if inserts or updates:
+            # saving each row would have done this
+            cache_utils.bump('Stats')
+        # so that no page has to work it out
+        self.rank_index()
+        return len(inserts), len(updates)
+
+    @transaction.commit_on_success
+    def _refresh_rows(self, now):
+        from channelguide.channels.models import Channel
+        counts = SubscriptionDay.objects.count_all(now)
+        channel_ids = list(Channel.objects.approved().values_list(
+                'id', flat=True))
+        inserts, updates = self.find_changes(counts, channel_ids)
+        self.write_changes(inserts, updates)
+        return counts, channel_ids, inserts, updates
+
+    def calculate_ranks(self):
+        """
+        Return a dictionary mapping each of the FIELDS to (values, counts):
+        the different values it has, in order, and how many rows have each
+        value or more.  There's one entry for each different value, however
+        many rows have it.
+        """
+        columns = [[] for field in self.FIELDS]
+        for row in self.values_list(*self.FIELDS):
+            for column, value in zip(columns, row):
+                column.append(value)
+        ranks = {}
+        for field, column in zip(self.FIELDS, columns):
+            column.sort()
+            values = []
+            counts = []
+            for i, value in enumerate(column):
+                if not values or values[-1] != value:
+                    values.append(value)
+                    counts.append(len(column) - i)
+            ranks[field] = (values, counts)
+        return ranks
+
+    def rank_index(self):
+        """
+        Return the calculate_ranks() of the current stats.  They're cached
+        under the 'Stats' stamp, which saving any GeneratedStats bumps, and
+        this process keeps the last ones it used.
+        """
+        global _ranks
+        from channelguide.cache import utils as cache_utils
+        key = cache_utils.digest_key('subscription:ranks',
+                                     cache_utils.get_stamps(['Stats']).items())
+        found = _ranks
+        if found is not None and found[0] == key:
+            return found[1]
+        ranks = cache.cache.get(key)
+        if ranks is None:
+            ranks = self.calculate_ranks()
+            cache.cache.set(key, ranks, RANKS_TIMEOUT)
+        _ranks = (key, ranks)
+        return ranks
+
+# (key, rank index) this process used last
+_ranks = None
+
+def cache_counts(counts, channel_ids):
+    """Store the count_all() counts of the channels for total()."""
+    values = {}
+    for channel_id in channel_ids:
+        total, month, day = counts.get(channel_id, (0, 0, 0))
+        values[total_key(channel_id, None)] = total
+        values[total_key(channel_id, 'month')] = month
+        values[total_key(channel_id, 'day')] = day
+    cache.cache.set_many(values, TOTAL_TIMEOUT)
 
 class GeneratedStats(models.Model):
     channel = models.OneToOneField('channels.Channel', primary_key=True,
@@ -66,13 +398,21 @@ class GeneratedStats(models.Model):
     subscription_count = models.IntegerField(default=0,
         db_column='subscription_count_total')
 
+    objects = GeneratedStatsManager()
+
     class Meta:
         db_table = 'cg_channel_generated_stats'
 
     def rank(self, column):
-        kw = {'%s__gte' % column: getattr(self, column)}
-        return '%i/%i' % (GeneratedStats.objects.filter(**kw).count(),
-                          GeneratedStats.objects.count())
+        """Return 'n/total', where n channels have as many subscriptions
+        in the column as this one or more."""
+        values, counts = GeneratedStats.objects.rank_index()[column]
+        i = bisect.bisect_left(values, getattr(self, column))
+        if i < len(values):
+            count = counts[i]
+        else:
+            count = 0
+        return '%i/%i' % (count, counts and counts[0] or 0)
 
     @property
     def subscription_count_today_rank(self):
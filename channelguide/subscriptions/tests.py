@@ -7,7 +7,11 @@ from django.conf import settings
 from django.core import management
 from django.core.urlresolvers import reverse
 
-from channelguide.subscriptions.models import Subscription
+from channelguide.moderate.views import stats
+from channelguide.subscriptions.buffer import SubscriptionBuffer, TokenBucket
+from channelguide.subscriptions.models import (GeneratedStats, Subscription,
+                                               SubscriptionDay,
+                                               SubscriptionHour)
 from channelguide.subscriptions.views import subscribe_hit
 from channelguide.testframework import TestCase
 
@@ -73,11 +77,191 @@ class SubscriptionTestCase(TestCase):
         management.call_command('refresh_stats_table', verbosity=0)
         self.check_subscription_counts(3, 2, 1, use_cache=True)
 
+    def test_refresh_writes_changes(self):
+        """
+        GeneratedStats.objects.refresh() should give every approved channel
+        a row with its counts, and only write the rows which changed.
+        """
+        now = datetime.now()
+        self.channel.state = 'A'
+        self.channel.save()
+        other = self.make_channel(self.ralph, state='A')
+        unapproved = self.make_channel(self.ralph)
+        for channel in self.channel, unapproved:
+            Subscription.objects.add(channel, '1.1.1.1', now)
+            Subscription.objects.add(channel, '1.1.1.1',
+                                     now - timedelta(days=7))
+        self.assertEquals(GeneratedStats.objects.refresh(), (2, 0))
+        self.assertEquals(GeneratedStats.objects.refresh(), (0, 0))
+        def counts(channel):
+            stats = GeneratedStats.objects.get(channel=channel)
+            return (stats.subscription_count, stats.subscription_count_month,
+                    stats.subscription_count_today)
+        self.assertEquals(counts(self.channel), (2, 2, 1))
+        self.assertEquals(counts(other), (0, 0, 0))
+        self.assertFalse(GeneratedStats.objects.filter(
+                channel=unapproved).count())
+        Subscription.objects.add(other, '1.1.1.1', now - timedelta(days=40))
+        self.assertEquals(GeneratedStats.objects.refresh(), (0, 1))
+        self.assertEquals(counts(other), (1, 0, 0))
+
+    def test_subscription_days(self):
+        """
+        Subscription.objects.add() should count each subscription in its
+        channel's SubscriptionDay, and compacting the subscriptions
+        shouldn't change the counts.
+        """
+        now = datetime.now()
+        week = timedelta(days=7)
+        Subscription.objects.add(self.channel, '1.1.1.1', now)
+        Subscription.objects.add(self.channel, '1.1.1.2', now)
+        Subscription.objects.add(self.channel, '1.1.1.1', now-week*6)
+        self.assertEquals(sorted(SubscriptionDay.objects.filter(
+                    channel=self.channel).values_list('day', 'count')),
+                          [((now-week*6).date(), 1), (now.date(), 2)])
+        management.call_command('compact_subscriptions', verbosity=0)
+        self.assertEquals(Subscription.objects.count(), 2)
+        self.check_subscription_counts(3, 2, 2)
+        self.assertEquals(SubscriptionDay.objects.totals_by_day(
+                now.date() - week*7), {(now-week*6).date(): 1,
+                                       now.date(): 2})
+
+    def test_rolling_day(self):
+        """
+        The day's count should be the last 24 hours', from the
+        SubscriptionHours, so it doesn't start again at midnight.
+        """
+        now = datetime(2009, 7, 22, 0, 30)
+        self.channel.state = 'A'
+        self.channel.save()
+        Subscription.objects.add(self.channel, '1.1.1.1',
+                                 datetime(2009, 7, 21, 22, 15))
+        Subscription.objects.add(self.channel, '1.1.1.2',
+                                 datetime(2009, 7, 21, 1, 0))
+        Subscription.objects.add(self.channel, '1.1.1.3',
+                                 datetime(2009, 7, 21, 0, 59))
+        Subscription.objects.add(self.channel, '1.1.1.4',
+                                 datetime(2009, 7, 22, 0, 10))
+        self.assertEquals(SubscriptionDay.objects.count_all(now),
+                          {self.channel.pk: (4, 4, 3)})
+        GeneratedStats.objects.refresh(now)
+        self.assertEquals(GeneratedStats.objects.get(
+                channel=self.channel).subscription_count_today, 3)
+        Subscription.objects.add(self.channel, '1.1.1.5', now - timedelta(
+                days=3))
+        management.call_command('compact_subscriptions', verbosity=0)
+        self.assertEquals(SubscriptionHour.objects.filter(
+                channel=self.channel).count(), 0)
+
+    def test_stats_page(self):
+        """
+        The moderators' stats should come from the days' counts.
+        """
+        yesterday = datetime.now() - timedelta(days=1)
+        Subscription.objects.add(self.channel, '1.1.1.1', yesterday)
+        Subscription.objects.add(self.channel, '1.1.1.2', yesterday)
+        admin = self.make_user('rachel')
+        admin.is_superuser = True
+        admin.save()
+        page = self.get_page(reverse(stats), login_as=admin)
+        key = 'stats:day:%i:%i:%i' % yesterday.timetuple()[:3]
+        self.assertTrue((key, 2) in page.context['today_keys'])
+
+    def test_ranks(self):
+        """
+        GeneratedStats.rank() should count the rows with as many
+        subscriptions or more from the rank index, and see saved changes.
+        """
+        counts = [(5, 3, 1), (5, 2, 0), (9, 2, 0), (0, 0, 0)]
+        stats = []
+        for total, month, today in counts:
+            stats.append(GeneratedStats.objects.create(
+                    channel=self.make_channel(self.ralph),
+                    subscription_count=total, subscription_count_month=month,
+                    subscription_count_today=today))
+        def ranks():
+            return [(s.subscription_count_rank,
+                     s.subscription_count_month_rank,
+                     s.subscription_count_today_rank) for s in stats]
+        self.assertEquals(ranks(), [('3/4', '1/4', '1/4'),
+                                    ('3/4', '3/4', '4/4'),
+                                    ('1/4', '3/4', '4/4'),
+                                    ('4/4', '4/4', '4/4')])
+        stats[3].subscription_count = 10
+        stats[3].save()
+        self.assertEquals(stats[3].subscription_count_rank, '1/4')
+        self.assertEquals(stats[2].subscription_count_rank, '2/4')
+
     def test_subscription_view(self):
         url = reverse(subscribe_hit, args=(self.channel.pk,))
         self.get_page(url)
         self.check_subscription_counts(1, 1, 1)
 
+    def test_subscription_view_throttle(self):
+        """
+        An address should get one click a second counted, for every channel
+        in it.
+        """
+        other = self.make_channel(self.ralph)
+        url = reverse(subscribe_hit, args=(self.channel.pk,))
+        self.get_page(url, data={other.pk: 1})
+        self.get_page(url)
+        self.check_subscription_counts(1, 1, 1)
+        self.assertEquals(Subscription.objects.filter(channel=other).count(),
+                          1)
+        self.assertEquals(self.get_page(url + '?%i=1' % (
+                    other.pk + 1)).status_code, 404)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=1, burst=2)
+        self.assertEquals([bucket.take('a', 0) for i in range(3)],
+                          [True, True, False])
+        self.assertFalse(bucket.take('a', 0.5))
+        self.assertTrue(bucket.take('a', 1.5))
+        self.assertTrue(bucket.take('b', 1.5))
+
+    def test_buffer(self):
+        """
+        A SubscriptionBuffer should keep the hits until it's flushed, and
+        write them all when it's stopped.
+        """
+        now = datetime.now()
+        other = self.make_channel(self.ralph)
+        buffer = SubscriptionBuffer(interval=3600)
+        for i in range(250):
+            buffer.add(self.channel.pk, '1.1.1.%i' % i, now, False)
+        buffer.add(other.pk, '1.1.1.1', now - timedelta(days=40), True)
+        buffer.add(other.pk + 1, '1.1.1.1', now, False) # no such channel
+        self.assertEquals(len(buffer), 252)
+        self.assertEquals(Subscription.objects.count(), 0)
+        buffer.stop()
+        self.assertEquals(len(buffer), 0)
+        self.assertFalse(buffer.thread.isAlive())
+        self.check_subscription_counts(250, 250, 250)
+        self.assertEquals(SubscriptionDay.objects.get(
+                channel=other).count, 1)
+        self.assertTrue(Subscription.objects.get(
+                channel=other).ignore_for_recommendations)
+
+    def test_buffer_failure(self):
+        """
+        Hits which can't be written should be kept for the next try, but
+        only the newest max_hits of them.
+        """
+        now = datetime.now()
+        buffer = SubscriptionBuffer(interval=3600, max_hits=3)
+        def existing(hits):
+            raise ValueError('database is down')
+        buffer.existing = existing
+        for i in range(5):
+            buffer.add(self.channel.pk, '1.1.1.%i' % i, now, False)
+        self.assertRaises(ValueError, buffer.flush)
+        self.assertEquals([hit[1] for hit in buffer.hits],
+                          ['1.1.1.2', '1.1.1.3', '1.1.1.4'])
+        del buffer.existing
+        buffer.stop()
+        self.check_subscription_counts(3, 3, 3)
+
     def test_ignore_for_recommendation_from_other_channel(self):
         url = reverse(subscribe_hit, args=(self.channel.pk,))
         other_channel = reverse('channelguide.channels.views.channel',
@@ -1,25 +1,46 @@
 from django.conf import settings
 from django.core.urlresolvers import resolve, Resolver404
 from django.views.decorators.cache import never_cache
-from django.http import HttpResponse
-from django.shortcuts import get_object_or_404
+from django.http import Http404, HttpResponse
 
 from channelguide import util
 
 from channelguide.channels.models import Channel
 from channelguide.channels.views import channel as channel_view
 from channelguide.guide.views.firsttime import index as firsttime_index
-from channelguide.subscriptions.models import Subscription
+from channelguide.subscriptions import buffer
+
+# ids of the channels which have been found, so that a hit for one doesn't
+# have to look it up again
+_channel_ids = set()
+
+def check_channel(id):
+    """Raise Http404 if there's no channel with the id."""
+    id = int(id)
+    if id in _channel_ids:
+        return
+    if not Channel.objects.filter(pk=id).count():
+        raise Http404
+    _channel_ids.add(id)
 
 @never_cache
 def subscribe_hit(request, id):
     """Used by our ajax call handleSubscriptionLink.  It will get a security
     error if we redirect it to a URL outside the channelguide, so we don't do
     that
+
+    The hits are written in batches by subscriptions.buffer, and an address
+    only gets one click a second counted, whichever channels it's for.
     """
     ids = [id] + [int(k) for k in request.GET]
     for id in ids:
-        channel = get_object_or_404(Channel, pk=id)
+        check_channel(id)
+    ip = request.META.get('REMOTE_ADDR', '0.0.0.0')
+    if ip == '127.0.0.1':
+        ip = request.META.get('HTTP_X_FORWARDED_FOR', '0.0.0.0')
+    if not buffer.allow(ip):
+        return HttpResponse("Hit successfull")
+    for id in ids:
         referer = request.META.get('HTTP_REFERER', '')
         ignore_for_recommendations = False
         if referer.startswith(settings.BASE_URL_FULL):
@@ -37,11 +58,7 @@ def subscribe_hit(request, id):
                         ignore_for_recommendations = True
                     elif func == firsttime_index:
                         ignore_for_recommendations = True
-        ip = request.META.get('REMOTE_ADDR', '0.0.0.0')
-        if ip == '127.0.0.1':
-            ip = request.META.get('HTTP_X_FORWARDED_FOR', '0.0.0.0')
-        Subscription.objects.add(
-            channel, ip,
-            ignore_for_recommendations=ignore_for_recommendations)
+        buffer.add(int(id), ip,
+                   ignore_for_recommendations=ignore_for_recommendations)
 
     return HttpResponse("Hit successfull")
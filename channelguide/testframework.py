@@ -28,6 +28,19 @@ def clear_cache():
             cache._cache = {}
             cache._expire_info = {}
 
+def clear_search_index():
+    from channelguide.search import backends, suggest
+    backends.get_backend().clear()
+    suggest.reset()
+
+def clear_neighbor_index():
+    from channelguide.recommendations import neighbors
+    neighbors.reset()
+
+def clear_subscription_throttle():
+    from channelguide.subscriptions import buffer
+    buffer.reset()
+
 class TestLogFilter(logging.Filter):
     def __init__(self):
         logging.Filter.__init__(self)
@@ -59,6 +72,9 @@ class TestCase(test.TestCase):
         settings.BASE_URL_FULL = 'http://testserver/'
         self.changed_settings = []
         clear_cache()
+        clear_search_index()
+        clear_neighbor_index()
+        clear_subscription_throttle()
 
     def change_setting_for_test(self, name, value):
         self.changed_settings.append((name, getattr(settings, name)))
@@ -8,3 +8,6 @@ from settings import *
 MEDIA_ROOT = os.path.join(STATIC_DIR, "test-media")
 MEDIA_URL = 'http://localhost:8000/test-media/'
 IMAGE_DOWNLOAD_CACHE_DIR = os.path.join(ROOT_DIR, 'test-image-download-cache')
+SEARCH_INDEX_PATH = ':memory:'
+SUBSCRIPTION_FLUSH_INTERVAL = 0
+RECOMMENDATION_REBUILD_THREAD = False
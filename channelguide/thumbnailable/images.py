@@ -0,0 +1,151 @@
+# Copyright (c) 2009 Participatory Culture Foundation
+# See LICENSE for details.
+
+"""Thumbnails made with PIL, in this process instead of by ImageMagick.
+
+make_thumbnails() decodes an image once and makes all of its sizes from it.
+A JPEG is only decoded at the smallest scale that's still big enough for
+the largest size.  The sizes are made largest first, and each one is
+shrunk from the smallest one already made which is at least CHAIN_FACTOR
+times as big, so most of the work is done on small images without the
+thumbnails getting blurrier.  Each thumbnail is flattened onto white and
+padded out to exactly its size with black, centred, as the "Pad Out
+Image" convert recipe util.make_thumbnail() used to run did.
+
+make_many() makes the thumbnails of a list of images in a pool of
+processes, so that they use every core.
+"""
+
+import logging
+import multiprocessing
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+# JPEG quality of the thumbnails
+QUALITY = 90
+# a size is only shrunk from another one which is this many times as big,
+# rather than from the original
+CHAIN_FACTOR = 2
+
+def identify(image_file):
+    """Return the lowercase name of the format of the image in the file
+    ('jpeg', 'png', ...).  Only the header is read."""
+    image_file.seek(0)
+    try:
+        image = Image.open(image_file)
+    except (IOError, ValueError):
+        raise ValueError('not an image we could identify')
+    if not image.format:
+        raise ValueError('not an image we could identify')
+    return image.format.lower()
+
+def fit(size, box):
+    """Return the size an image is shrunk to so that it fits in the box,
+    keeping its shape.  Images which already fit keep their size."""
+    width, height = size
+    scale = min(float(box[0]) / width, float(box[1]) / height, 1)
+    return (max(1, int(round(width * scale))),
+            max(1, int(round(height * scale))))
+
+def flatten(image):
+    """Return an RGB version of the image, with anything transparent over
+    white."""
+    if image.mode == 'P' and 'transparency' in image.info:
+        image = image.convert('RGBA')
+    if image.mode in ('RGBA', 'LA'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[3])
+        return background
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+def pad(image, width, height):
+    """Return the image centred on a black one of the given size."""
+    if image.size == (width, height):
+        return image
+    padded = Image.new('RGB', (width, height), (0, 0, 0))
+    padded.paste(image, ((width - image.size[0]) / 2,
+                         (height - image.size[1]) / 2))
+    return padded
+
+def save(image, path):
+    """Save the image in the format of the path's extension."""
+    if path.lower().endswith(('.jpeg', '.jpg')):
+        image.save(path, 'JPEG', quality=QUALITY)
+    else:
+        image.save(path)
+
+def make_thumbnails(source_path, sizes):
+    """
+    Make thumbnails of the image at source_path.  sizes is a list of
+    (path, width, height) for each one.  Raises ValueError if the image
+    can't be read.
+    """
+    if not sizes:
+        return
+    try:
+        image = Image.open(source_path)
+        # worked out from the full size, so that they're the same however
+        # the image is decoded
+        targets = [fit(image.size, (width, height))
+                   for (path, width, height) in sizes]
+        image.draft('RGB', (max([width for (width, height) in targets]),
+                            max([height for (width, height) in targets])))
+        image = flatten(image)
+    except (EnvironmentError, ValueError):
+        logging.exception('error reading image')
+        raise ValueError('could not resize image')
+    made = [] # the resized images, largest first
+    order = sorted(range(len(sizes)), reverse=True,
+                   key=lambda i: targets[i][0] * targets[i][1])
+    for i in order:
+        path, width, height = sizes[i]
+        target = targets[i]
+        source = image
+        for smaller in reversed(made):
+            if (smaller.size[0] >= target[0] * CHAIN_FACTOR and
+                smaller.size[1] >= target[1] * CHAIN_FACTOR):
+                source = smaller
+                break
+        if source.size == target:
+            resized = source
+        else:
+            resized = source.resize(target, Image.ANTIALIAS)
+        made.append(resized)
+        try:
+            save(pad(resized, width, height), path)
+        except EnvironmentError:
+            logging.exception('error saving thumbnail')
+            raise ValueError('could not resize image')
+
+def _make(job):
+    """Run make_thumbnails() for a (source path, sizes) job in a pool
+    process.  Returns False if it failed."""
+    try:
+        make_thumbnails(*job)
+    except ValueError:
+        return False
+    except:
+        logging.exception('error making thumbnails of %s' % job[0])
+        return False
+    return True
+
+def make_pool(processes=None):
+    """Return a pool of processes for make_many(), one for each core if
+    processes is None."""
+    return multiprocessing.Pool(processes)
+
+def make_many(jobs, pool=None):
+    """
+    make_thumbnails() for each of a list of (source path, sizes), in the
+    pool's processes if there is one.  Returns a list of whether each job
+    worked.
+    """
+    if pool is None or len(jobs) < 2:
+        return [_make(job) for job in jobs]
+    return pool.map(_make, jobs, chunksize=4)
@@ -12,6 +12,7 @@ from django.conf import settings
 from django.db import models
 
 from channelguide import util
+from channelguide.thumbnailable import images
 
 class Thumbnailable(models.Model):
     """Mixin class that gives thumbnail capabilities.
@@ -68,11 +69,30 @@ class Thumbnailable(models.Model):
         util.copy_obj(dest, image_file)
         self._save_to_s3('original')
 
-    def _make_thumbnail(self, image_file, width, height):
-        source = self.thumb_path('original')
-        dest = self.thumb_path("%dx%d" % (width, height))
-        util.make_thumbnail(source, dest, width, height)
-        self._save_to_s3('%dx%d' % (width, height))
+    def _save_thumbnails_to_s3(self, sizes):
+        for width, height in sizes:
+            self._save_to_s3('%dx%d' % (width, height))
+
+    def thumbnail_job(self, overwrite=False, sizes=None):
+        """
+        Return the (original path, sizes) images.make_thumbnails() takes to
+        make this object's thumbnails of the given sizes (or all of them),
+        leaving out the ones which exist unless overwrite is True.  sizes
+        is a list of 'WIDTHxHEIGHT' strings.
+        """
+        if sizes is None:
+            sizes = self.THUMBNAIL_SIZES
+        else:
+            sizes = [s.split('x') for s in sizes]
+            sizes = [(int(s[0]), int(s[1])) for s in sizes]
+        thumbnails = []
+        for width, height in sizes:
+            if (width, height) not in self.THUMBNAIL_SIZES:
+                continue
+            thumb_path = self.thumb_path("%dx%d" % (width, height))
+            if overwrite or not os.path.exists(thumb_path):
+                thumbnails.append((thumb_path, width, height))
+        return self.thumb_path('original'), thumbnails
 
     def save_thumbnail(self, image_file):
         """Save the thumbnail for this image.  image_file should be a file-like
@@ -82,9 +102,9 @@ class Thumbnailable(models.Model):
         self.thumbnail_extension = util.get_image_extension(image_file)
         image_file.seek(0)
         self._save_original_thumbnail(image_file)
-        for width, height in self.THUMBNAIL_SIZES:
-            image_file.seek(0)
-            self._make_thumbnail(image_file, width, height)
+        image_file.seek(0)
+        images.make_thumbnails(*self.thumbnail_job(overwrite=True))
+        self._save_thumbnails_to_s3(self.THUMBNAIL_SIZES)
         self.save()
 
     def refresh_thumbnails(self, overwrite=False, sizes=None):
@@ -92,18 +112,31 @@ class Thumbnailable(models.Model):
 
         if self.thumbnail_extension is None:
             return
-        image_file = file(self.thumb_path('original'))
-        if sizes is None:
-            sizes = self.THUMBNAIL_SIZES
-        else:
-            sizes = [s.split('x') for s in sizes]
-            sizes = [(int(s[0]), int(s[1])) for s in sizes]
-        for width, height in sizes:
-            if (width, height) not in self.THUMBNAIL_SIZES:
-                continue
-            thumb_path = self.thumb_path("%dx%d" % (width, height))
-            if overwrite or not os.path.exists(thumb_path):
-                self._make_thumbnail(image_file, width, height)
+        source, thumbnails = self.thumbnail_job(overwrite, sizes)
+        images.make_thumbnails(source, thumbnails)
+        self._save_thumbnails_to_s3([(width, height) for
+                                     (path, width, height) in thumbnails])
 
     def thumbnail_exists(self):
         return self.thumbnail_extension is not None
+
+def refresh_many(objects, overwrite=False, sizes=None, pool=None):
+    """
+    refresh_thumbnails() for each of a list of Thumbnailables, with the
+    images made in the pool's processes (see images.make_pool()) if there
+    is one.  The ones whose images can't be read are skipped.
+    """
+    jobs = []
+    refreshing = []
+    for obj in objects:
+        if obj.thumbnail_extension is None:
+            continue
+        source, thumbnails = obj.thumbnail_job(overwrite, sizes)
+        if thumbnails:
+            jobs.append((source, thumbnails))
+            refreshing.append(obj)
+    made = images.make_many(jobs, pool)
+    for obj, (source, thumbnails), worked in zip(refreshing, jobs, made):
+        if worked:
+            obj._save_thumbnails_to_s3([(width, height) for
+                                        (path, width, height) in thumbnails])
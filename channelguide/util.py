@@ -9,7 +9,6 @@ from urllib import quote, urlopen, unquote_plus
 from xml.sax import saxutils
 import Queue
 import cgi
-import logging
 import md5
 import os
 import re
@@ -195,15 +194,8 @@ def copy_obj(dest_path, file_obj):
         f.close()
 
 def get_image_extension(image_file):
-    image_file.seek(0)
-    try:
-        identify_output = call_command('identify', '-',
-                                       data=image_file)
-    except EnvironmentError:
-        raise ValueError('not an image we could identify')
-    if identify_output is '':
-        raise ValueError('not an image we could identify')
-    return identify_output.split(" ")[1].lower()
+    from channelguide.thumbnailable import images
+    return images.identify(image_file)
 
 def push_media_to_s3(subpath, content_type):
     """
@@ -232,20 +224,10 @@ def push_media_to_s3(subpath, content_type):
 
 
 def make_thumbnail(source_path, dest_path, width, height):
-    # From the "Pad Out Image" recipe at
-    # http://www.imagemagick.org/Usage/thumbnails/
-    border_width = max(width, height) / 2
-    try:
-        call_command("convert",  source_path,
-                     "-strip", '-flatten',
-                     "-resize", "%dx%d>" % (width, height),
-                     "-gravity", "center", "-bordercolor", "black",
-                     "-border", "%s" % border_width,
-                     "-crop", "%dx%d+0+0" % (width, height),
-                     "+repage", dest_path)
-    except EnvironmentError:
-        logging.exception('error resizing image')
-        raise ValueError('could not resize image')
+    """Shrink the image to fit in width x height, padded out with black.
+    Raises ValueError if it can't be read."""
+    from channelguide.thumbnailable import images
+    images.make_thumbnails(source_path, [(dest_path, width, height)])
 
 def hash_string(str):
     return md5.new(str.encode('utf8')).hexdigest()
@@ -327,23 +309,16 @@ def grab_urls(urls, num_threads=5):
     pprinter.loop_done()
     return results
 
-subprocess_lock = threading.Lock()
 def call_command(*args, **kwargs):
     data = kwargs.pop('data', None)
     if kwargs:
         raise TypeError('extra keyword args: %s' % kwargs.keys())
-    subprocess_lock.acquire()
-    try:
-        pipe = subprocess.Popen(args, stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if data is not None:
-            pipe.stdin.write(data.read())
-        pipe.stdin.close()
-        stdout = pipe.stdout.read()
-        stderr = pipe.stderr.read()
-        returncode = pipe.wait()
-    finally:
-        subprocess_lock.release()
+    pipe = subprocess.Popen(args, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if data is not None:
+        data = data.read()
+    stdout, stderr = pipe.communicate(data)
+    returncode = pipe.returncode
     if returncode != 0:
         raise OSError("Error running %r: %s\n(return code %s)" %
                 (args, stderr, returncode))
@@ -11,4 +11,5 @@ setup(name="channelguide",
                         'mysql-python',
                         'python-memcached',
                         'south',
-                        'feedparser'])
+                        'feedparser',
+                        'PIL'])